@@ -10,8 +10,13 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from collections import Counter, namedtuple
+
+import bgzf
 import file_utils as fu
 import utils as u
+from lookup import Query, newLookup, BATCH_SIZE
+from transcripts import exonNumbers
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -107,89 +112,158 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
+"""Binds a stage's per-line annotation function to its log writer, so the
+   same stage can run over temp files or inside the fused single pass;
+   after names the earlier stages whose annotations it reads
+"""
+Stage = namedtuple('Stage', ['name', 'annotateLine', 'writeLog', 'kwargs',
+    'after'], defaults=[()])
+
+
+"""Runs one stage over a whole file: every line of infile is annotated
+   into outfile and the stage counters are written to logfile
+"""
+def runStage(infile, outfile, logfile, stage, logmode='a', 
+    batch_size=BATCH_SIZE, db=None):
+
+    fh = bgzf.openText(infile)
     fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+    conn = None
+    if db is None:
+        conn = u.db_connect()
+        db = newLookup(conn.cursor(), batch_size)
+    counts = Counter()
+
+    for lines in fu.readChunks(fh, batch_size):
+        for line in annotateChunk(lines, stage, db, counts):
+            fh_out.write(line + '\n')
 
-    inds = getFormatSpecificIndices(format=format)
+    fh_log = open(logfile, logmode)
+    stage.writeLog(fh_log, counts, **stage.kwargs)
+    fh_log.close()
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    if conn is not None:
+        conn.close()
+    fh.close()
+    fh_out.close()
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
+
+"""Annotates a chunk of lines with one stage; lookups that can be batched
+   are resolved for the whole chunk before the lines are annotated
+"""
+def annotateChunk(lines, stage, db, counts):
+    db.prefetch(stage, lines)
+    annotated = [stage.annotateLine(line, db, counts, **stage.kwargs) 
+        for line in lines]
+    db.release()
+    return annotated
+
+
+"""True if every chromosome's variants appear in non-decreasing position
+   order, which is what the sweep lookups need; chromosomes themselves
+   may come in any order
+"""
+def isSorted(infile, format='vcf', sep='\t'):
+    inds = getFormatSpecificIndices(format=format)
+    last = {}
+    with bgzf.openText(infile) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith("#") or (line == ''):
+                continue
             fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+            try:
+                chr = fields[inds[0]].strip()
+                pos = int(fields[inds[1]].strip())
+            except (IndexError, ValueError):
+                return False
+            if (pos < last.get(chr, pos)):
+                return False
+            last[chr] = pos
+    return True
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+""" 
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+    runStage(vcf, vcf + tmpextout, vcf + '.count.log', 
+        Stage('dbSNP', getSnpsFromDbSnpLine, getSnpsFromDbSnpLog, 
+            {'format': format, 'varclass': varclass, 'sep': sep}), 
+        logmode='w')
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+def getSnpsFromDbSnpLine(line, db, counts, format='vcf', varclass='SNV',
+    sep='\t'):
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+    inds = getFormatSpecificIndices(format=format)
+    line = line.strip()
+    if line.startswith("#"):
+        return line
+
+    fields = line.split(sep)
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+    rows = db.fetchall(dbSnpQuery(chr, pos, ref, getComplementary(ref),
+        varclass))
+
+    fields[2] = '.'
+    if (len(rows) > 0):
+        rsids, maf_str = dbSnpRecords(rows)
+        counts['var_count'] += 1
+        if (str(fields[7]) == '.'):
+            fields[7] = 'DB' + maf_str
+        else:
+            fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+        fields[2] = rsids
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    ## rsid stays "." otherwise - in case there was annotation from old release of dbSNP
+    counts['linenum'] += 1
+    return '\t'.join([str(x) for x in fields])
 
-            linenum = linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
+"""dbSNP rows of varclass at pos on chr with ref, or its complement
+   compRef, as reference base
+"""
+def dbSnpQuery(chr, pos, ref, compRef, varclass='SNV'):
+    return Query('dbSNP', 'CHR', chr, pos, 'POS', 'POS', 
+        match=((('REF', ref), ('INFO', varclass)), 
+            (('REF', compRef), ('INFO', varclass))))
 
+
+"""rsids written to ID and GMAF records written to INFO for dbSNP rows
+"""
+def dbSnpRecords(rows):
+    rsids = []
+    mafs = []
+    for row in rows:
+        rsids.append(str(row[3]))
+        if (str(row[7]) != '.'):
+            mafs.append('GMAF=' + str(row[7]))
+
+    maf_str=''
+    if (len(mafs) > 0):
+        maf_str = ';' + ';'.join([str(x) for x in mafs])
+    return str(';'.join(rsids)), maf_str
+
+
+def getSnpsFromDbSnpLog(fh_log, counts, **kwargs):
+    linenum = counts['linenum'] + 1
+    var_count = counts['var_count']
     ratioInDbSnp = (var_count / float(linenum)) * 100
     fh_log.write("## Please notice that all Isoforms were counted\n")
     fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
     fh_log.write(f"Total: {str(linenum)}\n")
     fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -198,307 +272,205 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     3. chrom_pos_unequal
 """
 def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage('BigRefGene', getBigRefGeneLine, writeNoLog, 
+            {'format': format, 'sep': sep}))
 
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+def getBigRefGeneLine(line, db, counts, format='vcf', sep='\t'):
+    inds = getFormatSpecificIndices(format=format)
+    line = line.strip()
+    if line.startswith("#"):
+        return line
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+    fields = line.split(sep)
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+    compRef = getComplementary(ref)
+    compAlt = getComplementary(alt)
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    query1 = Query('chrom_pos_equal_base', 'CHR', chr, pos, 'start', 'start', 
+        match=((('haplotypeReference', ref), ('haplotypeAlternate', alt)), 
+            (('haplotypeReference', compRef), ('haplotypeAlternate', compAlt))))
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+    query2 = Query('chrom_pos_equal_nobase', 'CHR', chr, pos, 'start', 'start')
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    query3 = Query('chrom_pos_unequal', 'CHR', chr, pos, 'start', 'end')
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+    for query in [query1, query2, query3]:
+        rows = db.fetchall(query)
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+            fields[7] = fields[7] + ';' + ';'.join(m)
+            if (str(fields[7]).startswith(".;")):
+                fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+            return '\t'.join([str(x) for x in fields])
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+    return line
 
-            if (keep_going):
-                fh_out.write(line + '\n')
 
-            vcf_linenum = vcf_linenum + 1
+"""Log writer for stages that do not report any counts
+"""
+def writeNoLog(fh_log, counts, **kwargs):
+    pass
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""getGenes counter of each positionType an earlier stage wrote to INFO
+"""
+POSITION_TYPE_COUNTS = {
+    'intron': 'intronic_count',
+    'non_coding_intron': 'non_coding_intronic_count',
+    'CDS': 'cds_count',
+    'non_coding_exon': 'non_coding_exonic_count',
+    'utr5': 'utr5_count',
+    'utr3': 'utr3_count',
+}
 
 
 """Get information about location in gene structures
 """
 def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
 
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage('refGene', getGenesLine, getGenesLog, {'format': format, 
+            'table': table, 'promoter_offset': promoter_offset, 'sep': sep}))
 
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
 
-                    else:
-                        region = ''
+def getGenesLine(line, db, counts, format='vcf', table='refGene', 
+    promoter_offset=500, sep='\t'):
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+    inds = getFormatSpecificIndices(format=format)
+    line = line.strip()
+    if line.startswith("#"):
+        return line
+
+    fields = line.split(sep)
+    chr = fields[inds[0]].strip()
+
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    alt = clean_mysql_chars(fields[inds[3]]).strip()
+    info_field = clean_mysql_chars(fields[7]).strip()
+    this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+
+    rows = db.fetchall(Query(table, 'chrom', chr, pos, 'txStart', 'txEnd', 
+        offset=promoter_offset))
+    info = []
+
+    if (len(rows) == 0):
+        fields[7] = fields[7] + ";positionType=interGenic"
+        counts['interGenic_count'] += 1
+        return '\t'.join(fields)
+
+    cnt = 1
+    for row in rows:
+        #count location
+        positionType = str(u.parse_field(info_field, 
+            'positionType', ';', '='))
+        if positionType in POSITION_TYPE_COUNTS:
+            counts[POSITION_TYPE_COUNTS[positionType]] += 1
+
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        exonCount = int(row[8])
+        geneSymbol = str(row[12])
+        strand = str(row[3])
+
+        promoter_plus = txtStart - int(promoter_offset)
+        promoter_minus = txtEnd + int(promoter_offset)
+        region = ""
+        pos = int(pos)
+        exons = []
+
+        if (cdsStart == cdsEnd):
+            for exnum in exonNumbers(row, pos):
+                exons.append("non_coding_exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+            if (len(exons) > 0):
+                region = ";".join(exons)
+        elif (u.isBetween(pos, cdsStart, cdsEnd)):
+            for exnum in exonNumbers(row, pos):
+                exons.append("exon=" +  "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                counts['exonic_count'] += 1
+            if (len(exons) > 0):
+                region = ";".join(exons)
+
+        elif ((u.isBetween(pos, promoter_plus, txtStart) and 
+            (strand == "+")) or 
+            (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"))):
+            island = db.fetchone(Query('cpgIslandExt', 'chrom', chr, pos, 
+                columns='chrom, chromStart, chromEnd, name'))
+
+            if (island is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(island[3]).split())
+                counts['promoter_count'] += 1
 
-                    cnt = cnt + 1
+        else:
+            region = ''
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+        if (region != ''):
+            info.append(collapseGeneNames(row=row, 
+                indices=indicesKnownGenes, region=region, cnt=cnt))
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+        cnt = cnt + 1
 
-            linenum = linenum + 1
+    str_info = ";".join(info)
+    fields[7] = fields[7] + ';' + str_info
+    return '\t'.join(fields)
 
-        else:
-            fh_out.write(line + '\n')
 
+def getGenesLog(fh_log, counts, **kwargs):
     print("Variants located:")
     fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    print(f"In interGenic {str(counts['interGenic_count'])}")
+    fh_log.write(f"In interGenic {str(counts['interGenic_count'])}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    print(f"In CDS {str(counts['cds_count'])}")
+    fh_log.write(f"In CDS {str(counts['cds_count'])}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    print(f"In \'3 UTR {str(counts['utr3_count'])}")
+    fh_log.write(f"In \'3 UTR {str(counts['utr3_count'])}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    print(f"In \'5 UTR {str(counts['utr5_count'])}")
+    fh_log.write(f"In \'5 UTR {str(counts['utr5_count'])}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    print(f"In Intronic {str(counts['intronic_count'])}")
+    fh_log.write(f"In Intronic {str(counts['intronic_count'])}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    print(f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}")
+    fh_log.write(f"In Non_coding_intronic " + \
+        f"{str(counts['non_coding_intronic_count'])}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    print(f"In Exonic {str(counts['exonic_count'])}")
+    fh_log.write(f"In Exonic {str(counts['exonic_count'])}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    print(f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}")
+    fh_log.write(f"In Non_coding_exonic " + \
+        f"{str(counts['non_coding_exonic_count'])}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    print(f"In Putative Promoter Region {str(counts['promoter_count'])}")
+    fh_log.write(f"In Putative Promoter Region " + \
+        f"{str(counts['promoter_count'])}\n")
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -560,8 +532,6 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
                     geneSymbol = str(row[12])
                     strand = str(row[3])
 
@@ -570,18 +540,12 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
+                        for exnum in exonNumbers(row, pos):
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
                             region='positionType=non_coding_exon;' + ";".join(exons)
                         else:
@@ -590,14 +554,10 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
                         cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
+                        for exnum in exonNumbers(row, pos):
+                            exons.append("exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count=exonic_count+1
                         if (len(exons) > 0):
                             region = 'positionType=CDS;' + ";".join(exons)
                         else:
@@ -712,400 +672,193 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     conn.close()
 
 
-"""Overlap with tfbsConsSites
+"""Log writer shared by the overlap stages
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
+def addOverlapLog(fh_log, counts, table='', **kwargs):
+    fh_log.write(f"In {str(table)}: {str(counts['var_count'])} in " + \
+        f"{str(counts['line_count'])} variants\n")
+
+
+"""Overlap stage of one reference table, as run by addOverlapLine:
+   table       table read (the prefix of the per-chromosome tables when
+               chroms is set); also the key written to INFO
+   value       format of one overlap, over the columns of a matching row
+   chrom_col, start_col, end_col, columns
+               columns of the Query issued for each variant
+   add_chr     True to prefix the variant's chrom with 'chr', False to
+               strip the prefix
+   chroms      chromosomes that have a table of their own
+   first       only the first matching row is used
+   strip       strip each formatted value
+   dedup       drop repeated values
+   key         written before each value, or once before all of them
+               with key_once; None means table
+   joiner      put between the written values
+   sanitize    replace ';' with ',' in what is written
+   always_sep  put ';' before what is written even if INFO ends with ';'
+   field_sep   joins the fields of an annotated line
+"""
+OverlapSpec = namedtuple('OverlapSpec', ['table', 'value', 'chrom_col',
+    'start_col', 'end_col', 'columns', 'add_chr', 'chroms', 'first',
+    'strip', 'dedup', 'key', 'key_once', 'joiner', 'sanitize', 'always_sep',
+    'field_sep'], defaults=['chrom', 'chromStart', 'chromEnd', '*', True,
+    None, False, False, False, None, False, ';', False, False, '\t'])
+
+"""Overlap stages by table; a new overlap table needs only an entry here
+   and a Stage running addOverlapLine with its table
+"""
+OVERLAP_SPECS = dict([(spec.table, spec) for spec in [
+    OverlapSpec('cytoBand', '{3}', dedup=True, key_once=True),
+    # For some reason this table has no "chr" preceeding number
+    OverlapSpec('gadAll', '{3}', chrom_col='chromosome', add_chr=False,
+        dedup=True, field_sep='\t '),
+    OverlapSpec('gwasCatalog', 'pubMedID={5},trait={10}',
+        start_col='chromEnd'),
+    OverlapSpec('targetScanS', '{4},{1}_{2}_{3}', first=True, strip=True,
+        key='miRNAsites'),
+    OverlapSpec('hugo', '{5},{6}', strip=True, dedup=True,
+        key='HGNC_GeneAnnotation', joiner=',', sanitize=True),
+    OverlapSpec('genomicSuperDups', 'True;otherChrom={7};otherStart={8};' +
+        'otherEnd={9}', first=True, always_sep=True),
+    OverlapSpec('tfbsConsSites', '{3}.{0}.{1}.{2}', chrom_col=None,
+        columns='chrom, chromStart, chromEnd, name', strip=True,
+        key='tfbsRegion', chroms=[str(i) for i in range(1, 23)] + 
+        ['X', 'Y'])] +
+    [OverlapSpec(table, 'True', first=True) for table in ['dgv_Cnv',
+        'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv']]])
+
+
+"""Adds the overlaps of a variant with the table of spec (by default
+   OVERLAP_SPECS[table]) to its INFO; counts line_count for each variant
+   with overlaps and var_count for each overlapping row
+"""
+def addOverlapLine(line, db, counts, format='vcf', table='', sep='\t',
+    spec=None):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    spec = spec or OVERLAP_SPECS[table]
+    inds = getFormatSpecificIndices(format=format)
+    line = line.strip()
+    ## not comments, header line
+    if (line.startswith("##") or line.startswith('CHROM') or 
+        line.startswith('#CHROM')):
+        return line
+
+    fields = line.split(sep)
+    chr, query_table = overlapTarget(spec, fields[inds[0]].strip())
+    if query_table is None: # chrom is not on the list
+        return line
+
+    pos = fields[inds[1]].strip()
+    rows = overlapRows(spec, db, query_table, chr, pos)
+    if (len(rows) == 0):
+        return line
+
+    counts['line_count'] += 1
+    counts['var_count'] += len(rows)
+
+    records = overlapRecords(spec, rows)
+    if str(fields[7]).endswith(';') and not spec.always_sep:
+        fields[7] = fields[7] + records
+    else:
+        fields[7] = fields[7] + ';' + records
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    return spec.field_sep.join(fields)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+"""Chromosome the lookups of spec use for a variant on chr, and the table
+   they read; the table is None if chr has no table of its own
+"""
+def overlapTarget(spec, chr):
+    if spec.add_chr and not chr.startswith("chr"):
+        chr = "chr" + chr
+    elif (not spec.add_chr) and chr.startswith("chr"):
+        chr = str(chr).replace("chr", "")
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    if spec.chroms is None:
+        return chr, spec.table
+    chrIndex = chr.replace('chr', '')
+    if (chrIndex not in spec.chroms):
+        return chr, None
+    return chr, spec.table + chrIndex
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+"""Rows of query_table that overlap pos on chr, as spec reads them
+"""
+def overlapRows(spec, db, query_table, chr, pos):
+    query = Query(query_table, spec.chrom_col, chr, pos, spec.start_col,
+        spec.end_col, columns=spec.columns)
+    if spec.first:
+        row = db.fetchone(query)
+        return [] if (row is None) else [row]
+    return db.fetchall(query)
 
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
 
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+"""What spec writes to INFO for the overlapping rows
+"""
+def overlapRecords(spec, rows):
+    values = [spec.value.format(*row) for row in rows]
+    if spec.strip:
+        values = [v.strip() for v in values]
+    if spec.dedup:
+        values = u.dedup(values)
+
+    key = spec.key or str(spec.table)
+    if spec.key_once:
+        records = key + '=' + spec.joiner.join(values)
+    else:
+        records = spec.joiner.join([key + '=' + v for v in values])
+    if spec.sanitize:
+        records = records.replace(';', ',')
+    return records
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
 
-        linenum = linenum + 1
+"""Overlap with tfbsConsSites
+"""
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapLog, 
+            {'format': format, 'table': table, 'sep': sep}))
 
 
 """Overlap with GadAll table
 """
 def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
     tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapLog, 
+            {'format': format, 'table': table, 'sep': sep}))
 
 
 """ Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapLog, 
+            {'format': format, 'table': table, 'sep': sep}))
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapLog, 
+            {'format': format, 'table': table, 'sep': sep}))
 
 
 """Overlap with segdup regions genomicSuperDups
 """
 def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
     table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapLog, 
+            {'format': format, 'table': table, 'sep': sep}))
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1187,217 +940,43 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     fh_out.close()
 
 
-"""Method to find overlap with Cytoband table
+"""Method to find overlap with Cytoband table; any other table is read
+   as gene bands (name2 of the transcripts overlapping the variant)
 """
 def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    spec = OVERLAP_SPECS['cytoBand']
+    if (table != 'cytoBand'):
+        spec = spec._replace(table=table, value='{12}', start_col='txStart',
+            end_col='txEnd')
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapLog, 
+            {'format': format, 'table': table, 'sep': sep, 'spec': spec}))
 
 
 """Method to find overlap with CNV tables
 """
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapLog, 
+            {'format': format, 'table': table, 'sep': sep}))
 
 
 """Method to find overlap with targetScanS tables
 """
 def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runStage(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', 
+        Stage(table, addOverlapLine, addOverlapWithMiRNALog, 
+            {'format': format, 'table': table, 'sep': sep}))
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNALog(fh_log, counts, **kwargs):
+    fh_log.write(f"In miRNAsites: {str(counts['var_count'])} in " + \
+        f"{str(counts['line_count'])} variants\n")
 
-### EOF
\ No newline at end of file
+### EOF
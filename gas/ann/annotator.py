@@ -1,15 +1,23 @@
 import uuid
-import subprocess
-from subprocess import PIPE
 import os
+import time
 import boto3
 from botocore.exceptions import ClientError
 import json
 
+import run
+import job_runner
+import job_scheduler
+from worker_pool import WorkerPool
+
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read('ann_config.ini')
 
+# Fields annotate_job reads from a job request
+JOB_FIELDS = ['job_id', 'user_id', 's3_inputs_bucket', 's3_key_input_file', 
+    'recipients', 'user_role']
+
 def update_job_status(job_id):
     dynamodb = boto3.resource('dynamodb', config['aws']['AwsRegionName'])
     ann_table = dynamodb.Table(config['aws']['AnnTableName'])
@@ -33,69 +41,153 @@ def update_job_status(job_id):
             raise
     else:
         print("UpdateItem succeeded.")
-# Connect to SQS and get the message queue
-sqs = boto3.resource('sqs', region_name=config['aws']['AwsRegionName'])
-queue = sqs.get_queue_by_name(QueueName=config['aws']['SQSRequestQueueName'])
-# Poll the message queue in a loop 
-while True:
-    # Attempt to read a message from the queue
-    # Use long polling - DO NOT use sleep() to wait between polls
-    messages = queue.receive_messages(WaitTimeSeconds=20)
-    if (len(messages) > 0):
-        message = messages[0]
-        body = json.loads(message.body)['Message']
-        info = json.loads(body)
-        # If message read, extract job parameters from the message body as before
-        job_id = info['job_id']
-        user_id = info['user_id']
-        input_file_name = info["input_file_name"]
-        s3_inputs_bucket = info["s3_inputs_bucket"]
-        s3_key_input_file = info["s3_key_input_file"]
-        submit_time = info["submit_time"]
-        job_status = info["job_status"]
-        recipients = info["recipients"]
-        user_role = info["user_role"]
-        # Include below the same code you used in prior homework
-        # Get the input file S3 object and copy it to a local file
-        # Use a local directory structure that makes it easy to organize
-        # multiple running annotation jobs
-        s3 = boto3.resource('s3')
-        key = s3_key_input_file
-        print("key "+ key)
-        new_dir = config['local']['LocalDir'] + user_id
-        if not os.path.exists(new_dir):
-            try: 
-                os.mkdir(new_dir)
-            except OSError as e:
-                print(e.errno)
-            except ValueError as e:
-                print(e.errno)
-            except Exception as e: 
-                print(e.errno)
-        
-        try:
-            file = s3.Bucket(s3_inputs_bucket).download_file(key, config['local']['LocalDir'] + key.split('/')[1] + '/' + key.split('/')[2])
-        except ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                print("The object does not exist.")
-            else:
-                raise
 
-        # Launch annotation job as a background process
-        try:
-            p2 = subprocess.Popen(['python', 'run.py', config['local']['LocalDir'] +  key.split('/')[1] + '/' + key.split('/')[2], job_id, recipients, user_role], stdout=PIPE, stderr=PIPE)
-            update_job_status(job_id)
+"""Marks a job that was given up on (see job_runner.JobRunner) as FAILED,
+   unless it has already completed
+"""
+def fail_job(info):
+    dynamodb = boto3.resource('dynamodb', config['aws']['AwsRegionName'])
+    ann_table = dynamodb.Table(config['aws']['AnnTableName'])
+    try:
+        response = ann_table.update_item(
+            Key={
+                'job_id': info['job_id']
+            },
+            UpdateExpression="set job_status = :s",
+            ConditionExpression="job_status in (:p, :r)",
+            ExpressionAttributeValues={
+                ':s': "FAILED",
+                ':p': 'PENDING',
+                ':r': 'RUNNING'
+            },
+            ReturnValues="UPDATED_NEW"
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+            print(e.response['Error']['Message'])
+        else:
+            raise
+    else:
+        print("UpdateItem succeeded.")
+
+"""driver.run options of a job: results are only sorted by position
+   (and indexed) if the request asks for sort_input or SortInput = yes in
+   [local]; preserve_order (PreserveOrder) puts sorted results back in
+   the order of the input. The variant cache is set up by [local] alone:
+   CachePath (the cache shared by this host's jobs), CacheBytes (its size
+   bound), ReferenceVersion (the version it is keyed on) and
+   KnownVariants (a known_variants artifact to copy annotations from)
+"""
+def job_options(info):
+    options = {}
+    for option, setting in [('sort_input', 'SortInput'), 
+        ('preserve_order', 'PreserveOrder')]:
+        options[option] = bool(info.get(option, 
+            config.getboolean('local', setting, fallback=False)))
+    for option, setting in [('cache_path', 'CachePath'), 
+        ('reference_version', 'ReferenceVersion'), 
+        ('known_variants', 'KnownVariants')]:
+        if config.has_option('local', setting):
+            options[option] = config['local'][setting]
+    if config.has_option('local', 'CacheBytes'):
+        options['cache_bytes'] = config.getint('local', 'CacheBytes')
+    return options
+
+"""Runs in a warm worker: copies the job's input from S3 to a local file
+   and annotates it, or with StreamJobs = yes in [local] annotates it
+   straight from and to S3
+"""
+def annotate_job(info):
+    # Extract job parameters from the message body as before
+    job_id = info['job_id']
+    user_id = info['user_id']
+    s3_inputs_bucket = info["s3_inputs_bucket"]
+    s3_key_input_file = info["s3_key_input_file"]
+    recipients = info["recipients"]
+    user_role = info["user_role"]
+    key = s3_key_input_file
+    if config.getboolean('local', 'StreamJobs', fallback=False):
+        update_job_status(job_id)
+        run.run_stream_job(s3_inputs_bucket, key, job_id, recipients, 
+            user_role, job_options(info))
+        return
+    # Get the input file S3 object and copy it to a local file
+    # Use a local directory structure that makes it easy to organize
+    # multiple running annotation jobs
+    s3 = boto3.resource('s3')
+    print("key "+ key)
+    new_dir = config['local']['LocalDir'] + user_id
+    if not os.path.exists(new_dir):
+        try: 
+            os.mkdir(new_dir)
+        except FileExistsError:
+            pass
         except OSError as e:
             print(e.errno)
-        except ValueError as e:
-            print(e.errno)
-        except Exception as e: 
-            print(e.errno)
-        # Delete the message from the queue, if job was successfully submitted
-        try:
-            delete_response = message.delete()
-        except ClientError as e:
-            print("Can't delete message.")
+
+    input_file = config['local']['LocalDir'] + key.split('/')[1] + '/' + key.split('/')[2]
+    try:
+        file = s3.Bucket(s3_inputs_bucket).download_file(key, input_file)
+    except ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            # Nothing to annotate; the message is deleted
+            print("The object does not exist.")
+            return
+        else:
+            raise
+
+    update_job_status(job_id)
+    run.run_job(input_file, job_id, recipients, user_role, job_options(info))
+
+if __name__ == '__main__':
+    # Run as many jobs at once as there are CPUs, as long as each can have
+    # AnnJobMemoryMB of memory ([local]; AnnWorkers caps the number); the
+    # warm workers are started before any boto3 client exists and keep
+    # the annotation modules and a database connection between jobs
+    slots = job_runner.jobSlots(
+        job_memory=int(config['local'].get('AnnJobMemoryMB', 1024)) * 1024 * 1024,
+        max_slots=int(config['local'].get('AnnWorkers', 0)) or None)
+    pool = WorkerPool(workers=slots)
+    # Connect to SQS and get the message queue
+    sqs = boto3.resource('sqs', region_name=config['aws']['AwsRegionName'])
+    queue = sqs.get_queue_by_name(QueueName=config['aws']['SQSRequestQueueName'])
+    s3_client = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    # Jobs wait in a small backlog, run shortest first with premium
+    # users' jobs weighted ahead; queue waits per tier are printed
+    # every minute
+    scheduler = job_scheduler.Scheduler()
+    # A job still failing on the AnnMaxReceives-th delivery of its message
+    # is marked FAILED and its message deleted
+    runner = job_runner.JobRunner(queue, pool, slots, scheduler=scheduler,
+        max_receives=int(config['local'].get('AnnMaxReceives', 
+            job_runner.MAX_RECEIVES)), abandon=fail_job)
+    reported = time.time()
+    # Poll the message queue in a loop 
+    while True:
+        # Wait for room in the backlog, then read up to that many messages
+        # Use long polling - DO NOT use sleep() to wait between polls
+        messages = runner.receive()
+        for message in messages:
+            # A message that is not a job request, or lacks the fields of
+            # one, can never run; it is deleted
+            try:
+                info = dict(json.loads(json.loads(message.body)['Message']))
+                missing = [field for field in JOB_FIELDS if field not in info]
+                if missing:
+                    raise KeyError(', '.join(missing))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Can't read message {message.message_id}: {e}")
+                runner.delete(message)
+                continue
+            # Schedule the annotation job by the size of its input; a
+            # warm worker runs it and its message is deleted once it is done
+            size = job_scheduler.objectSize(s3_client, 
+                info['s3_inputs_bucket'], info['s3_key_input_file'])
+            runner.submit(message, annotate_job, (info,), size=size, 
+                tier=info.get('user_role'), since=info.get('submit_time'))
+        if time.time() - reported >= 60:
+            print(scheduler.report())
+            reported = time.time()
 
 
 
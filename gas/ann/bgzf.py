@@ -0,0 +1,401 @@
+# bgzf.py
+#
+# Reads plain, gzip and bgzip VCFs as text and writes annotated VCFs as
+# BGZF, building a tabix index (.tbi, or .csi for chromosomes longer than
+# 512 Mbp) while the blocks are written
+#
+# Usage: python bgzf.py <vcf> <output.vcf.gz>
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import sys
+import gzip
+import zlib
+import struct
+
+"""Extensions of compressed VCFs, stripped when naming the output
+"""
+GZIP_EXTS = ['.gz', '.bgz']
+GZIP_MAGIC = b'\x1f\x8b'
+
+"""Uncompressed bytes per BGZF block, as written by bgzip; a block must
+   stay under 64 KiB compressed
+"""
+BLOCK_DATA = 0xff00
+COMPRESS_LEVEL = 6
+BLOCK_HEADER = bytes.fromhex('1f8b08040000000000ff060042430200')
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000' +
+    '000000000000')
+
+"""Binning of the index, as in the SAM/tabix specifications: 16 kbp
+   linear windows and bins over 5 levels cover 2^29 bp in a .tbi; a .csi
+   adds levels until its largest position is covered
+"""
+MIN_SHIFT = 14
+TBI_DEPTH = 5
+TBI_MAX = 1 << (MIN_SHIFT + 3 * TBI_DEPTH)
+
+"""Tabix header for VCF: format, sequence, begin and end columns (end 0
+   means begin + length of REF), meta character and skipped lines
+"""
+TABIX_VCF = (2, 1, 2, 0, ord('#'), 0)
+
+
+def isGzipped(path):
+    with open(path, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+"""Opens a plain, gzip or bgzip file for reading as text; compressed
+   files are decompressed as they are read
+"""
+def openText(path):
+    if isGzipped(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""Opens path for writing annotated lines: a BgzfVcfWriter if the name
+   ends with .gz, a plain text file otherwise
+"""
+def openOutput(path, index=True):
+    if path.endswith('.gz'):
+        return BgzfVcfWriter(path, index=index)
+    return open(path, 'w')
+
+
+"""Index written next to path, or None
+"""
+def indexPath(path):
+    for ext in ['.tbi', '.csi']:
+        if os.path.exists(path + ext):
+            return path + ext
+    return None
+
+
+"""Writes BGZF blocks to fh; tell() gives the virtual offset of the next
+   byte, (address of its block << 16) | offset within the block
+"""
+class BgzfWriter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.address = 0
+        self.buffer = bytearray()
+
+    def tell(self):
+        return (self.address << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while (len(self.buffer) >= BLOCK_DATA):
+            self.flushBlock(bytes(self.buffer[:BLOCK_DATA]))
+            del self.buffer[:BLOCK_DATA]
+
+    def flushBlock(self, data):
+        deflate = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+        body = deflate.compress(data) + deflate.flush()
+        block = BLOCK_HEADER + struct.pack('<H', len(body) + 25) + body + \
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+        self.fh.write(block)
+        self.address = self.address + len(block)
+
+    """Writes out the last block and the EOF marker
+    """
+    def flush(self):
+        if (len(self.buffer) > 0):
+            self.flushBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(EOF_BLOCK)
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+
+"""Smallest bin holding [beg, end), as (levels above the 16 kbp level,
+   index within that level); which bin number it is depends on the depth
+   of the index, known only once every record has been seen
+"""
+def binKey(beg, end):
+    end = end - 1
+    level = 0
+    while (beg >> (MIN_SHIFT + 3 * level)) != (end >> (MIN_SHIFT + 3 * level)):
+        level = level + 1
+    return level, beg >> (MIN_SHIFT + 3 * level)
+
+
+"""Bin number of a binKey in an index of depth levels below the root, as
+   hts_reg2bin numbers them
+"""
+def binNumber(key, depth):
+    level, index = key
+    if (level >= depth):
+        return 0
+    return ((1 << ((depth - level) * 3)) - 1) // 7 + index
+
+
+"""Chunks, linear index and counts of one chromosome
+"""
+class ReferenceIndex(object):
+    def __init__(self):
+        self.bins = {}
+        self.linear = []
+        self.first = None
+        self.last = None
+        self.records = 0
+
+    def add(self, beg, end, start, stop):
+        chunks = self.bins.setdefault(binKey(beg, end), [])
+        if (len(chunks) > 0) and (chunks[-1][1] == start):
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+
+        last = (end - 1) >> MIN_SHIFT
+        if (last >= len(self.linear)):
+            self.linear.extend([None] * (last + 1 - len(self.linear)))
+        for window in range(beg >> MIN_SHIFT, last + 1):
+            if self.linear[window] is None:
+                self.linear[window] = start
+
+        if self.first is None:
+            self.first = start
+        self.last = stop
+        self.records = self.records + 1
+
+    """Chunks of each bin of an index of depth levels, with the keys that
+       share the root merged
+    """
+    def binChunks(self, depth):
+        bins = {}
+        for key, chunks in self.bins.items():
+            bins.setdefault(binNumber(key, depth), []).extend(chunks)
+        merged = {}
+        for bin, chunks in bins.items():
+            merged[bin] = []
+            for start, stop in sorted(chunks):
+                if (len(merged[bin]) > 0) and (merged[bin][-1][1] >= start):
+                    merged[bin][-1][1] = max(merged[bin][-1][1], stop)
+                else:
+                    merged[bin].append([start, stop])
+        return sorted(merged.items())
+
+    """Linear index with empty windows given the offset of the next
+       window that has one
+    """
+    def offsets(self):
+        offsets = list(self.linear)
+        following = self.last or 0
+        for window in range(len(offsets) - 1, -1, -1):
+            if offsets[window] is None:
+                offsets[window] = following
+            following = offsets[window]
+        return offsets
+
+
+"""Tabix index of a VCF built one line at a time from the virtual
+   offsets its lines were written at; lines must be grouped by chromosome
+   and sorted by position, otherwise sorted is set to False and nothing
+   is indexed
+"""
+class TabixIndex(object):
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.current = None
+        self.last_beg = -1
+        self.max_end = 0
+        self.sorted = True
+
+    def add(self, line, start, stop):
+        if (not self.sorted) or line.startswith('#') or (line.strip() == ''):
+            return
+        fields = line.rstrip('\r\n').split('\t', 8)
+        try:
+            beg = int(fields[1]) - 1
+        except (IndexError, ValueError):
+            self.sorted = False
+            return
+        end = beg + len(fields[3]) if (len(fields) > 3) else beg + 1
+        if (len(fields) > 7):
+            end = max(end, infoEnd(fields[7], end))
+        end = max(end, beg + 1)
+
+        chrom = fields[0]
+        if (chrom != self.current):
+            if chrom in self.refs:
+                self.sorted = False
+                return
+            self.names.append(chrom)
+            self.refs[chrom] = ReferenceIndex()
+            self.current = chrom
+            self.last_beg = -1
+        if (beg < self.last_beg) or (beg < 0):
+            self.sorted = False
+            return
+        self.last_beg = beg
+        self.max_end = max(self.max_end, end)
+        self.refs[chrom].add(beg, end, start, stop)
+
+    """Writes the index to path + '.tbi', or path + '.csi' if a position
+       is beyond what a .tbi can hold; returns the index's path
+    """
+    def write(self, path):
+        ext, data = self.encode()
+        with open(path + ext + '.building', 'wb') as fh:
+            fh.write(data)
+        os.replace(path + ext + '.building', path + ext)
+        return path + ext
+
+    """The index as the extension it is written with ('.tbi' or '.csi')
+       and its BGZF-compressed bytes
+    """
+    def encode(self):
+        if (self.max_end <= TBI_MAX):
+            depth = TBI_DEPTH
+            ext = '.tbi'
+            data = [b'TBI\x01', struct.pack('<i', len(self.names)),
+                self.header()]
+        else:
+            depth = TBI_DEPTH
+            while (1 << (MIN_SHIFT + 3 * depth)) < self.max_end:
+                depth = depth + 1
+            ext = '.csi'
+            header = self.header()
+            data = [b'CSI\x01', struct.pack('<iii', MIN_SHIFT, depth,
+                len(header)), header, struct.pack('<i', len(self.names))]
+
+        for name in self.names:
+            data.append(self.reference(self.refs[name], depth,
+                ext == '.csi'))
+        data.append(struct.pack('<Q', 0))
+
+        compressed = io.BytesIO()
+        writer = BgzfWriter(compressed)
+        writer.write(b''.join(data))
+        writer.flush()
+        return ext, compressed.getvalue()
+
+    def header(self):
+        names = b''.join([n.encode('utf-8') + b'\x00' for n in self.names])
+        return struct.pack('<iiiiiii', *(TABIX_VCF + (len(names),))) + names
+
+    def reference(self, ref, depth, csi):
+        offsets = ref.offsets()
+        bins = ref.binChunks(depth)
+        pseudo = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        data = [struct.pack('<i', len(bins) + 1)]
+        for bin, chunks in bins:
+            data.append(struct.pack('<I', bin))
+            if csi:
+                data.append(struct.pack('<Q', self.binOffset(bin, depth,
+                    offsets)))
+            data.append(struct.pack('<i', len(chunks)))
+            data.extend([struct.pack('<QQ', s, e) for s, e in chunks])
+        data.append(struct.pack('<I', pseudo))
+        if csi:
+            data.append(struct.pack('<Q', 0))
+        data.append(struct.pack('<iQQQQ', 2, ref.first, ref.last,
+            ref.records, 0))
+        if not csi:
+            data.append(struct.pack('<i', len(offsets)))
+            data.extend([struct.pack('<Q', o) for o in offsets])
+        return b''.join(data)
+
+    """Smallest virtual offset a record in bin can start at, from the
+       linear window holding the bin's first position
+    """
+    def binOffset(self, bin, depth, offsets):
+        level = 0
+        first = 0
+        while (bin >= first + (1 << (level * 3))):
+            first = first + (1 << (level * 3))
+            level = level + 1
+        window = ((bin - first) << (MIN_SHIFT + 3 * (depth - level))) >> \
+            MIN_SHIFT
+        return offsets[window] if (window < len(offsets)) else 0
+
+
+"""END= of a VCF INFO field, or default
+"""
+def infoEnd(info, default):
+    for entry in info.split(';'):
+        if entry.startswith('END='):
+            try:
+                return int(entry[4:])
+            except ValueError:
+                return default
+    return default
+
+
+"""Text file writing VCF lines as BGZF, indexed as they are written;
+   close() writes the index next to path (unless the lines were not
+   sorted). Given fh, a binary file such as an upload stream, the lines
+   are written to it instead, and the index is left in self.index for
+   the caller.
+"""
+class BgzfVcfWriter(object):
+    def __init__(self, path, index=True, fh=None):
+        self.path = path
+        self.writer = BgzfWriter(fh if fh is not None else open(path, 'wb'))
+        self.index = TabixIndex() if index else None
+        self.pending = ''
+
+    def write(self, text):
+        lines = (self.pending + text).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.writeLine(line + '\n')
+
+    def writeLine(self, line):
+        start = self.writer.tell()
+        self.writer.write(line.encode('utf-8'))
+        if self.index is not None:
+            self.index.add(line, start, self.writer.tell())
+
+    def close(self):
+        if (self.pending != ''):
+            self.writeLine(self.pending)
+            self.pending = ''
+        self.writer.close()
+        if self.path is None:
+            return
+        for ext in ['.tbi', '.csi']:
+            if os.path.exists(self.path + ext):
+                os.remove(self.path + ext)
+        if self.index is None:
+            return
+        if self.index.sorted:
+            self.index.write(self.path)
+        else:
+            print(f"{self.path} is not sorted by position; not indexing it")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Writes the text file src to path as indexed BGZF
+"""
+def compressFile(src, path):
+    with openText(src) as fh, BgzfVcfWriter(path) as fh_out:
+        for line in fh:
+            fh_out.write(line)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        compressFile(sys.argv[1], sys.argv[2])
+        print(f"{sys.argv[2]} written")
+    else:
+        print("Usage: python bgzf.py <vcf> <output.vcf.gz>")
+
+### EOF
@@ -0,0 +1,110 @@
+# consequence.py
+#
+# Classifies variant positions against refGene transcripts with array
+# operations: the region of the transcript each position falls in and
+# the exons that hold it (requires numpy)
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from collections import namedtuple
+
+import numpy as np
+
+from transcripts import STRAND, TX_START, TX_END, CDS_START, CDS_END, \
+    EXON_COUNT, parseExons
+
+"""Region labels; a position is given the first that applies, in the
+   order getExonsEtAl tests for them
+"""
+OTHER = 0
+NON_CODING_EXON = 1
+NON_CODING_INTRON = 2
+CDS_EXON = 3
+CDS_INTRON = 4
+UTR5 = 5
+UTR3 = 6
+PROMOTER = 7
+
+"""Columns of a list of transcripts, one entry each; strand is 1 for
+   '+', -1 for '-' and 0 otherwise. The exons of transcript t are
+   [exon_offsets[t], exon_offsets[t + 1]) of exon_starts, exon_ends and
+   exon_order, sorted by start, with exon_order their 0-based number in
+   refGene order.
+"""
+TranscriptArrays = namedtuple('TranscriptArrays', ['tx_start', 'tx_end',
+    'cds_start', 'cds_end', 'strand', 'exon_count', 'exon_offsets',
+    'exon_starts', 'exon_ends', 'exon_order'])
+
+
+"""TranscriptArrays of refGene rows, using the exons parsed by
+   transcripts.transcript where the rows carry them
+"""
+def transcriptArrays(rows):
+    exons = [getattr(row, 'exons', None) or parseExons(row) for row in rows]
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(e.starts) for e in exons], out=offsets[1:])
+
+    def column(index):
+        return np.array([int(row[index]) for row in rows], dtype=np.int64)
+
+    def exonColumn(name):
+        return np.array([x for e in exons for x in getattr(e, name)],
+            dtype=np.int64)
+
+    return TranscriptArrays(column(TX_START), column(TX_END),
+        column(CDS_START), column(CDS_END),
+        np.array([{'+': 1, '-': -1}.get(str(row[STRAND]), 0) for row in rows],
+            dtype=np.int8),
+        column(EXON_COUNT), offsets, exonColumn('starts'),
+        exonColumn('ends'), exonColumn('order'))
+
+
+def between(pos, start, end):
+    return (start <= pos) & (pos <= end)
+
+
+"""Classifies pos[k] against transcript k of tx; returns the region
+   label of each, and the exon numbers holding each position, counted
+   from the transcript's 5' end as transcripts.exonNumbers does: those of
+   k are numbers[offsets[k]:offsets[k + 1]]. With utr=False the UTRs are
+   not labelled, so positions in them can still be PROMOTER, as in
+   getGenes.
+"""
+def classify(pos, tx, promoter_offset=500, utr=True):
+    pos = np.asarray(pos, dtype=np.int64)
+    size = len(pos)
+    pair = np.repeat(np.arange(size), np.diff(tx.exon_offsets))
+    hit = np.flatnonzero(between(pos[pair], tx.exon_starts, tx.exon_ends))
+    hit = hit[np.lexsort((tx.exon_order[hit], pair[hit]))]
+    in_exon = np.bincount(pair[hit], minlength=size) > 0
+
+    plus = tx.strand == 1
+    minus = tx.strand == -1
+    noncoding = tx.cds_start == tx.cds_end
+    coding = tx.cds_start < tx.cds_end
+    in_cds = between(pos, tx.cds_start, tx.cds_end)
+    conditions = [noncoding & in_exon, noncoding, in_cds & in_exon, in_cds]
+    labels = [NON_CODING_EXON, NON_CODING_INTRON, CDS_EXON, CDS_INTRON]
+    if utr:
+        five = between(pos, tx.tx_start, tx.cds_start)
+        three = between(pos, tx.cds_end, tx.tx_end)
+        conditions.extend([coding & plus & five, coding & plus & three,
+            coding & minus & three, coding & minus & five])
+        labels.extend([UTR5, UTR3, UTR5, UTR3])
+    conditions.append((plus & between(pos, tx.tx_start - promoter_offset,
+        tx.tx_start)) | (minus & between(pos, tx.tx_end,
+        tx.tx_end + promoter_offset)))
+    labels.append(PROMOTER)
+
+    numbers = np.where(tx.strand[pair[hit]] == -1,
+        tx.exon_count[pair[hit]] - tx.exon_order[hit], tx.exon_order[hit] + 1)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pair[hit], minlength=size), out=offsets[1:])
+    return np.select(conditions, labels, default=OTHER).astype(np.int8), \
+        offsets, numbers
+
+### EOF
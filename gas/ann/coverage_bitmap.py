@@ -0,0 +1,197 @@
+# coverage_bitmap.py
+#
+# Per-chromosome coverage bitmaps of the interval reference tables, so
+# overlap lookups in regions a table does not touch are never sent to the
+# database
+#
+# Usage: python coverage_bitmap.py <filter_dir>
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import mmap
+import time
+
+from lookup import REFERENCE_TABLES
+from interval_index import chromKey
+
+"""Layout, next to the position filters:
+   <filter_dir>/<table>.cov        bitmaps of every chromosome, one after
+                                   another; bit b of a chromosome is set if
+                                   an interval touches bin b, i.e.
+                                   [b * BIN_SIZE, (b + 1) * BIN_SIZE)
+   <filter_dir>/<table>.cov.json   columns, bin size and, per chromosome,
+                                   the byte offset and number of bins
+"""
+COVERAGE_EXT = '.cov'
+BIN_SIZE = 256
+
+"""Tables looked up by overlap: table -> (chrom_col, start_col, end_col)
+"""
+INTERVAL_TABLES = dict([(t, c) for t, c in REFERENCE_TABLES.items()
+    if (c[1] != c[2])])
+
+FETCH_ROWS = 100000
+
+"""Bitmaps already mapped by this process, keyed by path
+"""
+_bitmaps = {}
+
+
+"""Bit array with the bins [start >> shift, end >> shift] of every
+   interval set; negative bounds fall into bin 0
+"""
+def binBitmap(starts, ends, shift):
+    import numpy as np
+    first = np.maximum(starts, 0) >> shift
+    last = np.maximum(np.maximum(ends, starts), 0) >> shift
+    bins = int(last.max()) + 1 if (len(last) > 0) else 0
+    edges = np.zeros(bins + 1, dtype=np.int64)
+    np.add.at(edges, first, 1)
+    np.add.at(edges, last + 1, -1)
+    return np.packbits(np.cumsum(edges[:bins]) > 0, bitorder='little'), bins
+
+
+"""Builds the coverage bitmaps of one table from the reference database
+"""
+def buildCoverage(conn, directory, table, chrom_col, start_col, end_col,
+    bin_size=BIN_SIZE):
+
+    import numpy as np
+    import pymysql.cursors
+
+    shift = bin_size.bit_length() - 1
+    if (1 << shift) != bin_size:
+        raise ValueError(f"Bin size must be a power of two, not {bin_size}")
+
+    stream = conn.cursor(pymysql.cursors.SSCursor)
+    stream.execute('select ' + (chrom_col or "''") + ', ' + start_col +
+        ', ' + end_col + ' from ' + table + ' where ' + start_col +
+        ' is not null and ' + end_col + ' is not null;')
+    bounds = {}
+    while True:
+        chunk = stream.fetchmany(FETCH_ROWS)
+        if (len(chunk) == 0):
+            break
+        for chrom, start, end in chunk:
+            if chrom is None:
+                continue
+            starts, ends = bounds.setdefault(chromKey(chrom), ([], []))
+            starts.append(int(start))
+            ends.append(int(end))
+    stream.close()
+
+    path = os.path.join(directory, table + COVERAGE_EXT)
+    info = {'table': table, 'chrom_col': chrom_col, 'start_col': start_col,
+        'end_col': end_col, 'bin_size': bin_size, 'chroms': {},
+        'created': int(time.time())}
+    offset = 0
+    with open(path + '.building', 'wb') as fh:
+        for key, (starts, ends) in sorted(bounds.items()):
+            bits, bins = binBitmap(np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64), shift)
+            fh.write(bits.tobytes())
+            info['chroms'][key] = {'offset': offset, 'bins': bins}
+            offset = offset + len(bits)
+    os.replace(path + '.building', path)
+    with open(path + '.json', 'w') as fh:
+        json.dump(info, fh, indent=1)
+    return path
+
+
+"""Builds the bitmaps of every interval table into directory; rebuild
+   them whenever the reference tables are reloaded
+"""
+def buildBitmaps(directory, tables=INTERVAL_TABLES, bin_size=BIN_SIZE,
+    conn=None):
+
+    import utils as u
+    import file_utils as fu
+
+    fu.mkdirp(directory)
+    close = conn is None
+    if conn is None:
+        conn = u.db_connect()
+    for table, (chrom_col, start_col, end_col) in tables.items():
+        print(f"Building coverage bitmap for {table} . . .")
+        buildCoverage(conn, directory, table, chrom_col, start_col, end_col,
+            bin_size=bin_size)
+    if close:
+        conn.close()
+
+
+"""Memory-mapped bitmaps of one table; pages are shared by every process
+   that maps the same file
+"""
+class CoverageBitmap(object):
+    def __init__(self, path):
+        with open(path + '.json') as fh:
+            self.info = json.load(fh)
+        self.chroms = self.info['chroms']
+        self.shift = self.info['bin_size'].bit_length() - 1
+        self.columns = [(c or '').lower() for c in [self.info['chrom_col'],
+            self.info['start_col'], self.info['end_col']]]
+        self.array = None
+        if (os.path.getsize(path) > 0):
+            with open(path, 'rb') as fh:
+                self.array = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    """False if no interval on chrom touches [lo, hi]; True if one may
+    """
+    def touches(self, chrom, lo, hi):
+        entry = self.chroms.get(chromKey(chrom) if
+            (self.columns[0] != '') else '')
+        if entry is None:
+            return False
+        first = max(lo, 0) >> self.shift
+        last = min(max(hi, 0) >> self.shift, entry['bins'] - 1)
+        for b in range(first, last + 1):
+            if (self.array[entry['offset'] + (b >> 3)] >> (b & 7)) & 1:
+                return True
+        return False
+
+    """False if query can only return intervals the table does not have
+       in the bins it covers
+    """
+    def admits(self, query):
+        if ([(c or '').lower() for c in [query.chrom_col, query.start_col,
+            query.end_col]] != self.columns):
+            return True
+        try:
+            pos = int(str(query.pos).strip())
+            offset = int(query.offset)
+        except ValueError:
+            return True
+        if (offset < 0):
+            return True
+        return self.touches(query.chrom, pos - offset, pos + offset)
+
+
+"""Bitmaps found in directory: table -> CoverageBitmap
+"""
+def loadBitmaps(directory, tables=INTERVAL_TABLES):
+    bitmaps = {}
+    for table in tables:
+        path = os.path.join(directory, table + COVERAGE_EXT)
+        if not os.path.exists(path + '.json'):
+            continue
+        if path not in _bitmaps:
+            _bitmaps[path] = CoverageBitmap(path)
+        bitmaps[table] = _bitmaps[path]
+    return bitmaps
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        buildBitmaps(sys.argv[1])
+        print(f"Coverage bitmaps written to {sys.argv[1]}")
+    else:
+        print("Usage: python coverage_bitmap.py <filter_dir>")
+
+### EOF
@@ -0,0 +1,398 @@
+# dbsnp_index.py
+#
+# Compact position index over the dbSNP table of a reference snapshot
+#
+# Usage: python dbsnp_index.py <snapshot_root> [version]
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+
+import numpy as np
+
+import file_utils as fu
+import snapshot as snap
+from interval_index import IndexedLookup, chromKey, sqlEquals
+
+"""Columns of dbSNP read by annotate.getSnpsFromDbSnpLine besides the
+   CHR/POS/REF/INFO it matches on: row[3] is the rsID, row[7] the GMAF
+"""
+RSID_COLUMN = 3
+GMAF_COLUMN = 7
+
+"""Per chromosome, rows sorted by position (table order within a
+   position), one array per file:
+   pos.u4     uint32 position
+   ref.2b     REF base packed four per byte, A=0 C=1 G=2 T=3
+   class.u1   uint8 code of the INFO class (SNV, DIV, MNV, MIXED, ...)
+   rsid.u4    uint32 rsID number, written back as 'rs<number>'
+   gmaf.u2    uint16 code of the GMAF value, 65535 for NULL
+   fallback.u4  positions holding rows that do not fit this layout (REF
+                longer than one base, unusual rsIDs, ...); lookups there
+                are passed to the full snapshot table
+   GMAF is coded through a table of its distinct values rather than
+   stored as a float, so str(GMAF) is written exactly as dbSNP has it.
+"""
+INDEX_DIR = 'dbSNP.compact'
+BASES = 'ACGT'
+NULL_CODE = 65535
+MAX_WIDTH = 32
+BUILD_ROWS = 10000000
+
+
+def codeTable():
+    table = np.full(256, 255, dtype=np.uint8)
+    for code, base in enumerate(BASES):
+        table[ord(base)] = code
+    return table
+
+
+"""Strings of a blob column as a fixed-width bytes array; values longer
+   than MAX_WIDTH come back empty and flagged in the returned mask
+"""
+def fixedWidth(blob, offsets, rows):
+    starts = np.asarray(offsets[rows], dtype=np.int64)
+    lengths = np.asarray(offsets[rows + 1], dtype=np.int64) - starts
+    fits = lengths <= MAX_WIDTH
+    if (len(rows) == 0) or (len(blob) == 0):
+        return np.zeros(len(rows), dtype='S1'), fits
+    width = max(1, int(lengths[fits].max()) if fits.any() else 1)
+    cols = np.arange(width)
+    valid = (cols[None, :] < lengths[:, None]) & fits[:, None]
+    idx = np.minimum(starts[:, None] + cols[None, :], len(blob) - 1)
+    matrix = np.where(valid, blob[idx], 0).astype(np.uint8)
+    return np.ascontiguousarray(matrix).view('S%d' % width).ravel(), fits
+
+
+"""Distinct-value coding of one snapshot column for rows; returns codes,
+   a mask of rows that could be coded and the list of decoded values
+"""
+def dictionaryCodes(chrom, column, rows, values, limit):
+    kind, nulls, (data, offsets) = chrom.columns[column]
+    isnull = (np.asarray(nulls[rows]) != 0) if (len(nulls) > 0) else \
+        np.zeros(len(rows), dtype=bool)
+    if (kind == 'null'):
+        return np.full(len(rows), NULL_CODE), np.ones(len(rows), bool), values
+    if kind in snap.FIXED_KINDS:
+        raw, fits = np.asarray(data[rows]), np.ones(len(rows), dtype=bool)
+    else:
+        raw, fits = fixedWidth(data, offsets, rows)
+
+    distinct, inverse = np.unique(raw, return_inverse=True)
+    known = dict([(value, n) for n, value in enumerate(values)])
+    mapping = np.empty(len(distinct), dtype=np.int64)
+    for n, value in enumerate(distinct):
+        if kind in snap.FIXED_KINDS:
+            decoded = int(value) if (kind == 'int') else float(value)
+        else:
+            decoded = snap.decodeValue(np.frombuffer(bytes(value),
+                dtype=np.uint8), kind)
+        if decoded not in known:
+            known[decoded] = len(values)
+            values.append(decoded)
+        mapping[n] = known[decoded]
+    codes = mapping[inverse.ravel()]
+
+    codes[isnull] = NULL_CODE
+    ok = fits & ((codes < limit) | isnull)
+    return codes, ok, values
+
+
+"""rsIDs 'rs<number>' (or plain integers) as uint32 numbers
+"""
+def rsidNumbers(chrom, column, rows):
+    kind, nulls, (data, offsets) = chrom.columns[column]
+    ok = np.zeros(len(rows), dtype=bool)
+    if (len(nulls) > 0):
+        notnull = np.asarray(nulls[rows]) == 0
+    else:
+        notnull = np.ones(len(rows), dtype=bool)
+
+    if (kind == 'int'):
+        numbers = np.asarray(data[rows], dtype=np.int64)
+        ok = notnull & (numbers >= 0) & (numbers < 2 ** 32)
+        return numbers, ok
+
+    if kind not in ['str', 'bytes']:
+        return np.zeros(len(rows), dtype=np.int64), ok
+
+    raw, fits = fixedWidth(data, offsets, rows)
+    digits = np.char.replace(raw, b'rs', b'', count=1)
+    ok = notnull & fits & np.char.startswith(raw, b'rs') & \
+        np.char.isdigit(digits) & (np.char.str_len(digits) <= 10) & \
+        ((np.char.str_len(digits) == 1) | ~np.char.startswith(digits, b'0'))
+    numbers = np.zeros(len(rows), dtype=np.int64)
+    numbers[ok] = digits[ok].astype(np.int64)
+    ok = ok & (numbers < 2 ** 32)
+    return numbers, ok
+
+
+"""Builds the compact dbSNP index inside a snapshot version
+"""
+def buildIndex(root, version=None):
+    snapshot = snap.openSnapshot(root, version)
+    table = snapshot.get('dbSNP')
+    names = [c.lower() for c in table.info['columns']]
+    pos_col = names.index(table.start_col.lower())
+    ref_col = names.index('ref')
+    info_col = names.index('info')
+
+    directory = os.path.join(snapshot.path, INDEX_DIR)
+    manifest = {'version': snapshot.version, 'columns': table.info['columns'],
+        'kinds': {}, 'classes': [], 'gmafs': [], 'chroms': {}}
+    base_codes = codeTable()
+    classes = []
+    gmafs = []
+
+    for key, entry in table.info['chroms'].items():
+        chrom = table.chrom(key)
+        kinds = entry['kinds']
+        mergeKinds(manifest['kinds'], {'ref': kinds[ref_col],
+            'info': kinds[info_col], 'rsid': kinds[RSID_COLUMN],
+            'gmaf': kinds[GMAF_COLUMN],
+            'chrom': kinds[names.index(table.chrom_col.lower())]}, key)
+        chrom_dir = os.path.join(directory, entry['dir'])
+        fu.mkdirp(chrom_dir)
+
+        parts = dict([(name, []) for name in ['pos', 'ref', 'class', 'rsid',
+            'gmaf', 'fallback']])
+        for lo in range(0, entry['rows'], BUILD_ROWS):
+            rows = np.arange(lo, min(entry['rows'], lo + BUILD_ROWS))
+
+            pos_kind, pos_nulls, (pos_data, _) = chrom.columns[pos_col]
+            if (pos_kind != 'int'):
+                raise ValueError(f"dbSNP POS must be integer, not {pos_kind}")
+            pos = np.asarray(pos_data[rows], dtype=np.int64)
+            pos_ok = (pos >= 0) & (pos < 2 ** 32)
+            if (len(pos_nulls) > 0):
+                pos_ok = pos_ok & (np.asarray(pos_nulls[rows]) == 0)
+
+            ref_kind, ref_nulls, (ref_data, ref_offsets) = \
+                chrom.columns[ref_col]
+            ref = np.full(len(rows), 255, dtype=np.uint8)
+            if ref_kind in ['str', 'bytes']:
+                starts = np.asarray(ref_offsets[rows], dtype=np.int64)
+                single = (np.asarray(ref_offsets[rows + 1],
+                    dtype=np.int64) - starts) == 1
+                ref[single] = base_codes[np.asarray(ref_data)[
+                    starts[single]]]
+            ref_ok = ref < 4
+
+            cls, cls_ok, classes = dictionaryCodes(chrom, info_col, rows,
+                classes, 255)
+            cls_ok = cls_ok & (cls != NULL_CODE)
+            rsid, rsid_ok = rsidNumbers(chrom, RSID_COLUMN, rows)
+            gmaf, gmaf_ok, gmafs = dictionaryCodes(chrom, GMAF_COLUMN, rows,
+                gmafs, NULL_CODE)
+
+            coded = pos_ok & ref_ok & cls_ok & rsid_ok & gmaf_ok
+            parts['fallback'].append(pos[pos_ok & ~coded])
+            parts['pos'].append(pos[coded])
+            parts['ref'].append(ref[coded])
+            parts['class'].append(cls[coded])
+            parts['rsid'].append(rsid[coded])
+            parts['gmaf'].append(gmaf[coded])
+
+        arrays = dict([(name, np.concatenate(parts[name]) if parts[name]
+            else np.zeros(0, dtype=np.int64)) for name in parts])
+        order = np.argsort(arrays['pos'], kind='stable')
+        ref = arrays['ref'][order].astype(np.uint8)
+        packed = np.zeros((len(ref) + 3) // 4, dtype=np.uint8)
+        for shift in range(4):
+            packed[:len(ref[shift::4])] |= ref[shift::4] << (2 * shift)
+
+        arrays['pos'][order].astype('<u4').tofile(
+            os.path.join(chrom_dir, 'pos.u4'))
+        packed.tofile(os.path.join(chrom_dir, 'ref.2b'))
+        arrays['class'][order].astype(np.uint8).tofile(
+            os.path.join(chrom_dir, 'class.u1'))
+        arrays['rsid'][order].astype('<u4').tofile(
+            os.path.join(chrom_dir, 'rsid.u4'))
+        arrays['gmaf'][order].astype('<u2').tofile(
+            os.path.join(chrom_dir, 'gmaf.u2'))
+        np.unique(arrays['fallback']).astype('<u4').tofile(
+            os.path.join(chrom_dir, 'fallback.u4'))
+
+        manifest['chroms'][key] = {'dir': entry['dir'],
+            'rows': int(len(order)),
+            'chrom': chrom.value(names.index(table.chrom_col.lower()), 0)
+                if (entry['rows'] > 0) else key}
+
+    manifest['classes'] = [jsonValue(v) for v in classes]
+    manifest['gmafs'] = [jsonValue(v) for v in gmafs]
+    for key, entry in manifest['chroms'].items():
+        entry['chrom'] = jsonValue(entry['chrom'])
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    return directory
+
+
+"""Adds the column kinds of one chromosome to those of the index: a
+   snapshot gives a column that is all NULL on a chromosome the kind
+   'null', so the kind is that of the chromosomes with values, and the
+   index can only be built if they all agree
+"""
+def mergeKinds(merged, kinds, key):
+    for name, kind in kinds.items():
+        if merged.get(name, 'null') == 'null':
+            merged[name] = kind
+        elif (kind != 'null') and (kind != merged[name]):
+            raise ValueError(f"dbSNP column {name} is {merged[name]} on " + \
+                f"some chromosomes but {kind} on {key}")
+
+
+def jsonValue(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('latin-1')
+    return str(value) if not isinstance(value, (int, float)) else value
+
+
+def pythonValue(value, kind):
+    if (value is None) or (kind in ['int', 'float', 'null']):
+        return value
+    if (kind == 'bytes'):
+        return value.encode('latin-1')
+    return snap.decodeValue(np.frombuffer(value.encode('utf-8'),
+        dtype=np.uint8), kind)
+
+
+"""One chromosome of the compact index, memory-mapped
+"""
+class CompactChrom(object):
+    def __init__(self, directory):
+        self.pos = snap.mapArray(os.path.join(directory, 'pos.u4'), '<u4')
+        self.ref = snap.mapArray(os.path.join(directory, 'ref.2b'), np.uint8)
+        self.cls = snap.mapArray(os.path.join(directory, 'class.u1'),
+            np.uint8)
+        self.rsid = snap.mapArray(os.path.join(directory, 'rsid.u4'), '<u4')
+        self.gmaf = snap.mapArray(os.path.join(directory, 'gmaf.u2'), '<u2')
+        self.fallback = snap.mapArray(os.path.join(directory,
+            'fallback.u4'), '<u4')
+
+    def refCode(self, i):
+        return (int(self.ref[i >> 2]) >> (2 * (i & 3))) & 3
+
+    def hasFallback(self, pos):
+        i = int(np.searchsorted(self.fallback, pos, side='left'))
+        return (i < len(self.fallback)) and (int(self.fallback[i]) == pos)
+
+    def span(self, pos):
+        return (int(np.searchsorted(self.pos, pos, side='left')),
+            int(np.searchsorted(self.pos, pos, side='right')))
+
+
+"""Answers the dbSNP lookup of getSnpsFromDbSnpLine in O(log n). Rows
+   carry CHR, POS, REF, INFO, the rsID and GMAF and None for the columns
+   the stage does not read. Returns None (so the next lookup answers)
+   for any other shape of query and at fallback positions.
+"""
+class CompactDbSnp(object):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as fh:
+            self.manifest = json.load(fh)
+        self.version = self.manifest['version']
+        self.columns = self.manifest['columns']
+        self.names = [c.lower() for c in self.columns]
+        kinds = self.manifest['kinds']
+        self.kinds = kinds
+        self.classes = [pythonValue(v, kinds['info'])
+            for v in self.manifest['classes']]
+        self.gmafs = [pythonValue(v, kinds['gmaf'])
+            for v in self.manifest['gmafs']]
+        self.bases = [pythonValue(b, kinds['ref']) for b in BASES]
+        self.chroms = {}
+
+    def chrom(self, key):
+        if key not in self.chroms:
+            entry = self.manifest['chroms'].get(key)
+            self.chroms[key] = None if (entry is None) else \
+                CompactChrom(os.path.join(self.directory, entry['dir']))
+        return self.chroms[key]
+
+    def wanted(self, match):
+        wanted = set([])
+        for alternative in match:
+            values = dict([(col.lower(), value) for col, value in alternative])
+            if (set(values.keys()) != set(['ref', 'info'])):
+                return None
+            bases = [code for code, base in enumerate(self.bases)
+                if sqlEquals(base, values['ref'])]
+            classes = [code for code, cls in enumerate(self.classes)
+                if sqlEquals(cls, values['info'])]
+            wanted.update([(b, c) for b in bases for c in classes])
+        return wanted
+
+    def rsid(self, number):
+        kind = self.kinds['rsid']
+        if (kind == 'int'):
+            return number
+        value = 'rs' + str(number)
+        return value.encode('latin-1') if (kind == 'bytes') else value
+
+    def row(self, chrom, key, i):
+        row = [None] * len(self.columns)
+        row[self.names.index('chr')] = pythonValue(
+            self.manifest['chroms'][key]['chrom'], self.kinds['chrom'])
+        row[self.names.index('pos')] = int(chrom.pos[i])
+        row[self.names.index('ref')] = self.bases[chrom.refCode(i)]
+        row[self.names.index('info')] = self.classes[int(chrom.cls[i])]
+        row[RSID_COLUMN] = self.rsid(int(chrom.rsid[i]))
+        gmaf = int(chrom.gmaf[i])
+        row[GMAF_COLUMN] = None if (gmaf == NULL_CODE) else self.gmafs[gmaf]
+        return tuple(row)
+
+    def fetchall(self, query):
+        if (query.table != 'dbSNP') or (query.columns != '*') or \
+            (query.start_col != query.end_col) or \
+            (query.start_col.lower() != 'pos') or \
+            (query.chrom_col.lower() != 'chr'):
+            return None
+        try:
+            pos = int(str(query.pos).strip())
+        except ValueError:
+            return None
+        wanted = self.wanted(query.match)
+        if (wanted is None) or (pos < 0) or (pos >= 2 ** 32):
+            return None
+
+        key = chromKey(query.chrom)
+        chrom = self.chrom(key)
+        if chrom is None:
+            return []
+        if chrom.hasFallback(pos):
+            return None
+
+        lo, hi = chrom.span(pos)
+        return [self.row(chrom, key, i) for i in range(lo, hi)
+            if (chrom.refCode(i), int(chrom.cls[i])) in wanted]
+
+
+def hasIndex(root, version=None):
+    version = version or snap.currentVersion(root)
+    return fu.isExist(os.path.join(root, version, INDEX_DIR, 'manifest.json'))
+
+
+"""Puts the compact dbSNP index in front of inner
+"""
+def compactLookup(root, inner, version=None):
+    version = version or snap.currentVersion(root)
+    return IndexedLookup(inner, {'dbSNP': CompactDbSnp(
+        os.path.join(root, version, INDEX_DIR))})
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        print(f"Index written to " + \
+            buildIndex(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
+    else:
+        print("Usage: python dbsnp_index.py <snapshot_root> [version]")
+
+### EOF
@@ -12,110 +12,683 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import shutil
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from functools import partial
+import bgzf
 import file_utils as fu
 import annotate as ann
+import utils as u
+import transcripts
+from lookup import newLookup, BATCH_SIZE
 
-def run(infile, format):
+"""Size of a shard when sharding by byte ranges
+"""
+SHARD_BYTES = 64 * 1024 * 1024
 
+"""Annotation stages in the order they are applied to each variant; only
+   refGene (getGenes) reads what an earlier stage wrote, the positionType
+   and name that BigRefGene adds to INFO
+"""
+PIPELINE = [
+    ann.Stage('dbSNP', ann.getSnpsFromDbSnpLine, ann.getSnpsFromDbSnpLog, 
+        {'format': 'vcf'}),
+    ann.Stage('BigRefGene', ann.getBigRefGeneLine, ann.writeNoLog, 
+        {'format': 'vcf'}),
+    ann.Stage('refGene', ann.getGenesLine, ann.getGenesLog, 
+        {'format': 'vcf', 'table': 'refGene', 'promoter_offset': 500},
+        after=('BigRefGene',)),
+    ann.Stage('Cytoband', ann.addOverlapLine, ann.addOverlapLog, 
+        {'format': 'vcf', 'table': 'cytoBand'}),
+    ann.Stage('gadAll', ann.addOverlapLine, ann.addOverlapLog, 
+        {'format': 'vcf', 'table': 'gadAll'}),
+    ann.Stage('GwasCatalog', ann.addOverlapLine, ann.addOverlapLog, 
+        {'format': 'vcf', 'table': 'gwasCatalog'}),
+    ann.Stage('miRNA', ann.addOverlapLine, ann.addOverlapWithMiRNALog, 
+        {'format': 'vcf', 'table': 'targetScanS'}),
+    ann.Stage('HUGO Gene Nomenclature Committee', ann.addOverlapLine, 
+        ann.addOverlapLog, {'format': 'vcf', 'table': 'hugo'}),
+    ann.Stage('dgv_Cnv', ann.addOverlapLine, ann.addOverlapLog, 
+        {'format': 'vcf', 'table': 'dgv_Cnv'}),
+    ann.Stage('abParts_IG_T_CelReceptors', ann.addOverlapLine, 
+        ann.addOverlapLog, {'format': 'vcf', 
+        'table': 'abParts_IG_T_CelReceptors'}),
+    ann.Stage('mcCarroll_Cnv', ann.addOverlapLine, ann.addOverlapLog, 
+        {'format': 'vcf', 'table': 'mcCarroll_Cnv'}),
+    ann.Stage('conrad_Cnv', ann.addOverlapLine, ann.addOverlapLog, 
+        {'format': 'vcf', 'table': 'conrad_Cnv'}),
+    ann.Stage('genomicSuperDups', ann.addOverlapLine, ann.addOverlapLog, 
+        {'format': 'vcf', 'table': 'genomicSuperDups'}),
+    ann.Stage('addOverlapWithTfbsConsSites', ann.addOverlapLine, 
+        ann.addOverlapLog, {'format': 'vcf', 'table': 'tfbsConsSites'}),
+]
+
+
+"""Settings of an annotation job, taken as one mapping by run,
+   annotateJob and s3_stream.annotateObject; a job's mapping only needs
+   the settings it changes from these defaults (see jobOptions):
+   batch_size         variants looked up per reference query
+   indexed            overlap tables and refGene from in-memory indexes
+                      (requires numpy)
+   snapshot_dir       look up in the current snapshot there instead of
+                      the reference database
+   sweep              sweep-line lookups, for input sorted by position
+   filter_dir         skip lookups ruled out by the position filters there
+   plan_stats         table statistics a query planner chooses by
+   fused              every stage in one pass; False runs one pass and
+                      temp file per stage
+   workers            processes annotating shards of the input
+   shard_by           'chrom' or 'bytes'
+   shard_bytes        size of a shard when sharding by bytes
+   stage_workers      threads prefetching the stages' lookups
+   cache_path         variant cache shared across jobs
+   cache_bytes        size bound of the variant cache
+   reference_version  version the cache is keyed on without a snapshot
+   known_variants     known_variants artifact to copy annotations from
+   columnar           annotate chunks as vcf_batch batches (requires numpy)
+   compress           bgzip the output
+   sort_input         sort the input by position first, so the output
+                      can be indexed
+   preserve_order     put the output of a sorted input back in input order
+   sort_bytes         memory the sort may hold before it spills
+   spill_dir          where the sort spills (next to the output if None)
+"""
+OPTIONS = {
+    'batch_size': BATCH_SIZE, 'indexed': False, 'snapshot_dir': None,
+    'sweep': False, 'filter_dir': None, 'plan_stats': None, 'fused': True,
+    'workers': 1, 'shard_by': 'chrom', 'shard_bytes': SHARD_BYTES,
+    'stage_workers': 1, 'cache_path': None, 'cache_bytes': None,
+    'reference_version': None, 'known_variants': None, 'columnar': False,
+    'compress': False, 'sort_input': False, 'preserve_order': False,
+    'sort_bytes': None, 'spill_dir': None,
+}
+
+"""Options that set up a job's lookups (see jobLookup)
+"""
+LOOKUP_OPTIONS = ['batch_size', 'indexed', 'snapshot_dir', 'sweep',
+    'filter_dir', 'plan_stats']
+
+
+"""A job's options with the defaults of OPTIONS for those not given
+"""
+def jobOptions(options=None):
+    options = options or {}
+    unknown = sorted(set(options.keys()) - set(OPTIONS.keys()))
+    if (len(unknown) > 0):
+        raise ValueError(f"Unknown annotation options: {', '.join(unknown)}")
+    return dict(OPTIONS, **options)
+
+
+def lookupOptions(options):
+    return dict([(name, options[name]) for name in LOOKUP_OPTIONS])
+
+
+"""Annotates infile with the settings in options (see OPTIONS) into
+   annotFileName(infile, options['compress']) and its log into
+   infile + '.count.log'
+"""
+def run(infile, format, options=None):
+    options = jobOptions(options)
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    source = infile
+    compress = options['compress']
+    if options['sort_input']:
+        import external_sort
+        # Output to be put back in input order is annotated as plain text
+        final_compress = annotFileName(source, compress).endswith('.gz')
+        compress = final_compress and not options['preserve_order']
+        infile = sortedFileName(source)
+        external_sort.sortVcf(source, infile, 
+            max_bytes=options['sort_bytes'] or external_sort.SORT_BYTES, 
+            spill_dir=options['spill_dir'], 
+            order_file=(infile + '.order') if options['preserve_order'] 
+                else None)
+        print(f"Sorted {source} by position")
+    options['compress'] = compress
+
+    if options['sweep'] and not ann.isSorted(infile, format=format):
+        print("Input is not sorted by position; using indexed lookups")
+        options['sweep'] = False
+        options['indexed'] = True
+
+    if options['columnar'] and ((format != 'vcf') or not options['fused'] or 
+        ((options['stage_workers'] is not None) and 
+        (options['stage_workers'] > 1))):
+        print("Columnar batches are only used for VCF input annotated " + \
+            "in one pass without stage workers")
+        options['columnar'] = False
+
+    filtered = u.db_stats['lookups_filtered']
+    cache = cacheSettings(options, format)
+
+    if (options['workers'] is not None) and (options['workers'] > 1):
+        queries = runParallel(infile, format, options, cache=cache)
+    elif options['fused']:
+        counts, queries, cache_stats = annotateJob(infile, 
+            annotFileName(infile, compress), options, cache=cache)
+        writeLogs(infile + '.count.log', PIPELINE, counts, cache_stats)
+    else:
+        with jobLookup(**lookupOptions(options)) as db:
+            runStaged(infile, PIPELINE, db, 
+                batch_size=options['batch_size'], compress=compress)
+            queries = db.queries
+
+    if options['filter_dir'] is not None:
+        import position_filter
+        with open(infile + '.count.log', 'a') as fh_log:
+            position_filter.writeFilterLog(fh_log, 
+                u.db_stats['lookups_filtered'] - filtered)
+
+    if options['sort_input']:
+        finishSorted(source, infile, final_compress, 
+            options['preserve_order'], sort_bytes=options['sort_bytes'], 
+            spill_dir=options['spill_dir'])
+
+    print(f"Reference database queries: {queries}")
+    print(f"Reference database secret fetches: " + \
+        f"{u.db_stats['secret_fetches']}")
+
+
+"""Annotates infile into outfile with every stage of PIPELINE, running
+   independent stages concurrently if options['stage_workers'] > 1 and
+   copying known and cached variants from the stores described by cache
+   (see cacheSettings); with options['columnar'] the stages run over
+   vcf_batch batches (requires numpy). Returns the stage counters, the
+   number of reference queries and the cache counters (None without a
+   cache).
+"""
+def annotateJob(infile, outfile, options, cache=None):
+    options = jobOptions(options)
+    stage_workers = options['stage_workers']
+    variants = None
+    if cache is not None:
+        import variant_cache
+        stores = []
+        if cache['known'] is not None:
+            stores.append(variant_cache.VariantCache(cache['known'], 
+                cache['version'], readonly=True))
+        if cache['path'] is not None:
+            stores.append(variant_cache.VariantCache(cache['path'], 
+                cache['version'], max_bytes=cache['max_bytes']))
+        variants = variant_cache.CacheChain(stores)
+
+    try:
+        if (stage_workers is not None) and (stage_workers > 1):
+            with stageLookups(PIPELINE, stage_workers, 
+                **lookupOptions(options)) as lookups:
+                counts = annotateFileConcurrently(infile, outfile, PIPELINE, 
+                    lookups, batch_size=options['batch_size'], 
+                    workers=stage_workers, cache=variants)
+                queries = sum([db.queries for db in lookups])
+        else:
+            with jobLookup(**lookupOptions(options)) as db:
+                counts = annotateFile(infile, outfile, PIPELINE, db, 
+                    batch_size=options['batch_size'], cache=variants, 
+                    columnar=options['columnar'])
+                queries = db.queries
+    finally:
+        if variants is not None:
+            variants.close()
+
+    return counts, queries, (variants.stats if variants is not None 
+        else None)
+
+
+"""Settings of the variant cache and known_variants artifact of a job
+   with options, or None if neither is used: both are tied to the
+   snapshot version (or reference_version for database runs) and to the
+   stages and their settings
+"""
+def cacheSettings(options, format='vcf'):
+    options = jobOptions(options)
+    cache_path = options['cache_path']
+    snapshot_dir = options['snapshot_dir']
+    reference_version = options['reference_version']
+    known_variants = options['known_variants']
+
+    if (cache_path is None) and (known_variants is None):
+        return None
+    if (format != 'vcf'):
+        print("Variant cache is only used for VCF input")
+        return None
+
+    if snapshot_dir is not None:
+        import snapshot
+        reference_version = snapshot.currentVersion(snapshot_dir)
+    if reference_version is None:
+        print("No reference version to key the variant cache on; not using it")
+        return None
+
+    import variant_cache
+    version = str(reference_version) + ':' + pipelineSignature(PIPELINE)
+    if (known_variants is not None) and \
+        (variant_cache.storedVersion(known_variants) != version):
+        print(f"{known_variants} was not built for reference version " + \
+            f"{version}; not using it")
+        known_variants = None
+    if (cache_path is None) and (known_variants is None):
+        return None
+
+    return {'path': cache_path, 'known': known_variants, 'version': version,
+        'max_bytes': options['cache_bytes'] or variant_cache.MAX_BYTES}
+
+
+def pipelineSignature(stages):
+    return hashlib.sha1(repr([(stage.name, stage.annotateLine.__name__, 
+        sorted(stage.kwargs.items())) for stage in stages]).encode('utf-8')
+        ).hexdigest()[:12]
+
+
+"""Lookup for one job: from the snapshot if snapshot_dir is given,
+   otherwise from the reference database over one pooled connection
+   lent to every stage, behind the position filters in filter_dir
+"""
+@contextmanager
+def jobLookup(batch_size=BATCH_SIZE, indexed=False, snapshot_dir=None, 
+    sweep=False, filter_dir=None, plan_stats=None):
+
+    if snapshot_dir is not None:
+        import snapshot
+        import dbsnp_index
+        from interval_index import localLookup
+        version = snapshot.currentVersion(snapshot_dir)
+        db = localLookup(None, snapshot.openSnapshot(snapshot_dir, version),
+            sweep=sweep)
+        if dbsnp_index.hasIndex(snapshot_dir, version):
+            db = dbsnp_index.compactLookup(snapshot_dir, db, version)
+        db = localLookup(db, {'refGene': transcripts.snapshotTranscripts(
+            snapshot.openSnapshot(snapshot_dir, version))}, sweep=sweep)
+        yield db
+    else:
+        with u.lend_connection() as conn:
+            yield openLookup(conn, batch_size=batch_size, indexed=indexed, 
+                sweep=sweep, filter_dir=filter_dir, plan_stats=plan_stats)
+
+
+"""One lookup per stage, so stages can prefetch on separate threads; the
+   database lookups share up to lanes pooled connections, each guarded by
+   its own lock
+"""
+@contextmanager
+def stageLookups(stages, lanes, batch_size=BATCH_SIZE, indexed=False, 
+    snapshot_dir=None, sweep=False, filter_dir=None, plan_stats=None):
+
+    if snapshot_dir is not None:
+        with ExitStack() as stack:
+            yield [stack.enter_context(jobLookup(batch_size=batch_size, 
+                snapshot_dir=snapshot_dir, sweep=sweep)) for stage in stages]
+        return
+
+    lanes = max(1, min(lanes, u.db_pool.max_size, len(stages)))
+    conns = []
+    try:
+        for i in range(lanes):
+            conns.append(u.PooledConnection(u.db_pool, u.db_pool.acquire()))
+        locks = [threading.Lock() for conn in conns]
+        yield [openLookup(conns[i % lanes], batch_size=batch_size, 
+            indexed=indexed, sweep=sweep, lock=locks[i % lanes], 
+            filter_dir=filter_dir, plan_stats=plan_stats)
+            for i in range(len(stages))]
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+"""Lookup used by all stages of a job; indexed=True serves the overlap
+   tables from in-memory interval indexes and refGene from the transcript
+   cache (requires numpy); sweep=True does the same for input sorted by
+   position, merging the variants with the tables by sweep lines;
+   filter_dir skips lookups ruled out by position filters and coverage
+   bitmaps; plan_stats lets a query_planner choose how each chunk's
+   lookups are sent, from the table statistics in that file
+"""
+def openLookup(conn, batch_size=BATCH_SIZE, indexed=False, sweep=False,
+    lock=None, filter_dir=None, plan_stats=None):
+    if (plan_stats is not None) and (batch_size is not None) and \
+        (batch_size > 1):
+        import query_planner
+        db = query_planner.plannedLookup(conn.cursor(), plan_stats, lock=lock)
+    else:
+        db = newLookup(conn.cursor(), batch_size, lock=lock)
+    if indexed or sweep:
+        import interval_index
+        indexes = interval_index.loadIndexes(conn.cursor())
+        indexes['refGene'] = transcripts.loadTranscripts(conn.cursor())
+        db = interval_index.localLookup(db, indexes, sweep=sweep)
+    if filter_dir is not None:
+        import position_filter
+        db = position_filter.filteredLookup(db, filter_dir)
+    return db
+
+
+"""Name of the plain text copy of infile sorted by position, e.g.
+   foo.vcf(.gz) -> foo.sorted.vcf
+"""
+def sortedFileName(infile):
+    for ext in bgzf.GZIP_EXTS:
+        if infile.endswith(ext):
+            infile = infile[:-len(ext)]
+    if infile.endswith('.vcf'):
+        return infile[:-len('.vcf')] + '.sorted.vcf'
+    return infile + '.sorted'
+
+
+"""Gives the output and log annotated from sorted_file, the sorted copy
+   of source, the names annotating source would have given them; with
+   preserve_order, the output is first put back in the input order
+"""
+def finishSorted(source, sorted_file, compress, preserve_order, 
+    sort_bytes=None, spill_dir=None):
+
+    import external_sort
+    annot_file = annotFileName(source, compress)
+    annot_sorted = annotFileName(sorted_file, compress and not preserve_order)
+    order_file = sorted_file + '.order'
+    restored = preserve_order and external_sort.restoreOrder(annot_sorted, 
+        order_file, annot_file, 
+        max_bytes=sort_bytes or external_sort.SORT_BYTES, spill_dir=spill_dir)
+
+    if restored:
+        os.remove(annot_sorted)
+    elif preserve_order and compress:
+        bgzf.compressFile(annot_sorted, annot_file)
+        os.remove(annot_sorted)
+    else:
+        os.replace(annot_sorted, annot_file)
+        index = bgzf.indexPath(annot_sorted)
+        if index is not None:
+            os.replace(index, annot_file + index[len(annot_sorted):])
+    os.replace(sorted_file + '.count.log', source + '.count.log')
+    os.remove(sorted_file)
+    if preserve_order:
+        os.remove(order_file)
+
+
+"""Name of the annotated output, e.g. foo.vcf -> foo.annot.vcf; with
+   compress=True, or for compressed input, foo.vcf(.gz) ->
+   foo.annot.vcf.gz
+"""
+def annotFileName(infile, compress=False):
+    for ext in bgzf.GZIP_EXTS:
+        if infile.endswith(ext):
+            infile = infile[:-len(ext)]
+            compress = True
+    name = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    return (name + '.gz') if compress else name
+
+
+"""Runs each stage over the whole file, writing one temp file per stage;
+   a compressed output is written from the last temp file
+"""
+def runStaged(infile, stages, db, batch_size=BATCH_SIZE, compress=False):
+    logfile = infile + '.count.log'
+
+    ann.runStage(infile, infile + '.1', logfile, stages[0], logmode='w', 
+        batch_size=batch_size, db=db)
+    print(f"{stages[0].name} - done.")
+
+    for i in range(1, len(stages)):
+        ann.runStage(infile + '.' + str(i), infile + '.' + str(i + 1), 
+            logfile, stages[i], batch_size=batch_size, db=db)
+        print(f"{stages[i].name} - done.")
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(stages)):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    outfile = annotFileName(infile, compress)
+    if outfile.endswith('.gz'):
+        bgzf.compressFile(infile + '.' + str(len(stages)), outfile)
+        fu.delete(infile + '.' + str(len(stages)))
+    else:
+        os.rename(infile + '.' + str(len(stages)), outfile)
+
+
+"""Annotates infile into outfile with every stage; returns the counters
+   of each stage. With a variant_cache.VariantCache, cached variants are
+   copied from it and only the others go through the stages. With
+   columnar=True each chunk is annotated as a vcf_batch.VariantBatch.
+"""
+def annotateFile(infile, outfile, stages, db, batch_size=BATCH_SIZE, 
+    cache=None, columnar=False):
+
+    annotate = annotateLines
+    if columnar:
+        import vcf_batch
+        annotate = vcf_batch.annotateBatch
+    return annotateChunks(infile, outfile, stages, partial(annotate, 
+        stages=stages, db=db), batch_size=batch_size, cache=cache)
+
+
+"""Annotates infile like annotateFile, with the stages run as a DAG:
+   for each chunk, a stage's lookups are prefetched on a worker thread
+   as soon as the stages it runs after have been applied, while the
+   annotations are applied to the lines in pipeline order, so INFO is
+   built up exactly as by annotateFile
+"""
+def annotateFileConcurrently(infile, outfile, stages, lookups, 
+    batch_size=BATCH_SIZE, workers=4, cache=None):
+
+    names = [stage.name for stage in stages]
+    for i, stage in enumerate(stages):
+        for name in stage.after:
+            if name not in names[:i]:
+                raise ValueError(f"Stage {stage.name} runs after {name}, " + \
+                    f"which must come before it in the pipeline")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return annotateChunks(infile, outfile, stages, partial(
+            annotateLinesConcurrently, stages=stages, lookups=lookups, 
+            executor=executor), batch_size=batch_size, cache=cache)
+
+
+"""Reads infile a chunk at a time, annotates each chunk with annotate
+   (lines -> what each line became and its counters per stage) and
+   writes the result to outfile; returns the summed counters of each
+   stage. infile and outfile are paths or open text files (e.g. streams
+   from and to S3), closed when done.
+"""
+def annotateChunks(infile, outfile, stages, annotate, batch_size=BATCH_SIZE,
+    cache=None):
+
+    counts = [Counter() for stage in stages]
+
+    fh = bgzf.openText(infile) if isinstance(infile, str) else infile
+    fh_out = bgzf.openOutput(outfile) if isinstance(outfile, str) else outfile
+
+    for lines in fu.readChunks(fh, batch_size):
+        if cache is None:
+            groups, line_counts = annotate(lines)
+        else:
+            groups, line_counts = annotateCached(lines, annotate, cache)
+
+        for stage_counts in line_counts:
+            for total, line_stage_counts in zip(counts, stage_counts):
+                total.update(line_stage_counts)
+        fh_out.write(''.join([l + '\n' for group in groups for l in group]))
+
+    fh.close()
+    fh_out.close()
+    return counts
+
+
+def annotateCached(lines, annotate, cache):
+    found = cache.fetch(lines)
+    misses = [line for line, hit in zip(lines, found) if hit is None]
+    groups, counts = annotate(misses) if (len(misses) > 0) else ([], [])
+    cache.store(misses, groups, counts)
+
+    annotated = iter(zip(groups, counts))
+    found = [hit if hit is not None else next(annotated) for hit in found]
+    return [group for group, c in found], [c for group, c in found]
+
+
+"""Runs every stage over a chunk of lines; returns the lines each input
+   line became and its counters for each stage
+"""
+def annotateLines(lines, stages, db):
+    groups = [[line] for line in lines]
+    counts = [[Counter() for stage in stages] for line in lines]
+
+    for i, stage in enumerate(stages):
+        db.prefetch(stage, [line for group in groups for line in group])
+        groups = annotateGroups(groups, stage, db, [c[i] for c in counts])
+        db.release()
+
+    return groups, counts
+
+
+def annotateLinesConcurrently(lines, stages, lookups, executor):
+    groups = [[line] for line in lines]
+    counts = [[Counter() for stage in stages] for line in lines]
+
+    applied = set([])
+    prefetches = {}
+    for i, stage in enumerate(stages):
+        if (len(stage.after) == 0):
+            prefetches[i] = executor.submit(lookups[i].prefetch, stage, lines)
+
+    for i, stage in enumerate(stages):
+        prefetches[i].result()
+        groups = annotateGroups(groups, stage, lookups[i], 
+            [c[i] for c in counts])
+        lookups[i].release()
+        applied.add(stage.name)
+
+        for j in range(i + 1, len(stages)):
+            if (j not in prefetches) and \
+                all([name in applied for name in stages[j].after]):
+                prefetches[j] = executor.submit(lookups[j].prefetch, 
+                    stages[j], [line for group in groups for line in group])
+
+    return groups, counts
+
+
+"""Applies one stage to the lines of each group, splitting any line the
+   stage gave an embedded newline
+"""
+def annotateGroups(groups, stage, db, counts):
+    return [splitAnnotatedLines([stage.annotateLine(line, db, line_counts, 
+        **stage.kwargs) for line in group]) 
+        for group, line_counts in zip(groups, counts)]
+
+
+"""Writes the log of each stage to logfile, a path or an open text file
+"""
+def writeLogs(logfile, stages, counts, cache_stats=None):
+    fh_log = open(logfile, 'w') if isinstance(logfile, str) else logfile
+    for stage, stage_counts in zip(stages, counts):
+        stage.writeLog(fh_log, stage_counts, **stage.kwargs)
+        print(f"{stage.name} - done.")
+    if cache_stats is not None:
+        import variant_cache
+        variant_cache.writeCacheLog(fh_log, cache_stats)
+    if isinstance(logfile, str):
+        fh_log.close()
+
+
+"""Splits infile into shards of consecutive lines, one per run of a
+   chromosome (shard_by='chrom') or of about shard_bytes (shard_by=
+   'bytes'); the header goes with the first shard. Concatenating the
+   shards in order gives back the input.
+"""
+def splitShards(infile, directory, format='vcf', shard_by='chrom', 
+    shard_bytes=SHARD_BYTES, sep='\t'):
+
+    chr_ind = u.getFormatSpecificIndices(format=format)[0]
+    shards = []
+    fh_out = None
+    key = None
+    size = 0
+
+    with bgzf.openText(infile) as fh:
+        for line in fh:
+            if not line.startswith("#"):
+                if (shard_by == 'chrom'):
+                    this_key = line.split(sep)[chr_ind].strip()
+                    full = (key is not None) and (this_key != key)
+                    key = this_key
+                else:
+                    full = (size >= shard_bytes)
+                if full and (fh_out is not None):
+                    fh_out.close()
+                    fh_out = None
+
+            if fh_out is None:
+                shards.append(os.path.join(directory, 
+                    '%06d.vcf' % len(shards)))
+                fh_out = open(shards[-1], 'w')
+                size = 0
+            fh_out.write(line)
+            size = size + len(line)
+
+    if fh_out is not None:
+        fh_out.close()
+    return shards
+
+
+"""Runs every stage over one shard in a worker process; returns the
+   stage counters, the number of reference queries, what the shard
+   added to the worker's utils.db_stats and the variant cache counters
+"""
+def annotateShard(shard, options, cache=None):
+    stats = Counter(u.db_stats)
+    counts, queries, cache_stats = annotateJob(shard, annotFileName(shard), 
+        options, cache=cache)
+    return counts, queries, u.db_stats - stats, cache_stats
+
+
+"""Annotates the shards of infile in parallel, options['workers'] at a
+   time, then merges the outputs in input order and writes one log from
+   the summed counters; the workers' db_stats are added to this process's
+"""
+def runParallel(infile, format, options, cache=None):
+    workers = options['workers']
+    directory = infile + '.shards'
+    fu.mkdirp(directory)
+    shards = splitShards(infile, directory, format=format, 
+        shard_by=options['shard_by'], shard_bytes=options['shard_bytes'])
+    print(f"Annotating {len(shards)} shards with {workers} workers")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(annotateShard, shards, 
+            [options] * len(shards), [cache] * len(shards)))
+
+    counts = [Counter() for stage in PIPELINE]
+    cache_stats = Counter() if cache is not None else None
+    queries = 0
+    outfile = annotFileName(infile, options['compress'])
+    with bgzf.openOutput(outfile) as fh_out:
+        for shard, result in zip(shards, results):
+            shard_counts, shard_queries, stats, shard_cache_stats = result
+            with open(annotFileName(shard)) as fh:
+                shutil.copyfileobj(fh, fh_out)
+            for total, stage_counts in zip(counts, shard_counts):
+                total.update(stage_counts)
+            u.db_stats.update(stats)
+            if shard_cache_stats is not None:
+                cache_stats.update(shard_cache_stats)
+            queries = queries + shard_queries
+    writeLogs(infile + '.count.log', PIPELINE, counts, cache_stats)
+
+    shutil.rmtree(directory)
+    return queries
+
+
+"""A stage may copy a newline out of a reference row; the staged runner
+   re-reads such output as separate lines, so split them the same way
+"""
+def splitAnnotatedLines(lines):
+    if not any([('\n' in l) or ('\r' in l) for l in lines]):
+        return lines
+    split = []
+    for l in lines:
+        split.extend(l.replace('\r\n', '\n').replace('\r', '\n').split('\n'))
+    return split
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,238 @@
+# external_sort.py
+#
+# Sorts VCFs larger than memory by chromosome and position with an
+# external merge sort, recording the input order so annotated output can
+# be put back in it
+#
+# Usage: python external_sort.py <vcf> <sorted_vcf> [order_file] [max_mb] [spill_dir]
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import heapq
+import tempfile
+from array import array
+
+import bgzf
+
+"""Memory a sort may hold before it spills a sorted run to disk
+"""
+SORT_BYTES = 256 * 1024 * 1024
+
+"""Bytes a held line costs on top of its text (string and tuple headers)
+"""
+LINE_OVERHEAD = 160
+
+ORDER_ENTRIES = 65536
+
+
+"""Sorts chromosomes 1, 2, ..., 10, ... before X, Y, MT and the rest;
+   names that differ only in a 'chr' prefix are still kept apart
+"""
+def chromOrder(chrom):
+    name = chrom[3:] if chrom.lower().startswith('chr') else chrom
+    if name.isdigit():
+        return (0, int(name), '', chrom)
+    return (1, 0, name, chrom)
+
+
+"""Sort key of a VCF record: chromosome, then position; records without
+   a numeric position go last on their chromosome
+"""
+def recordKey(line):
+    fields = line.split('\t', 2)
+    pos = sys.maxsize
+    if (len(fields) > 1):
+        try:
+            pos = int(fields[1].strip())
+        except ValueError:
+            pass
+    return (chromOrder(fields[0].strip()), pos)
+
+
+def spill(run, directory):
+    fd, path = tempfile.mkstemp(prefix='sort.', suffix='.run', dir=directory)
+    with os.fdopen(fd, 'w') as fh:
+        for sort_key, index, line in run:
+            fh.write(str(index) + '\t' + line)
+    return path
+
+
+def readRun(path, key):
+    with open(path) as fh:
+        for entry in fh:
+            index, line = entry.split('\t', 1)
+            index = int(index)
+            yield key(index, line), index, line
+
+
+"""Yields the (index, line) items sorted by key(index, line), holding
+   about max_bytes of lines at a time; sorted runs are spilled to
+   spill_dir and merged
+"""
+def externalSort(items, key, max_bytes=SORT_BYTES, spill_dir=None):
+    runs = []
+    run = []
+    size = 0
+    try:
+        for index, line in items:
+            run.append((key(index, line), index, line))
+            size = size + len(line) + LINE_OVERHEAD
+            if (size >= max_bytes):
+                run.sort()
+                runs.append(spill(run, spill_dir))
+                run = []
+                size = 0
+        run.sort()
+
+        for sort_key, index, line in heapq.merge(iter(run), *[readRun(path,
+            key) for path in runs]):
+            yield index, line
+    finally:
+        for path in runs:
+            os.remove(path)
+
+
+def numbered(fh):
+    for index, line in enumerate(fh):
+        yield index, line if line.endswith('\n') else line + '\n'
+
+
+"""Yields the (line number, line) items of the open text file fh sorted
+   by chromosome and position, with the header lines first in their
+   original order; runs are spilled to spill_dir (the temp directory if
+   None)
+"""
+def sortedItems(fh, max_bytes=SORT_BYTES, spill_dir=None):
+    headers = []
+
+    def records():
+        for index, line in numbered(fh):
+            if line.startswith('#'):
+                headers.append((index, line))
+            else:
+                yield index, line
+
+    merged = externalSort(records(), lambda index, line:
+        recordKey(line) + (index,), max_bytes=max_bytes, spill_dir=spill_dir)
+    try:
+        # The sort reads all of its input before yielding the first line,
+        # so every header has been seen once there is one (or none)
+        first = next(merged, None)
+        for item in headers + ([first] if first else []):
+            yield item
+        for item in merged:
+            yield item
+    finally:
+        merged.close()
+
+
+"""The lines of the open text file fh sorted as by sortedItems, e.g. to
+   annotate a stream sorted without staging it; closing the generator
+   closes fh
+"""
+def sortedLines(fh, max_bytes=SORT_BYTES, spill_dir=None):
+    items = sortedItems(fh, max_bytes=max_bytes, spill_dir=spill_dir)
+    try:
+        for index, line in items:
+            yield line
+    finally:
+        items.close()
+        fh.close()
+
+
+"""Writes infile (plain, gzip or bgzip) to outfile as plain text sorted
+   by chromosome and position, with the header lines first in their
+   original order. With order_file, the input line number of each output
+   line is written there (int64, in output order) for restoreOrder.
+"""
+def sortVcf(infile, outfile, max_bytes=SORT_BYTES, spill_dir=None,
+    order_file=None):
+
+    spill_dir = spill_dir or os.path.dirname(os.path.abspath(outfile))
+    with bgzf.openText(infile) as fh:
+        with open(outfile, 'w') as fh_out:
+            order = OrderWriter(order_file)
+            for index, line in sortedItems(fh, max_bytes=max_bytes,
+                spill_dir=spill_dir):
+                fh_out.write(line)
+                order.add(index)
+            order.close()
+
+
+"""Appends input line numbers to an order file, or drops them if path
+   is None
+"""
+class OrderWriter(object):
+    def __init__(self, path):
+        self.fh = open(path, 'wb') if (path is not None) else None
+        self.entries = array('q')
+
+    def add(self, index):
+        if self.fh is None:
+            return
+        self.entries.append(index)
+        if (len(self.entries) >= ORDER_ENTRIES):
+            self.entries.tofile(self.fh)
+            self.entries = array('q')
+
+    def close(self):
+        if self.fh is not None:
+            self.entries.tofile(self.fh)
+            self.fh.close()
+
+
+def readOrder(path):
+    with open(path, 'rb') as fh:
+        while True:
+            entries = array('q')
+            entries.frombytes(fh.read(ORDER_ENTRIES * entries.itemsize))
+            if (len(entries) == 0):
+                return
+            for index in entries:
+                yield index
+
+
+"""Writes the lines of infile, annotated from a file written by sortVcf,
+   to outfile in the input order recorded in order_file; returns False,
+   writing nothing, if infile does not have one line per recorded line
+"""
+def restoreOrder(infile, order_file, outfile, max_bytes=SORT_BYTES,
+    spill_dir=None):
+
+    spill_dir = spill_dir or os.path.dirname(os.path.abspath(outfile))
+    with bgzf.openText(infile) as fh:
+        lines = sum([1 for line in fh])
+    if (lines * array('q').itemsize != os.path.getsize(order_file)):
+        print(f"{infile} does not have one line per input line; " + \
+            f"leaving it sorted")
+        return False
+
+    with bgzf.openText(infile) as fh:
+        items = zip(readOrder(order_file), (line for index, line in
+            numbered(fh)))
+        with bgzf.openOutput(outfile) as fh_out:
+            for index, line in externalSort(items, lambda index, line:
+                index, max_bytes=max_bytes, spill_dir=spill_dir):
+                fh_out.write(line)
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        sortVcf(sys.argv[1], sys.argv[2],
+            order_file=sys.argv[3] if len(sys.argv) > 3 else None,
+            max_bytes=int(float(sys.argv[4]) * 1024 * 1024)
+                if len(sys.argv) > 4 else SORT_BYTES,
+            spill_dir=sys.argv[5] if len(sys.argv) > 5 else None)
+        print(f"Sorted {sys.argv[1]} into {sys.argv[2]}")
+    else:
+        print("Usage: python external_sort.py <vcf> <sorted_vcf> " + \
+            "[order_file] [max_mb] [spill_dir]")
+
+### EOF
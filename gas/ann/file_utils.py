@@ -218,6 +218,17 @@ def readindices(filename, sep='\t'):
     return sorted(values)
 
 
+"""Yields lists of up to size lines, file is not loaded to memory
+"""
+def readChunks(fh, size=1):
+    size = max(1, int(size or 1))
+    while True:
+        chunk = list(itertools.islice(fh, size))
+        if (len(chunk) == 0):
+            return
+        yield chunk
+
+
 """"Count number of lines in file, file is not loaded to memory
 """
 def linecount(filename):
@@ -0,0 +1,348 @@
+# interval_index.py
+#
+# In-memory interval indexes over the reference overlap tables
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+
+from lookup import REFERENCE_TABLES
+
+"""Overlap tables served from memory: table -> (chrom_col, start_col, end_col)
+"""
+OVERLAP_TABLES = dict([(t, c) for t, c in REFERENCE_TABLES.items()
+    if (t in ['cytoBand', 'gadAll', 'targetScanS', 'hugo', 'dgv_Cnv',
+        'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv',
+        'genomicSuperDups']) or t.startswith('tfbsConsSites')])
+
+"""Indexes already loaded by this process, keyed by table
+"""
+_indexes = {}
+
+
+"""Point-overlap index over the intervals of one chromosome.
+   Intervals are sorted by start; maxends[i] is the largest end among the
+   first i + 1 intervals, so every interval before the first maxend >= pos
+   ends before pos and the candidates are a single contiguous slice.
+   Passing maxends means the arrays are already sorted (e.g. memory-mapped
+   from a snapshot) and are used as they are.
+"""
+class IntervalIndex(object):
+    def __init__(self, starts, ends, rowids, maxends=None):
+        if maxends is not None:
+            self.starts = starts
+            self.ends = ends
+            self.rowids = rowids
+            self.maxends = maxends
+            return
+
+        order = np.argsort(starts, kind='stable')
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.rowids = np.asarray(rowids, dtype=np.int64)[order]
+        self.maxends = np.maximum.accumulate(self.ends) if \
+            (len(self.ends) > 0) else self.ends
+
+    """Row ids, in table order, of intervals with
+       start - offset <= pos <= end + offset
+    """
+    def overlapping(self, pos, offset=0):
+        lo = int(np.searchsorted(self.maxends, pos - offset, side='left'))
+        hi = int(np.searchsorted(self.starts, pos + offset, side='right'))
+        if (lo >= hi):
+            return self.rowids[0:0]
+        hits = self.rowids[lo:hi][self.ends[lo:hi] >= (pos - offset)]
+        return np.sort(hits)
+
+
+"""Answers lookups on one reference table from per-chromosome
+   IntervalIndexes; subclasses say where the indexes and rows live.
+   Chromosome names and match values are compared the way MySQL's default
+   collation does, ignoring case and trailing spaces.
+"""
+class IndexedTable(object):
+    def __init__(self, table, names, chrom_col, start_col, end_col):
+        self.table = table
+        self.names = [str(n).lower() for n in names]
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+
+    def chromIndex(self, key):
+        raise NotImplementedError
+
+    def row(self, key, rowid):
+        raise NotImplementedError
+
+    """Chromosome key and row ids answering query, or None if the query is
+       not one this index can answer (other columns or a non-numeric pos)
+    """
+    def lookup(self, query):
+        if (query.chrom_col != self.chrom_col) or \
+            (query.start_col != self.start_col) or \
+            (query.end_col != self.end_col):
+            return None
+        try:
+            pos = int(str(query.pos).strip())
+            offset = int(query.offset)
+        except ValueError:
+            return None
+
+        key = chromKey(query.chrom) if self.chrom_col else None
+        index = self.chromIndex(key)
+        if index is None:
+            return (key, [])
+        return (key, index.overlapping(pos, offset))
+
+    def matches(self, row, match):
+        if (len(match) == 0):
+            return True
+        for alternative in match:
+            if all([sqlEquals(row[self.names.index(col.lower())], value)
+                for col, value in alternative]):
+                return True
+        return False
+
+    def project(self, row, columns):
+        if (columns == '*'):
+            return row
+        return tuple([row[self.names.index(c.strip().lower())]
+            for c in columns.split(',')])
+
+    def fetchall(self, query):
+        found = self.lookup(query)
+        if found is None:
+            return None
+        key, rowids = found
+        rows = [self.row(key, int(i)) for i in rowids]
+        return [self.project(row, query.columns) for row in rows
+            if self.matches(row, query.match)]
+
+
+"""All rows of one reference table held in memory
+"""
+class TableIndex(IndexedTable):
+    def __init__(self, table, names, rows, chrom_col, start_col, end_col):
+        IndexedTable.__init__(self, table, names, chrom_col, start_col, 
+            end_col)
+        self.rows = rows
+
+        start_i = self.names.index(start_col.lower())
+        end_i = self.names.index(end_col.lower())
+        chrom_i = self.names.index(chrom_col.lower()) if chrom_col else None
+
+        by_chrom = {}
+        for rowid, row in enumerate(rows):
+            if (row[start_i] is None) or (row[end_i] is None):
+                continue
+            key = chromKey(row[chrom_i]) if chrom_i is not None else None
+            ids = by_chrom.setdefault(key, ([], [], []))
+            ids[0].append(int(row[start_i]))
+            ids[1].append(int(row[end_i]))
+            ids[2].append(rowid)
+
+        self.chroms = dict([(key, IntervalIndex(s, e, r))
+            for key, (s, e, r) in by_chrom.items()])
+
+    def chromIndex(self, key):
+        return self.chroms.get(key)
+
+    def row(self, key, rowid):
+        return self.rows[rowid]
+
+
+def chromKey(chrom):
+    return str(chrom).rstrip(' ').lower()
+
+
+"""Equality as in a MySQL where clause: numbers compare numerically,
+   binary strings exactly, other strings ignoring case and trailing spaces
+"""
+def sqlEquals(value, wanted):
+    if value is None:
+        return False
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value) == str(wanted).encode('utf-8')
+    if isinstance(value, float):
+        try:
+            return value == float(str(wanted).strip())
+        except ValueError:
+            return False
+    if isinstance(value, (int, Decimal)):
+        try:
+            return value == Decimal(str(wanted).strip())
+        except InvalidOperation:
+            return False
+    return chromKey(value) == chromKey(wanted)
+
+
+"""Loads table into memory once per process
+"""
+def loadTableIndex(cursor, table, chrom_col='chrom', start_col='chromStart',
+    end_col='chromEnd'):
+
+    if table not in _indexes:
+        cursor.execute('select * from ' + table + ';')
+        names = [d[0] for d in cursor.description]
+        rows = [tuple(row) for row in cursor.fetchall()]
+        _indexes[table] = TableIndex(table, names, rows, chrom_col,
+            start_col, end_col)
+    return _indexes[table]
+
+
+"""Answers lookups on the indexed tables (a mapping of table name to
+   IndexedTable) locally and passes all other lookups to the wrapped
+   SqlLookup/BatchedLookup; with no inner lookup every lookup must be
+   answered locally
+"""
+class IndexedLookup(object):
+    def __init__(self, inner, indexes):
+        self.inner = inner
+        self.indexes = indexes
+
+    @property
+    def queries(self):
+        return self.inner.queries if (self.inner is not None) else 0
+
+    def fetchall(self, query):
+        index = self.indexes.get(query.table)
+        rows = index.fetchall(query) if index is not None else None
+        if rows is None:
+            if self.inner is None:
+                raise KeyError(f"No index can answer lookup on {query.table}")
+            return self.inner.fetchall(query)
+        return rows
+
+    def fetchone(self, query):
+        rows = self.fetchall(query)
+        return rows[0] if (len(rows) > 0) else None
+
+    def prefetch(self, stage, lines, outer=None):
+        if self.inner is not None:
+            self.inner.prefetch(stage, lines, outer or self)
+
+    def release(self):
+        if self.inner is not None:
+            self.inner.release()
+
+
+"""Loads the indexes of tables: table -> IndexedTable
+"""
+def loadIndexes(cursor, tables=OVERLAP_TABLES):
+    return dict([(table, loadTableIndex(cursor, table, *columns))
+        for table, columns in tables.items()])
+
+
+"""Wraps db with the overlap tables loaded into memory
+"""
+def indexedLookup(cursor, db, tables=OVERLAP_TABLES):
+    return IndexedLookup(db, loadIndexes(cursor, tables))
+
+
+"""Sweep line over the sorted intervals of an IntervalIndex for
+   positions that arrive in non-decreasing order: intervals enter the
+   active heap (keyed by end) when the sweep reaches their start and
+   leave it once it passes their end, so each interval is touched once
+   per offset. A position behind the sweep is answered by the index.
+"""
+class Sweep(object):
+    def __init__(self, index):
+        self.index = index
+        self.states = {}
+
+    def overlapping(self, pos, offset=0):
+        state = self.states.setdefault(offset, {'pos': None, 'next': 0,
+            'active': []})
+        if (state['pos'] is not None) and (pos < state['pos']):
+            return self.index.overlapping(pos, offset)
+        state['pos'] = pos
+
+        active = state['active']
+        hi = int(np.searchsorted(self.index.starts, pos + offset,
+            side='right'))
+        for i in range(state['next'], hi):
+            heapq.heappush(active, (int(self.index.ends[i]),
+                int(self.index.rowids[i])))
+        state['next'] = max(state['next'], hi)
+
+        while (len(active) > 0) and (active[0][0] < pos - offset):
+            heapq.heappop(active)
+        return sorted([rowid for end, rowid in active])
+
+
+"""An IndexedTable answered by Sweeps over its chromosome indexes; rows
+   found for the current chunk are kept until release(), so the replays
+   of a batched prefetch do not move the sweep backwards
+"""
+class SweepTable(IndexedTable):
+    def __init__(self, source):
+        IndexedTable.__init__(self, source.table, source.names,
+            source.chrom_col, source.start_col, source.end_col)
+        self.source = source
+        self.sweeps = {}
+        self.results = {}
+
+    def chromIndex(self, key):
+        if key not in self.sweeps:
+            index = self.source.chromIndex(key)
+            self.sweeps[key] = None if (index is None) else Sweep(index)
+        return self.sweeps[key]
+
+    def row(self, key, rowid):
+        return self.source.row(key, rowid)
+
+    def fetchall(self, query):
+        if query not in self.results:
+            self.results[query] = IndexedTable.fetchall(self, query)
+        return self.results[query]
+
+    def release(self):
+        self.results = {}
+
+
+"""Mapping of table name to SweepTable over a mapping of IndexedTables
+"""
+class SweepTables(object):
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.tables = {}
+
+    def get(self, table):
+        if table not in self.tables:
+            index = self.indexes.get(table)
+            self.tables[table] = None if (index is None) else \
+                SweepTable(index)
+        return self.tables[table]
+
+    def release(self):
+        for table in self.tables.values():
+            if table is not None:
+                table.release()
+
+
+"""IndexedLookup for coordinate-sorted input: the indexed tables are
+   merged with the variants by sweep lines instead of searched per
+   variant
+"""
+class SweepLookup(IndexedLookup):
+    def __init__(self, inner, indexes):
+        IndexedLookup.__init__(self, inner, SweepTables(indexes))
+
+    def release(self):
+        self.indexes.release()
+        IndexedLookup.release(self)
+
+
+def localLookup(inner, indexes, sweep=False):
+    if sweep:
+        return SweepLookup(inner, indexes)
+    return IndexedLookup(inner, indexes)
+
+### EOF
@@ -0,0 +1,245 @@
+# job_runner.py
+#
+# Admits annotation requests from SQS to the worker pool only while it
+# has a free slot, receiving up to 10 messages per poll into a small
+# scheduled backlog and keeping the messages of waiting and running jobs
+# invisible until they finish
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import threading
+from functools import partial
+
+from botocore.exceptions import ClientError
+
+from job_scheduler import Scheduler
+
+"""Most messages SQS returns per receive
+"""
+MAX_MESSAGES = 10
+WAIT_SECONDS = 20
+
+"""Seconds a received message stays invisible, and how often the
+   messages of waiting and running jobs have that renewed
+"""
+VISIBILITY_SECONDS = 300
+HEARTBEAT_SECONDS = 60
+
+"""Times a message may be received before a job that keeps failing is
+   given up on
+"""
+MAX_RECEIVES = 5
+
+"""Memory set aside for one running job, and the share of the memory
+   available at startup that jobs may use
+"""
+JOB_MEMORY = 1024 * 1024 * 1024
+MEMORY_SHARE = 0.8
+
+
+"""Bytes of memory available to new processes: MemAvailable where
+   /proc/meminfo has it, otherwise all physical memory
+"""
+def availableMemory():
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+"""Jobs that can run at once: one per CPU, as long as each can have
+   job_memory bytes of the memory jobs may use; at most max_slots, at
+   least one
+"""
+def jobSlots(job_memory=JOB_MEMORY, max_slots=None):
+    slots = min(os.cpu_count() or 1,
+        int(availableMemory() * MEMORY_SHARE) // job_memory)
+    if max_slots is not None:
+        slots = min(slots, max_slots)
+    return max(1, slots)
+
+
+"""Renews the visibility timeout of the messages it holds every
+   heartbeat seconds, so SQS does not hand a waiting or running job's
+   message to another annotator
+"""
+class VisibilityKeeper(object):
+    def __init__(self, queue, timeout=VISIBILITY_SECONDS,
+        heartbeat=HEARTBEAT_SECONDS):
+
+        self.queue = queue
+        self.client = queue.meta.client
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.keep, daemon=True)
+        self.thread.start()
+
+    def add(self, message):
+        with self.lock:
+            self.messages[message.message_id] = message
+
+    def remove(self, message):
+        with self.lock:
+            self.messages.pop(message.message_id, None)
+
+    def keep(self):
+        while not self.stopped.wait(self.heartbeat):
+            self.extend()
+
+    def extend(self):
+        with self.lock:
+            messages = list(self.messages.values())
+        for i in range(0, len(messages), MAX_MESSAGES):
+            entries = [{'Id': str(n), 'ReceiptHandle': m.receipt_handle,
+                'VisibilityTimeout': self.timeout}
+                for n, m in enumerate(messages[i:i + MAX_MESSAGES])]
+            try:
+                response = self.client.change_message_visibility_batch(
+                    QueueUrl=self.queue.url, Entries=entries)
+            except ClientError as e:
+                print(f"Can't extend message visibility: {e}")
+                continue
+            for failed in response.get('Failed', []):
+                print(f"Can't extend visibility of message " + \
+                    f"{messages[i + int(failed['Id'])].message_id}: " + \
+                    f"{failed.get('Message', failed['Code'])}")
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+"""Runs jobs from queue on a WorkerPool with slots workers. Received jobs
+   wait in the scheduler, which picks the next one to run whenever a slot
+   is free; no more messages are received while slots + lookahead jobs
+   are waiting or running. A message is deleted once its job succeeds;
+   if the job fails, or the annotator stops before running it, it is
+   left to become visible again, so SQS delivers it again (at least
+   once). A job that fails on the max_receives-th receive of its message
+   is given up on: abandon(*args) is called with the job's arguments
+   (e.g. to mark it failed) and the message is deleted.
+"""
+class JobRunner(object):
+    def __init__(self, queue, pool, slots, keeper=None, scheduler=None,
+        lookahead=MAX_MESSAGES, max_receives=MAX_RECEIVES, abandon=None):
+
+        self.queue = queue
+        self.client = queue.meta.client
+        self.pool = pool
+        self.slots = slots
+        self.keeper = keeper or VisibilityKeeper(queue)
+        self.scheduler = scheduler or Scheduler()
+        self.lookahead = lookahead
+        self.max_receives = max_receives
+        self.abandon = abandon
+        self.running = 0
+        self.free = threading.Condition()
+
+    """Waits until the backlog has room, then long-polls for up to that
+       many messages (at most MAX_MESSAGES)
+    """
+    def receive(self):
+        with self.free:
+            while (self.room() <= 0):
+                self.free.wait()
+            room = self.room()
+        return self.queue.receive_messages(
+            MaxNumberOfMessages=min(MAX_MESSAGES, room),
+            WaitTimeSeconds=WAIT_SECONDS,
+            VisibilityTimeout=self.keeper.timeout,
+            AttributeNames=['ApproximateReceiveCount'])
+
+    def room(self):
+        return self.slots + self.lookahead - self.running - \
+            len(self.scheduler)
+
+    """Schedules func(*args) for message: a job of size bytes (None if
+       unknown) for a user of tier, waiting since the epoch time since
+    """
+    def submit(self, message, func, args, size=None, tier=None, since=None):
+        self.keeper.add(message)
+        self.scheduler.push((message, func, args), size, tier, since=since)
+        self.dispatch()
+
+    """Starts scheduled jobs while there are free slots
+    """
+    def dispatch(self):
+        with self.free:
+            while (self.running < self.slots):
+                job = self.scheduler.pop()
+                if job is None:
+                    return
+                message, func, args = job
+                try:
+                    self.pool.submit(func, args, callback=partial(
+                        self.finished, message, args))
+                except Exception as e:
+                    print(f"Can't start job of message " + \
+                        f"{message.message_id}: {e}")
+                    self.keeper.remove(message)
+                    continue
+                self.running = self.running + 1
+
+    def finished(self, message, args, ticket, seconds, error):
+        self.keeper.remove(message)
+        if error is None:
+            print(f"Job of message {message.message_id} finished in " + \
+                f"{seconds:.2f} seconds")
+            self.delete(message)
+        elif (receiveCount(message) >= self.max_receives):
+            print(f"Job of message {message.message_id} failed " + \
+                f"{receiveCount(message)} times; giving up: {error}")
+            self.giveUp(message, args)
+        else:
+            print(f"Job of message {message.message_id} failed; it will " + \
+                f"be received again: {error}")
+        self.release()
+
+    def giveUp(self, message, args):
+        if self.abandon is not None:
+            try:
+                self.abandon(*args)
+            except Exception as e:
+                print(f"Can't abandon job of message " + \
+                    f"{message.message_id}: {e}")
+        self.delete(message)
+
+    def release(self):
+        with self.free:
+            self.running = self.running - 1
+            self.free.notify()
+        self.dispatch()
+
+    """Deletes a message whose job is done (or that can never run)
+    """
+    def delete(self, message):
+        try:
+            self.client.delete_message(QueueUrl=self.queue.url,
+                ReceiptHandle=message.receipt_handle)
+        except ClientError as e:
+            print(f"Can't delete message {message.message_id}: {e}")
+
+    def close(self):
+        self.pool.close()
+        self.keeper.close()
+
+
+"""Times SQS has delivered message (0 if it was received without the
+   ApproximateReceiveCount attribute)
+"""
+def receiveCount(message):
+    return int((message.attributes or {}).get('ApproximateReceiveCount', 0))
+
+### EOF
@@ -0,0 +1,129 @@
+# job_scheduler.py
+#
+# Orders the annotation jobs an annotator has received: shortest expected
+# job first, from the size of the input, with premium users' jobs
+# weighted ahead and waiting jobs aged so none starves; keeps the queue
+# waits of each tier
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import math
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+"""Expected runtime of a job: a fixed overhead plus its input at the
+   annotation rate; inputs of unknown size are taken to be UNKNOWN_SIZE
+"""
+JOB_OVERHEAD = 2.0
+BYTES_PER_SECOND = 2 * 1024 * 1024
+UNKNOWN_SIZE = 64 * 1024 * 1024
+
+"""Expected runtimes are multiplied by the weight of the user's tier, so
+   a premium job counts as a 5 times shorter one
+"""
+TIER_WEIGHTS = {'premium_user': 0.2}
+
+"""Seconds of weighted expected runtime a job is forgiven for every
+   second it waits, so a long job eventually runs ahead of new short ones
+"""
+AGING_RATE = 1.0
+
+"""Queue waits kept per tier for the percentiles
+"""
+WAIT_SAMPLES = 1000
+
+
+"""Size in bytes of an S3 object from its metadata, or None
+"""
+def objectSize(client, bucket, key):
+    try:
+        return client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    except ClientError as e:
+        print(f"Can't read the size of s3://{bucket}/{key}: {e}")
+        return None
+
+
+"""The value at fraction of sorted values, by nearest rank
+"""
+def percentile(values, fraction):
+    rank = min(max(1, math.ceil(fraction * len(values))), len(values))
+    return values[rank - 1]
+
+
+"""Jobs waiting for a slot, taken out by pop() in order of weighted
+   expected runtime less AGING_RATE times the time waited. That order
+   does not change as time passes (every job ages at the same rate), so
+   each job's key is fixed when it is added: weighted runtime +
+   AGING_RATE * the time it started waiting.
+"""
+class Scheduler(object):
+    def __init__(self, weights=TIER_WEIGHTS, aging=AGING_RATE,
+        bytes_per_second=BYTES_PER_SECOND, overhead=JOB_OVERHEAD):
+
+        self.weights = weights
+        self.aging = aging
+        self.bytes_per_second = bytes_per_second
+        self.overhead = overhead
+        self.heap = []
+        self.order = itertools.count()
+        self.waits = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+    def expectedSeconds(self, size):
+        if size is None:
+            size = UNKNOWN_SIZE
+        return self.overhead + float(size) / self.bytes_per_second
+
+    """Adds job of size bytes for a user of tier, waiting since the epoch
+       time since (now if None)
+    """
+    def push(self, job, size, tier, since=None):
+        try:
+            since = float(since)
+        except (TypeError, ValueError):
+            since = time.time()
+        key = self.weights.get(tier, 1.0) * self.expectedSeconds(size) + \
+            self.aging * since
+        with self.lock:
+            heapq.heappush(self.heap, (key, next(self.order), job, tier,
+                since))
+
+    """Takes out the next job to run and records how long it waited;
+       returns None if no job is waiting
+    """
+    def pop(self):
+        with self.lock:
+            if (len(self.heap) == 0):
+                return None
+            key, order, job, tier, since = heapq.heappop(self.heap)
+            self.waits.setdefault(tier, deque(maxlen=WAIT_SAMPLES)).append(
+                max(0.0, time.time() - since))
+        return job
+
+    """Count, p50 and p95 of the recent queue waits (seconds) of each tier
+    """
+    def waitPercentiles(self):
+        with self.lock:
+            waits = dict([(tier, sorted(w)) for tier, w in self.waits.items()])
+        return dict([(tier, (len(w), percentile(w, 0.5), percentile(w, 0.95)))
+            for tier, w in waits.items() if (len(w) > 0)])
+
+    def report(self):
+        return "Queue wait: " + ", ".join([f"{tier} p50 {p50:.1f}s " + \
+            f"p95 {p95:.1f}s ({count} jobs)" for tier, (count, p50, p95)
+            in sorted(self.waitPercentiles().items(), key=str)])
+
+### EOF
@@ -0,0 +1,115 @@
+# known_variants.py
+#
+# Offline job that annotates every dbSNP SNV once per reference version,
+# so jobs copy the annotations of known variants instead of running the
+# stages on them
+#
+# Usage: python known_variants.py <artifact> <snapshot_root|reference_version>
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import sqlite3
+
+import driver
+import utils as u
+
+"""INFO written for each known variant, one per INFO class the artifact
+   answers (see variant_cache.infoClass); lines whose INFO ends with ';'
+   are rare enough to be left to the stages
+"""
+INFO_VALUES = ['.', 'KNOWN']
+
+BASES = ['A', 'C', 'G', 'T']
+FETCH_ROWS = 100000
+
+"""Writes a VCF with one line per dbSNP SNV position, reference base,
+   alternate base and INFO value, sorted by chromosome and position;
+   dbSNP's alternate alleles are not used by the stages, so all three
+   are written
+"""
+def writeKnownVariants(vcf, conn, info_values=INFO_VALUES):
+    import pymysql.cursors
+
+    stream = conn.cursor(pymysql.cursors.SSCursor)
+    stream.execute('select CHR, POS, REF from dbSNP where INFO="SNV" ' +
+        'order by CHR, POS;')
+    written = 0
+    last = None
+    with open(vcf, 'w') as fh:
+        fh.write('##fileformat=VCFv4.1\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        while True:
+            chunk = stream.fetchmany(FETCH_ROWS)
+            if (len(chunk) == 0):
+                break
+            for chrom, pos, ref in chunk:
+                if isinstance(ref, (bytes, bytearray)):
+                    ref = bytes(ref).decode('utf-8')
+                ref = str(ref).strip().upper()
+                if (chrom is None) or (pos is None) or (ref not in BASES) or \
+                    ((chrom, pos, ref) == last):
+                    continue
+                last = (chrom, pos, ref)
+                for alt in BASES:
+                    if (alt == ref):
+                        continue
+                    for info in info_values:
+                        fh.write(f"{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\t.\t" + \
+                            f"{info}\n")
+                        written = written + 1
+    stream.close()
+    return written
+
+
+"""Annotates every dbSNP SNV into a fresh artifact at path for the
+   snapshot in snapshot_dir, or for reference_version with the reference
+   database; jobs use it through driver.run's known_variants option
+"""
+def buildKnownVariants(path, snapshot_dir=None, reference_version=None,
+    batch_size=driver.BATCH_SIZE):
+
+    options = {'batch_size': batch_size, 'snapshot_dir': snapshot_dir,
+        'sweep': True, 'cache_path': path + '.building',
+        'cache_bytes': 2 ** 62, 'reference_version': reference_version}
+    settings = driver.cacheSettings(options)
+    if settings is None:
+        raise ValueError("A snapshot or reference version is required")
+    for ext in ['.building', '.building-wal', '.building-shm', '.vcf']:
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+
+    conn = u.db_connect()
+    print(f"Known variants: {writeKnownVariants(path + '.vcf', conn)}")
+    conn.close()
+
+    counts, queries, stats = driver.annotateJob(path + '.vcf', os.devnull,
+        options, cache=settings)
+    print(f"Annotations stored: {stats['stored']}")
+
+    seal = sqlite3.connect(path + '.building')
+    seal.execute('pragma journal_mode=delete;')
+    seal.close()
+    os.replace(path + '.building', path)
+    os.remove(path + '.vcf')
+    return settings['version']
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        if os.path.isdir(sys.argv[2]):
+            version = buildKnownVariants(sys.argv[1], snapshot_dir=sys.argv[2])
+        else:
+            version = buildKnownVariants(sys.argv[1],
+                reference_version=sys.argv[2])
+        print(f"Known variants for {version} written to {sys.argv[1]}")
+    else:
+        print("Usage: python known_variants.py <artifact> " + \
+            "<snapshot_root|reference_version>")
+
+### EOF
@@ -0,0 +1,202 @@
+# lookup.py
+#
+# Reference lookups used by the annotate.py stages
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from collections import Counter, OrderedDict, namedtuple
+
+"""Number of VCF lines whose lookups are resolved together
+"""
+BATCH_SIZE = 5000
+
+"""Reference tables read by the annotate.py stages and the columns their
+   lookups use: table -> (chrom_col, start_col, end_col). tfbsConsSites
+   is split into one table per chromosome with no chrom column.
+"""
+REFERENCE_TABLES = dict([
+    ('dbSNP', ('CHR', 'POS', 'POS')),
+    ('chrom_pos_equal_base', ('CHR', 'start', 'start')),
+    ('chrom_pos_equal_nobase', ('CHR', 'start', 'start')),
+    ('chrom_pos_unequal', ('CHR', 'start', 'end')),
+    ('refGene', ('chrom', 'txStart', 'txEnd')),
+    ('cpgIslandExt', ('chrom', 'chromStart', 'chromEnd')),
+    ('cytoBand', ('chrom', 'chromStart', 'chromEnd')),
+    ('gadAll', ('chromosome', 'chromStart', 'chromEnd')),
+    ('gwasCatalog', ('chrom', 'chromEnd', 'chromEnd')),
+    ('targetScanS', ('chrom', 'chromStart', 'chromEnd')),
+    ('hugo', ('chrom', 'chromStart', 'chromEnd')),
+    ('dgv_Cnv', ('chrom', 'chromStart', 'chromEnd')),
+    ('abParts_IG_T_CelReceptors', ('chrom', 'chromStart', 'chromEnd')),
+    ('mcCarroll_Cnv', ('chrom', 'chromStart', 'chromEnd')),
+    ('conrad_Cnv', ('chrom', 'chromStart', 'chromEnd')),
+    ('genomicSuperDups', ('chrom', 'chromStart', 'chromEnd'))] +
+    [('tfbsConsSites' + c, (None, 'chromStart', 'chromEnd')) for c in
+        [str(i) for i in range(1, 23)] + ['X', 'Y']])
+
+"""One reference lookup issued by a stage for one variant:
+   select <columns> from <table> where <chrom_col>="<chrom>" AND
+   (<start_col> - offset) <= pos AND pos <= (<end_col> + offset)
+   AND (<match alternative 1> OR <match alternative 2> ...)
+   start_col == end_col means an exact position match; chrom_col None
+   means the table holds a single chromosome; each match alternative is
+   a tuple of (column, value) pairs that must all hold
+"""
+Query = namedtuple('Query', ['table', 'chrom_col', 'chrom', 'pos',
+    'start_col', 'end_col', 'offset', 'match', 'columns'],
+    defaults=['chromStart', 'chromEnd', 0, (), '*'])
+
+
+def whereClause(query):
+    where = []
+    if query.chrom_col is not None:
+        where.append(query.chrom_col + '="' + str(query.chrom) + '"')
+
+    if (query.start_col == query.end_col):
+        where.append(query.start_col + ' = ' + str(query.pos))
+    elif (query.offset != 0):
+        where.append('(' + query.start_col + ' - ' + str(query.offset) +
+            ') <= ' + str(query.pos) + ' AND ' + str(query.pos) + ' <= (' +
+            query.end_col + ' + ' + str(query.offset) + ')')
+    else:
+        where.append('(' + query.start_col + ' <= ' + str(query.pos) +
+            ' AND ' + str(query.pos) + ' <= ' + query.end_col + ')')
+
+    if (len(query.match) > 0):
+        where.append('(' + ' OR '.join(['(' + ' AND '.join([col + '="' +
+            str(value) + '"' for col, value in alternative]) + ')'
+            for alternative in query.match]) + ')')
+
+    return ' AND '.join(where)
+
+
+def toSql(query):
+    return 'select ' + query.columns + ' from ' + query.table + \
+        ' where ' + whereClause(query) + ';'
+
+
+"""Answers every lookup with its own SQL round-trip
+"""
+class SqlLookup(object):
+    def __init__(self, cursor, lock=None):
+        self.cursor = cursor
+        self.lock = lock
+        self.queries = 0
+
+    """Runs sql; lookups whose cursors share a connection across threads
+       pass the same lock
+    """
+    def execute(self, sql):
+        self.queries = self.queries + 1
+        if self.lock is None:
+            self.cursor.execute(sql)
+            return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute(sql)
+            return self.cursor.fetchall()
+
+    def fetchall(self, query):
+        return list(self.execute(toSql(query)))
+
+    def fetchone(self, query):
+        rows = self.fetchall(query)
+        return rows[0] if (len(rows) > 0) else None
+
+    """Hook for lookups that resolve a whole chunk of lines up front;
+       outer is the lookup the stage is actually given, if this one is
+       wrapped by another
+    """
+    def prefetch(self, stage, lines, outer=None):
+        pass
+
+    def release(self):
+        pass
+
+
+"""Stops a stage replayed by BatchedLookup.prefetch at a lookup that is
+   not resolved yet
+"""
+class Unresolved(Exception):
+    pass
+
+
+"""Resolves the lookups of a chunk of lines with one statement per table
+   (per max_union lookups) and hands the rows back to each variant.
+
+   prefetch() runs the stage over the chunk, stopping each line at its
+   first unresolved lookup and collecting it; the collected lookups are
+   resolved in bulk and the stage is replayed until it asks for nothing
+   new. Lookups that depend on earlier results (the fallback bigRefGene
+   tables, cpgIslandExt for promoters) are only asked for once those
+   results are known, so the set of lookups matches the per-variant path.
+"""
+class BatchedLookup(SqlLookup):
+    def __init__(self, cursor, max_union=500, lock=None):
+        SqlLookup.__init__(self, cursor, lock=lock)
+        self.max_union = max_union
+        self.results = {}
+        self.pending = None
+
+    def fetchall(self, query):
+        if query in self.results:
+            return self.results[query]
+
+        if self.pending is not None:
+            self.pending[query] = True
+            raise Unresolved()
+
+        return SqlLookup.fetchall(self, query)
+
+    def prefetch(self, stage, lines, outer=None):
+        while True:
+            self.pending = OrderedDict()
+            try:
+                for line in lines:
+                    try:
+                        stage.annotateLine(line, outer or self, Counter(), 
+                            **stage.kwargs)
+                    except Unresolved:
+                        pass
+                pending = list(self.pending)
+            finally:
+                self.pending = None
+
+            if (len(pending) == 0):
+                break
+            self.resolve(pending)
+
+    def resolve(self, queries):
+        groups = OrderedDict()
+        for query in queries:
+            groups.setdefault((query.table, query.columns), []).append(query)
+
+        for (table, columns), group in groups.items():
+            if (columns == '*'):
+                columns = table + '.*'
+            for i in range(0, len(group), self.max_union):
+                batch = group[i:i + self.max_union]
+                sql = ' union all '.join(['select ' + str(tag) + ' as q, ' +
+                    columns + ' from ' + table + ' where ' + whereClause(q)
+                    for tag, q in enumerate(batch)]) + ';'
+
+                for q in batch:
+                    self.results[q] = []
+                for row in self.execute(sql):
+                    self.results[batch[int(row[0])]].append(tuple(row[1:]))
+
+    def release(self):
+        self.results = {}
+
+
+"""Batched lookups for chunks of more than one line, per-variant otherwise
+"""
+def newLookup(cursor, batch_size=BATCH_SIZE, lock=None):
+    if (batch_size is not None) and (batch_size > 1):
+        return BatchedLookup(cursor, lock=lock)
+    return SqlLookup(cursor, lock=lock)
+
+### EOF
@@ -0,0 +1,290 @@
+# position_filter.py
+#
+# Memory-mapped Bloom filters over the (chrom, pos) keys of the exact-match
+# reference tables, so lookups of positions a table cannot hold are never
+# sent to the database
+#
+# Usage: python position_filter.py <filter_dir> [false_positive_rate]
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import math
+import mmap
+import time
+import zlib
+import threading
+
+from lookup import REFERENCE_TABLES
+from interval_index import chromKey
+
+"""Layout of a filter directory:
+   <filter_dir>/<table>.bloom        bit array, bit b is (byte b >> 3) >> (b & 7)
+   <filter_dir>/<table>.bloom.json   table, columns, bits, hashes, rows, fpr
+   A key is crc32(chromKey(chrom)) << 32 | pos; its bits are
+   (h1 + i * h2) mod bits for i < hashes, with h1 and h2 splitmix64 of the
+   key (h2 of the key xor SECOND_HASH, made odd).
+"""
+FILTER_EXT = '.bloom'
+SECOND_HASH = 0x5851F42D4C957F2D
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+"""Default false positive rate of a filter
+"""
+FALSE_POSITIVE_RATE = 0.01
+
+"""Tables looked up by exact position: table -> (chrom_col, pos_col)
+"""
+EXACT_TABLES = dict([(t, (chrom_col, start_col)) for t, (chrom_col,
+    start_col, end_col) in REFERENCE_TABLES.items()
+    if (start_col == end_col) and (chrom_col is not None)])
+
+FETCH_ROWS = 100000
+
+"""Filters already mapped by this process, keyed by path
+"""
+_filters = {}
+_stats_lock = threading.Lock()
+
+
+def splitmix(x):
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def splitmixArray(x):
+    import numpy as np
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def chromCode(chrom):
+    return zlib.crc32(chromKey(chrom).encode('utf-8'))
+
+
+"""Bits and hash functions for rows keys at false positive rate fpr
+"""
+def filterSize(rows, fpr):
+    rows = max(rows, 1)
+    bits = max(64, int(math.ceil(-rows * math.log(fpr) /
+        (math.log(2) ** 2))))
+    hashes = max(1, int(round(bits / float(rows) * math.log(2))))
+    return bits, hashes
+
+
+"""Builds the filter of one table from the reference database
+"""
+def buildFilter(conn, directory, table, chrom_col, pos_col,
+    fpr=FALSE_POSITIVE_RATE):
+
+    import numpy as np
+    import pymysql.cursors
+
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from ' + table + ' where ' + pos_col +
+        ' is not null;')
+    rows = int(cursor.fetchone()[0])
+    bits, hashes = filterSize(rows, fpr)
+    array = np.zeros((bits + 7) // 8, dtype=np.uint8)
+
+    codes = {}
+    stream = conn.cursor(pymysql.cursors.SSCursor)
+    stream.execute('select ' + chrom_col + ', ' + pos_col + ' from ' +
+        table + ' where ' + pos_col + ' is not null;')
+    while True:
+        chunk = stream.fetchmany(FETCH_ROWS)
+        if (len(chunk) == 0):
+            break
+        for chrom, pos in chunk:
+            if (chrom is not None) and (chrom not in codes):
+                codes[chrom] = chromCode(chrom)
+        chunk = [(codes[chrom], int(pos)) for chrom, pos in chunk
+            if chrom is not None]
+        if (len(chunk) == 0):
+            continue
+        pos = np.array([p for c, p in chunk], dtype=np.int64)
+        if (pos.min() < 0) or (pos.max() >= 2 ** 32):
+            raise ValueError(f"{table}.{pos_col} out of range for a " + \
+                f"position filter")
+
+        keys = (np.array([c for c, p in chunk], dtype=np.uint64) <<
+            np.uint64(32)) | pos.astype(np.uint64)
+        h1 = splitmixArray(keys)
+        h2 = splitmixArray(keys ^ np.uint64(SECOND_HASH)) | np.uint64(1)
+        with np.errstate(over='ignore'):
+            for i in range(hashes):
+                b = (h1 + np.uint64(i) * h2) % np.uint64(bits)
+                np.bitwise_or.at(array, (b >> np.uint64(3)).astype(np.int64),
+                    (np.uint64(1) << (b & np.uint64(7))).astype(np.uint8))
+    stream.close()
+
+    path = os.path.join(directory, table + FILTER_EXT)
+    array.tofile(path + '.building')
+    os.replace(path + '.building', path)
+    with open(path + '.json', 'w') as fh:
+        json.dump({'table': table, 'chrom_col': chrom_col,
+            'pos_col': pos_col, 'bits': bits, 'hashes': hashes,
+            'rows': rows, 'fpr': fpr, 'created': int(time.time())},
+            fh, indent=1)
+    return path
+
+
+"""Builds the filters of every exact-match table into directory; rebuild
+   them whenever the reference tables are reloaded
+"""
+def buildFilters(directory, tables=EXACT_TABLES, fpr=FALSE_POSITIVE_RATE,
+    conn=None):
+
+    import utils as u
+    import file_utils as fu
+
+    fu.mkdirp(directory)
+    close = conn is None
+    if conn is None:
+        conn = u.db_connect()
+    for table, (chrom_col, pos_col) in tables.items():
+        print(f"Building position filter for {table} . . .")
+        buildFilter(conn, directory, table, chrom_col, pos_col, fpr=fpr)
+    if close:
+        conn.close()
+
+
+"""Memory-mapped filter of one table; pages are shared by every process
+   that maps the same file
+"""
+class PositionFilter(object):
+    def __init__(self, path):
+        with open(path + '.json') as fh:
+            self.info = json.load(fh)
+        self.bits = self.info['bits']
+        self.hashes = self.info['hashes']
+        self.chrom_col = self.info['chrom_col'].lower()
+        self.pos_col = self.info['pos_col'].lower()
+        with open(path, 'rb') as fh:
+            self.array = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    """False if the table has no row at (chrom, pos); True if it may
+    """
+    def mayContain(self, chrom, pos):
+        key = (chromCode(chrom) << 32) | pos
+        h1 = splitmix(key)
+        h2 = splitmix(key ^ SECOND_HASH) | 1
+        for i in range(self.hashes):
+            b = ((h1 + i * h2) & MASK64) % self.bits
+            if not ((self.array[b >> 3] >> (b & 7)) & 1):
+                return False
+        return True
+
+    """False if query can only return rows at a (chrom, pos) key the
+       table does not hold
+    """
+    def admits(self, query):
+        if (query.start_col != query.end_col) or (query.chrom_col is None) or \
+            (query.start_col.lower() != self.pos_col) or \
+            (query.chrom_col.lower() != self.chrom_col):
+            return True
+        try:
+            pos = int(str(query.pos).strip())
+        except ValueError:
+            return True
+        if (pos < 0) or (pos >= 2 ** 32):
+            return True
+        return self.mayContain(query.chrom, pos)
+
+
+"""Filters found in directory: table -> PositionFilter
+"""
+def loadFilters(directory, tables=EXACT_TABLES):
+    filters = {}
+    for table in tables:
+        path = os.path.join(directory, table + FILTER_EXT)
+        if not os.path.exists(path + '.json'):
+            continue
+        if path not in _filters:
+            _filters[path] = PositionFilter(path)
+        filters[table] = _filters[path]
+    return filters
+
+
+"""Answers lookups the filters (table -> PositionFilter or
+   coverage_bitmap.CoverageBitmap) rule out as empty and passes the rest
+   to the wrapped lookup. Lookups skipped outside of prefetch are added to
+   utils.db_stats['lookups_filtered'], so each line is counted once.
+"""
+class FilteredLookup(object):
+    def __init__(self, inner, filters):
+        self.inner = inner
+        self.filters = filters
+        self.prefetching = False
+        self.filtered = 0
+
+    @property
+    def queries(self):
+        return self.inner.queries
+
+    def fetchall(self, query):
+        position_filter = self.filters.get(query.table)
+        if (position_filter is not None) and \
+            (not position_filter.admits(query)):
+            if not self.prefetching:
+                self.filtered = self.filtered + 1
+            return []
+        return self.inner.fetchall(query)
+
+    def fetchone(self, query):
+        rows = self.fetchall(query)
+        return rows[0] if (len(rows) > 0) else None
+
+    def prefetch(self, stage, lines, outer=None):
+        self.prefetching = True
+        try:
+            self.inner.prefetch(stage, lines, outer or self)
+        finally:
+            self.prefetching = False
+
+    def release(self):
+        import utils as u
+        with _stats_lock:
+            u.db_stats['lookups_filtered'] += self.filtered
+        self.filtered = 0
+        self.inner.release()
+
+
+"""Wraps db with the position filters and coverage bitmaps in directory
+"""
+def filteredLookup(db, directory):
+    import coverage_bitmap
+    filters = loadFilters(directory)
+    filters.update(coverage_bitmap.loadBitmaps(directory))
+    if (len(filters) == 0):
+        print(f"No position filters or coverage bitmaps in {directory}")
+        return db
+    return FilteredLookup(db, filters)
+
+
+def writeFilterLog(fh_log, filtered):
+    fh_log.write(f"Reference lookups skipped by position filters and " + \
+        f"coverage bitmaps: {str(filtered)}\n")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        buildFilters(sys.argv[1], fpr=float(sys.argv[2])
+            if len(sys.argv) > 2 else FALSE_POSITIVE_RATE)
+        print(f"Position filters written to {sys.argv[1]}")
+    else:
+        print("Usage: python position_filter.py <filter_dir> " + \
+            "[false_positive_rate]")
+
+### EOF
@@ -0,0 +1,249 @@
+# query_planner.py
+#
+# Chooses, per chunk, table and chromosome, how the lookups of a batched
+# job are sent to the reference database: one query per lookup, union
+# batches, or one range query joined locally
+#
+# Usage: python query_planner.py <stats_file>
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import math
+from collections import OrderedDict
+
+from lookup import REFERENCE_TABLES, BatchedLookup, SqlLookup
+
+"""Strategies a plan can pick
+"""
+POINT = 'point'
+BATCHED = 'batched-IN'
+RANGE = 'range-prefetch'
+
+"""Cost model, in rows transferred: a round trip to the database costs
+   about as much as sending ROUND_TRIP_ROWS rows, and each lookup in a
+   union batch adds UNION_LOOKUP_ROWS of parsing and planning
+"""
+ROUND_TRIP_ROWS = 1000
+UNION_LOOKUP_ROWS = 50
+
+"""Plans already chosen by this process: (table, chrom) -> strategy, so a
+   plan is printed only when it changes
+"""
+_chosen = {}
+
+"""Statistics already loaded by this process, keyed by path
+"""
+_stats = {}
+
+
+"""Row count and extent of every reference table by chromosome:
+   table -> chrom key -> [rows, min start, max end]
+"""
+def gatherStats(conn, tables=REFERENCE_TABLES):
+    from interval_index import chromKey
+
+    stats = {}
+    cursor = conn.cursor()
+    for table, (chrom_col, start_col, end_col) in tables.items():
+        print(f"Counting {table} . . .")
+        cursor.execute('select ' + (chrom_col or "''") + ', count(*), ' +
+            'min(' + start_col + '), max(' + end_col + ') from ' + table +
+            ((' group by ' + chrom_col) if chrom_col else '') + ';')
+        stats[table] = {}
+        for chrom, rows, lo, hi in cursor.fetchall():
+            if (chrom is None) or (lo is None) or (hi is None):
+                continue
+            key = chromKey(chrom) if chrom_col else ''
+            entry = stats[table].setdefault(key, [0, int(lo), int(hi)])
+            entry[0] = entry[0] + int(rows)
+            entry[1] = min(entry[1], int(lo))
+            entry[2] = max(entry[2], int(hi))
+    return stats
+
+
+"""Statistics from path, gathered from the database with conn and saved
+   to path the first time
+"""
+def loadStats(path, conn=None):
+    if path in _stats:
+        return _stats[path]
+    if not os.path.exists(path):
+        import utils as u
+        close = conn is None
+        if conn is None:
+            conn = u.db_connect()
+        stats = gatherStats(conn)
+        if close:
+            conn.close()
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(stats, fh, indent=1)
+        os.replace(path + '.tmp', path)
+    with open(path) as fh:
+        _stats[path] = json.load(fh)
+    return _stats[path]
+
+
+"""Picks a strategy for the lookups of one table and chromosome from
+   how many there are, the window they span and how many rows the table
+   holds on the chromosome
+"""
+class QueryPlanner(object):
+    def __init__(self, stats, max_union=500):
+        self.stats = stats
+        self.max_union = max_union
+
+    """Rows of table expected in [lo, hi] of chrom, assuming they are
+       spread evenly over the chromosome's extent; None without stats
+    """
+    def expectedRows(self, table, chrom, lo, hi):
+        if table not in self.stats:
+            return None
+        entry = self.stats[table].get(chrom)
+        if entry is None:
+            return 0
+        rows, first, last = entry
+        covered = min(hi, last) - max(lo, first) + 1
+        if (covered <= 0):
+            return 0
+        return int(math.ceil(rows * covered / float(last - first + 1)))
+
+    """(strategy, reason) for lookups at positions in [lo, hi]; span is
+       None if they cannot be fetched as a range
+    """
+    def plan(self, table, chrom, lookups, span):
+        batches = int(math.ceil(lookups / float(self.max_union)))
+        costs = OrderedDict([
+            (POINT, lookups * ROUND_TRIP_ROWS),
+            (BATCHED, batches * ROUND_TRIP_ROWS +
+                lookups * UNION_LOOKUP_ROWS)])
+
+        expected = None
+        if span is not None:
+            expected = self.expectedRows(table, chrom, span[0], span[1])
+        if expected is not None:
+            costs[RANGE] = ROUND_TRIP_ROWS + expected
+
+        strategy = min(costs, key=lambda s: costs[s])
+        reason = f"{lookups} lookups, {batches} union batches"
+        if expected is not None:
+            reason = reason + f", ~{expected} rows in " + \
+                f"{span[1] - span[0] + 1} bp"
+        elif span is None:
+            reason = reason + ", no numeric window"
+        else:
+            reason = reason + ", no row counts"
+        return strategy, reason
+
+
+"""BatchedLookup that resolves each table and chromosome of a chunk the
+   way its QueryPlanner finds cheapest. A range-prefetch reads every row
+   of the window in one query and answers the lookups from a
+   interval_index.TableIndex over those rows (requires numpy).
+"""
+class PlannedLookup(BatchedLookup):
+    def __init__(self, cursor, planner, max_union=500, lock=None):
+        BatchedLookup.__init__(self, cursor, max_union=max_union, lock=lock)
+        self.planner = planner
+
+    def resolve(self, queries):
+        from interval_index import chromKey
+
+        groups = OrderedDict()
+        for query in queries:
+            key = (query.table, query.chrom_col, query.start_col,
+                query.end_col, chromKey(query.chrom) if query.chrom_col
+                else '')
+            groups.setdefault(key, []).append(query)
+
+        batched = []
+        for (table, chrom_col, start_col, end_col, chrom), group in \
+            groups.items():
+
+            span = self.window(group)
+            strategy, reason = self.planner.plan(table, chrom, len(group),
+                span)
+            if (_chosen.get((table, chrom)) != strategy):
+                _chosen[(table, chrom)] = strategy
+                print(f"Plan for {table} {chrom or '(all)'}: {strategy} " + \
+                    f"({reason})")
+
+            if (strategy == RANGE):
+                self.prefetchRange(group, span)
+            elif (strategy == POINT):
+                for query in group:
+                    self.results[query] = SqlLookup.fetchall(self, query)
+            else:
+                batched.extend(group)
+
+        if (len(batched) > 0):
+            BatchedLookup.resolve(self, batched)
+
+    """[lo, hi] holding every row the lookups can return, or None if a
+       position is not a number
+    """
+    def window(self, group):
+        try:
+            bounds = [(int(str(q.pos).strip()), int(q.offset)) for q in group]
+        except ValueError:
+            return None
+        if any([offset < 0 for pos, offset in bounds]):
+            return None
+        return (min([pos - offset for pos, offset in bounds]),
+            max([pos + offset for pos, offset in bounds]))
+
+    def prefetchRange(self, group, span):
+        from interval_index import TableIndex
+
+        query = group[0]
+        where = []
+        if query.chrom_col is not None:
+            where.append(query.chrom_col + '="' + str(query.chrom) + '"')
+        where.append(query.start_col + ' <= ' + str(span[1]))
+        where.append(query.end_col + ' >= ' + str(span[0]))
+        sql = 'select * from ' + query.table + ' where ' + \
+            ' AND '.join(where) + ';'
+
+        self.queries = self.queries + 1
+        if self.lock is None:
+            rows, names = self.describe(sql)
+        else:
+            with self.lock:
+                rows, names = self.describe(sql)
+
+        index = TableIndex(query.table, names, [tuple(r) for r in rows],
+            query.chrom_col, query.start_col, query.end_col)
+        for q in group:
+            found = index.fetchall(q)
+            self.results[q] = found if (found is not None) else \
+                SqlLookup.fetchall(self, q)
+
+    def describe(self, sql):
+        self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
+        return rows, [d[0] for d in self.cursor.description]
+
+
+"""Planned lookups over cursor with the statistics in stats_path
+"""
+def plannedLookup(cursor, stats_path, lock=None):
+    return PlannedLookup(cursor, QueryPlanner(loadStats(stats_path)),
+        lock=lock)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        if os.path.exists(sys.argv[1]):
+            os.remove(sys.argv[1])
+        loadStats(sys.argv[1])
+        print(f"Reference table statistics written to {sys.argv[1]}")
+    else:
+        print("Usage: python query_planner.py <stats_file>")
+
+### EOF
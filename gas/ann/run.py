@@ -7,8 +7,13 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import sys
 import os
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import driver
+import bgzf
+import s3_stream
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 import time
 import json
@@ -18,26 +23,58 @@ from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read('ann_config.ini')
 
-def update_job_status(job_id, log_object, annot_object):
-  dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
-  ann_table = dynamodb.Table(config['aws']['AnnTableName'])
+# Multipart uploads of results: 8 MB parts, up to 10 at a time per file
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, 
+  multipart_chunksize=8 * 1024 * 1024, max_concurrency=10, use_threads=True)
+
+# driver.run options of every job: results are bgzipped
+JOB_OPTIONS = {'compress': True}
+
+# boto3 clients and the DynamoDB table, created once per process on first
+# use (a warm worker reuses them for every job it runs)
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(service):
+  with _clients_lock:
+    if service not in _clients:
+      _clients[service] = boto3.client(service, 
+        region_name=config['aws']['AwsRegionName'])
+    return _clients[service]
+
+def get_ann_table():
+  with _clients_lock:
+    if 'ann_table' not in _clients:
+      dynamodb = boto3.resource('dynamodb', 
+        region_name=config['aws']['AwsRegionName'])
+      _clients['ann_table'] = dynamodb.Table(config['aws']['AnnTableName'])
+    return _clients['ann_table']
+
+def update_job_status(job_id, log_object, annot_object, index_object=None):
+  ann_table = get_ann_table()
   complete_time = int(time.time())
+  update = "set job_status = :s, s3_key_result_file = :r,\
+           s3_key_log_file = :l, s3_results_bucket = :t, complete_time = :c"
+  values = {
+      ':s': "COMPLETED",
+      ':r': annot_object,
+      ':l': log_object,
+      ':t': 'gas_results',
+      ':c': complete_time,
+      ':p': 'RUNNING'
+  }
+  # The tabix index of a sorted result, archived along with it
+  if index_object is not None:
+    update = update + ", s3_key_index_file = :i"
+    values[':i'] = index_object
   try:
       response = ann_table.update_item(
           Key={
               'job_id': job_id
           },
-          UpdateExpression="set job_status = :s, s3_key_result_file = :r,\
-           s3_key_log_file = :l, s3_results_bucket = :t, complete_time = :c",
+          UpdateExpression=update,
           ConditionExpression="job_status = :p",
-          ExpressionAttributeValues={
-              ':s': "COMPLETED",
-              ':r': annot_object,
-              ':l': log_object,
-              ':t': 'gas_results',
-              ':c': complete_time,
-              ':p': 'RUNNING'
-          },
+          ExpressionAttributeValues=values,
           ReturnValues="UPDATED_NEW"
       )
   except ClientError as e:
@@ -49,7 +86,7 @@ def update_job_status(job_id, log_object, annot_object):
       print("UpdateItem succeeded:")
 
 def publish_to_results_sns(job_id, recipients):
-  client = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
+  client = get_client('sns')
   topic_arn = config['aws']['SNSResultsTopicArn']   
   #sqs = boto3.resource('sqs', region_name=config['aws']['AwsRegionName'])
   #queue = sqs.get_queue_by_name(QueueName=config['aws']['SQSQueueName'])
@@ -66,7 +103,7 @@ def publish_to_results_sns(job_id, recipients):
     print("publish to sns results topic failed")
 
 def publish_to_archive_sns(job_id):
-  client = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
+  client = get_client('sns')
   topic_arn = config['aws']['SNSArchiveTopicArn']   
   data = {
       "job_id": job_id
@@ -93,57 +130,123 @@ class Timer(object):
     if self.verbose:
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+"""Annotates input_file with the job's driver.run options and uploads,
+   records and announces the results; run once per interpreter from the
+   command line, or many times by the annotator's warm workers
+"""
+def run_job(input_file, job_id, recipients, user_role, options=None):
+  with Timer():
+    print("input_file " + input_file)
+    steps = []
+    # With sort_input, input is sorted by position first, so results can
+    # be indexed; preserve_order puts them back in the order of the input
+    with Timer(verbose=False) as t:
+      driver.run(input_file, 'vcf', dict(JOB_OPTIONS, **(options or {})))
+    steps.append(('annotate', t.secs))
+    log_file = input_file + '.count.log'
+    log_object = input_file[5:] + '.count.log'
+    # Results are bgzipped, with a tabix index if the input was sorted
+    annot_file = driver.annotFileName(input_file, compress=True)
+    annot_object = annot_file[5:]
+    index_file = bgzf.indexPath(annot_file)
+    index_object = None
+    uploads = [('log file', log_file, log_object), 
+      ('annotated file', annot_file, annot_object)]
+    if index_file is not None:
+      index_object = annot_object + index_file[len(annot_file):]
+      uploads.append(('index of annotated file', index_file, index_object))
+
+    # Upload the log, result and index at once
+    with Timer(verbose=False) as t:
+      uploaded = run_steps([('upload ' + what, upload_file, (path, key)) 
+        for what, path, key in uploads], steps)
+    steps.append(('uploads', t.secs))
+
+    with Timer(verbose=False) as t:
+      for path in [input_file] + [path for what, path, key in uploads]:
+        try:
+          os.remove(path)
+        except:
+          print("Error while deleting file ", path)
+    steps.append(('delete files', t.secs))
+
+    if not all(uploaded):
+      print_steps(steps)
+      raise RuntimeError(f"Results of job {job_id} were not all uploaded")
+    finish_job(job_id, log_object, annot_object, recipients, user_role, steps,
+      index_object)
+
+"""Annotates s3://bucket/key straight into the results bucket, with
+   nothing staged on local disk, then records and announces the results;
+   options are applied as by run_job
+"""
+def run_stream_job(bucket, key, job_id, recipients, user_role, options=None):
+  with Timer():
+    print("key " + key)
+    steps = []
+    # Results are named as for a local copy of the input at
+    # <LocalDir><user>/<file>
+    name = '/'.join(key.split('/')[1:3])
+    log_object = name + '.count.log'
+    annot_object = driver.annotFileName(name, compress=True)
+    with Timer(verbose=False) as t:
+      index_object = s3_stream.annotateObject(get_client('s3'), bucket, key, 
+        config['aws']['ResultBucketName'], annot_object, log_object, 
+        dict(JOB_OPTIONS, **(options or {})))
+    steps.append(('annotate and upload', t.secs))
+    finish_job(job_id, log_object, annot_object, recipients, user_role, steps,
+      index_object)
+
+def upload_file(path, key):
+  try:
+    get_client('s3').upload_file(path, config['aws']['ResultBucketName'], key, 
+      Config=TRANSFER_CONFIG)
+  except ClientError as e:
+    print(f"Can't upload {path} to S3.")
+    return False
+  return True
+
+"""Once the results are uploaded: marks the job completed and announces
+   it, all at once
+"""
+def finish_job(job_id, log_object, annot_object, recipients, user_role, 
+  steps=None, index_object=None):
+  steps = [] if steps is None else steps
+  notices = [('update job status', update_job_status, 
+      (job_id, log_object, annot_object, index_object)), 
+    ('publish results', publish_to_results_sns, (job_id, recipients))]
+  if user_role == "free_user":
+    notices.append(('publish archive', publish_to_archive_sns, (job_id,)))
+  with Timer(verbose=False) as t:
+    run_steps(notices, steps)
+  steps.append(('status and notifications', t.secs))
+  print_steps(steps)
+
+"""Runs (name, function, args) steps on threads, adding each one's time
+   to steps; returns their results in order
+"""
+def run_steps(tasks, steps):
+  def timed(name, function, args):
+    with Timer(verbose=False) as t:
+      result = function(*args)
+    return result, (name, t.secs)
+
+  with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+    results = [f.result() for f in [executor.submit(timed, *task) 
+      for task in tasks]]
+  steps.extend([step for result, step in results])
+  return [result for result, step in results]
+
+def print_steps(steps):
+  print("Step times: " + ", ".join([f"{name} {secs:.2f}s" 
+    for name, secs in steps]))
+
 if __name__ == '__main__':
   # Call the AnnTools pipeline
-  if len(sys.argv) > 1:
-    with Timer():
-      print("sys.argv[1] " + sys.argv[1])
-      driver.run(sys.argv[1], 'vcf')
-      s3_client = boto3.client('s3')
-      bucket = config['aws']['ResultBucketName']
-      log_file = sys.argv[1] + '.count.log'
-      log_object = sys.argv[1][5:] + '.count.log'
-      annot_file = sys.argv[1][:len(sys.argv[1]) - 4] + '.annot.vcf'
-      annot_object = sys.argv[1][5:len(sys.argv[1]) - 4] + '.annot.vcf'
-      job_id = sys.argv[2]
-      recipients = sys.argv[3]
-      user_role = sys.argv[4]
-      #print("log_file " + log_file)
-      #print("annot_file " + annot_file)
-      #print("log_object "+ log_object)
-      #print("annot_object "+ annot_object)
-
-      try:
-        response = s3_client.upload_file(log_file, bucket, log_object)
-      except ClientError as e:
-        print("Can't upload log file to S3.")
-
-      try:
-        response = s3_client.upload_file(annot_file, bucket, annot_object)
-      except ClientError as e:
-        print("Can't upload annotated file to S3.")
-      
-      try:
-        os.remove(sys.argv[1])
-      except:
-        print("Error while deleting file ", sys.argv[1])
-
-      try:
-        os.remove(log_file)
-      except:
-        print("Error while deleting file ", log_file)
-
-      try:
-        os.remove(annot_file)
-      except:
-        print("Error while deleting file ", annot_file)
-      
-      update_job_status(job_id, log_object, annot_object)
-      
-      publish_to_results_sns(job_id, recipients)
-      if user_role == "free_user":
-        publish_to_archive_sns(job_id)
-
+  if len(sys.argv) > 4:
+    run_job(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], 
+      {'sort_input': '--sort' in sys.argv[5:], 
+        'preserve_order': '--preserve-order' in sys.argv[5:]})
   else:
     print("A valid .vcf file must be provided as input to this program.")
 
@@ -0,0 +1,278 @@
+# s3_stream.py
+#
+# Annotates a VCF from S3 to S3 without staging it on local disk: the
+# input object's body is read ahead in chunks while the pipeline runs,
+# and the output goes out as a multipart upload whose parts are sent as
+# they fill
+#
+# Usage: python s3_stream.py <bucket> <key> <result_bucket> <result_key>
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import sys
+import gzip
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import bgzf
+import driver
+import utils as u
+
+"""Bytes read from the input body at a time, and how many reads are
+   held ahead of the pipeline
+"""
+READ_BYTES = 1024 * 1024
+READ_AHEAD = 16
+
+"""Size of each uploaded part (S3 needs at least 5 MiB for all but the
+   last), and how many parts may be uploading at once
+"""
+PART_BYTES = 8 * 1024 * 1024
+UPLOADS = 4
+
+"""Seconds the reader waits to hand over a chunk before checking that
+   the stream is still wanted
+"""
+HANDOFF_SECONDS = 1
+
+
+"""Raw binary stream over an S3 object body (botocore StreamingBody); a
+   thread reads the body ahead, up to READ_AHEAD chunks, so downloading
+   overlaps annotation
+"""
+class BodyReader(io.RawIOBase):
+    def __init__(self, body, read_bytes=READ_BYTES, ahead=READ_AHEAD):
+        self.body = body
+        self.read_bytes = read_bytes
+        self.chunks = queue.Queue(maxsize=ahead)
+        self.current = memoryview(b'')
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fetch, daemon=True)
+        self.thread.start()
+
+    def fetch(self):
+        while not self.stopped.is_set():
+            try:
+                data = self.body.read(self.read_bytes)
+            except Exception as e:
+                data = e
+            while not self.stopped.is_set():
+                try:
+                    self.chunks.put(data, timeout=HANDOFF_SECONDS)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(data, Exception) or (len(data) == 0):
+                return
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while (len(self.current) == 0):
+            if self.finished:
+                return 0
+            data = self.chunks.get()
+            if isinstance(data, Exception):
+                raise data
+            if (len(data) == 0):
+                self.finished = True
+                return 0
+            self.current = memoryview(data)
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.body.close()
+        super(BodyReader, self).close()
+
+
+"""Opens an S3 object body as text, decompressing gzip or bgzip input as
+   it is read
+"""
+def openBody(body, read_bytes=READ_BYTES):
+    stream = io.BufferedReader(BodyReader(body, read_bytes=read_bytes),
+        buffer_size=read_bytes)
+    if stream.peek(len(bgzf.GZIP_MAGIC))[:len(bgzf.GZIP_MAGIC)] == \
+        bgzf.GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream)
+    return io.TextIOWrapper(stream)
+
+
+"""Binary stream written to s3://bucket/key as a multipart upload: each
+   part_bytes written are uploaded on a pool of threads, at most uploads
+   at a time, while writing goes on. close() completes the upload (an
+   output smaller than one part is sent with a single put_object);
+   abort() drops it, and must be called if the output is abandoned.
+"""
+class MultipartUpload(io.RawIOBase):
+    def __init__(self, client, bucket, key, part_bytes=PART_BYTES,
+        uploads=UPLOADS):
+
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = max(part_bytes, 5 * 1024 * 1024)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.aborted = False
+        self.slots = threading.BoundedSemaphore(uploads)
+        self.executor = ThreadPoolExecutor(max_workers=uploads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while (len(self.buffer) >= self.part_bytes):
+            self.send(bytes(self.buffer[:self.part_bytes]))
+            del self.buffer[:self.part_bytes]
+        return len(data)
+
+    def send(self, data):
+        for part in self.parts:
+            if part.done() and (part.exception() is not None):
+                raise part.exception()
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        self.slots.acquire()
+        self.parts.append(self.executor.submit(self.uploadPart,
+            len(self.parts) + 1, data))
+
+    def uploadPart(self, number, data):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket,
+                Key=self.key, UploadId=self.upload_id, PartNumber=number,
+                Body=data)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.aborted:
+                pass
+            elif self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key,
+                    Body=bytes(self.buffer))
+            else:
+                if (len(self.buffer) > 0):
+                    self.send(bytes(self.buffer))
+                self.client.complete_multipart_upload(Bucket=self.bucket,
+                    Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': [part.result()
+                        for part in self.parts]})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            self.executor.shutdown()
+            super(MultipartUpload, self).close()
+
+    def abort(self):
+        self.aborted = True
+        if self.upload_id is None:
+            return
+        for part in self.parts:
+            part.cancel()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket,
+                Key=self.key, UploadId=self.upload_id)
+        except ClientError as e:
+            print(f"Can't abort the upload of s3://{self.bucket}/" + \
+                f"{self.key}: {e}")
+        self.upload_id = None
+
+
+"""Annotates s3://bucket/key into s3://result_bucket/result_key and
+   writes the log to log_key there, with nothing staged on local disk.
+   options are those of driver.run (see driver.OPTIONS); the job runs in
+   one pass in this process, so fused, workers and the shard settings do
+   not apply, and sweep lookups are not used, as the input cannot be
+   checked for order before it is annotated. With options['sort_input'],
+   the input is sorted by position as it is read (runs past sort_bytes
+   spill to spill_dir); with preserve_order as well it is annotated in
+   input order, the order a local job's sorted result is put back in.
+   With options['compress'], the result is BGZF and, if it is sorted, its
+   tabix index is uploaded next to it (result_key + '.tbi' or '.csi').
+   Returns the key of the uploaded index, or None.
+"""
+def annotateObject(client, bucket, key, result_bucket, result_key, log_key,
+    options=None):
+
+    options = dict(driver.jobOptions(options), sweep=False)
+    compress = options['compress']
+    filter_dir = options['filter_dir']
+    cache = driver.cacheSettings(options)
+    filtered = u.db_stats['lookups_filtered']
+
+    fh = openBody(client.get_object(Bucket=bucket, Key=key)['Body'])
+    if options['sort_input'] and not options['preserve_order']:
+        import external_sort
+        fh = external_sort.sortedLines(fh,
+            max_bytes=options['sort_bytes'] or external_sort.SORT_BYTES,
+            spill_dir=options['spill_dir'])
+    upload = MultipartUpload(client, result_bucket, result_key)
+    if compress:
+        fh_out = bgzf.BgzfVcfWriter(None, fh=upload)
+    else:
+        fh_out = io.TextIOWrapper(io.BufferedWriter(upload))
+    try:
+        counts, queries, cache_stats = driver.annotateJob(fh, fh_out, options,
+            cache=cache)
+    except BaseException:
+        upload.abort()
+        fh.close()
+        raise
+
+    fh_log = io.StringIO()
+    driver.writeLogs(fh_log, driver.PIPELINE, counts, cache_stats)
+    if filter_dir is not None:
+        import position_filter
+        position_filter.writeFilterLog(fh_log,
+            u.db_stats['lookups_filtered'] - filtered)
+    client.put_object(Bucket=result_bucket, Key=log_key,
+        Body=fh_log.getvalue().encode('utf-8'))
+
+    index_key = None
+    if compress and fh_out.index.sorted:
+        ext, data = fh_out.index.encode()
+        index_key = result_key + ext
+        client.put_object(Bucket=result_bucket, Key=index_key, Body=data)
+    elif compress:
+        print(f"s3://{bucket}/{key} is not sorted by position; not " + \
+            f"indexing the result")
+
+    print(f"Reference database queries: {queries}")
+    return index_key
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        import boto3
+        annotateObject(boto3.client('s3'), sys.argv[1], sys.argv[2],
+            sys.argv[3], sys.argv[4], sys.argv[4] + '.count.log',
+            {'compress': sys.argv[4].endswith('.gz')})
+    else:
+        print("Usage: python s3_stream.py <bucket> <key> <result_bucket> " + \
+            "<result_key>")
+
+### EOF
@@ -0,0 +1,386 @@
+# snapshot.py
+#
+# Offline snapshots of the annotator reference tables as memory-mapped
+# columnar files, so workers can annotate without the database
+#
+# Usage: python snapshot.py <snapshot_root> [version]
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import json
+import time
+from decimal import Decimal
+
+import numpy as np
+
+import file_utils as fu
+from lookup import REFERENCE_TABLES
+from interval_index import IndexedTable, IndexedLookup, IntervalIndex, \
+    chromKey
+
+"""Layout of a snapshot:
+   <root>/CURRENT                    name of the version workers use
+   <root>/<version>/manifest.json    tables, columns, chromosomes, kinds
+   <root>/<version>/<table>/<chrom dir>/<column>.<ext>
+   Numeric columns are fixed-width little-endian arrays (.i8, .f8); text,
+   binary and decimal columns are a blob (.blob) plus n + 1 uint64
+   offsets (.off); columns with NULLs get a uint8 mask (.null). Each
+   chromosome also gets its interval index, already sorted
+   (_index.starts/ends/maxends/rowids.i8).
+"""
+FIXED_KINDS = {'int': '<i8', 'float': '<f8'}
+BLOB_KINDS = ['str', 'bytes', 'decimal']
+INDEX_ARRAYS = ['starts', 'ends', 'maxends', 'rowids']
+FETCH_ROWS = 100000
+
+"""Snapshots already opened by this process, keyed by path
+"""
+_snapshots = {}
+
+
+def columnKind(value):
+    if isinstance(value, int):
+        return 'int'
+    elif isinstance(value, float):
+        return 'float'
+    elif isinstance(value, Decimal):
+        return 'decimal'
+    elif isinstance(value, str):
+        return 'str'
+    elif isinstance(value, (bytes, bytearray)):
+        return 'bytes'
+    raise ValueError(f"Unsupported column type {type(value).__name__}")
+
+
+def encodeValue(value, kind):
+    if (kind == 'bytes'):
+        return bytes(value)
+    return str(value).encode('utf-8')
+
+
+def decodeValue(data, kind):
+    if (kind == 'bytes'):
+        return bytes(data)
+    elif (kind == 'decimal'):
+        return Decimal(bytes(data).decode('utf-8'))
+    return bytes(data).decode('utf-8')
+
+
+"""Appends the values of one column of one chromosome to its files; the
+   kind is taken from the first non-NULL value
+"""
+class ColumnWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.kind = None
+        self.pending = 0
+        self.has_nulls = False
+        self.fh_null = open(path + '.null', 'wb')
+        self.fh_data = None
+        self.fh_off = None
+        self.offset = 0
+
+    def open(self, kind):
+        self.kind = kind
+        if kind in FIXED_KINDS:
+            self.fh_data = open(self.path + '.' + FIXED_KINDS[kind][1:], 'wb')
+        else:
+            self.fh_data = open(self.path + '.blob', 'wb')
+            self.fh_off = open(self.path + '.off', 'wb')
+            self.fh_off.write(np.array([0], dtype='<u8').tobytes())
+        pending = self.pending
+        self.pending = 0
+        self.write([None] * pending, nulls=False)
+
+    def write(self, values, nulls=True):
+        if nulls:
+            mask = np.array([v is None for v in values], dtype=np.uint8)
+            self.fh_null.write(mask.tobytes())
+            self.has_nulls = self.has_nulls or bool(mask.any())
+
+        if self.kind is None:
+            kinds = [columnKind(v) for v in values if v is not None]
+            if (len(kinds) == 0):
+                self.pending = self.pending + len(values)
+                return
+            self.open(kinds[0])
+
+        for v in values:
+            if (v is not None) and (columnKind(v) != self.kind):
+                raise ValueError(f"{self.path}: mixed column types " + \
+                    f"{self.kind} and {columnKind(v)}")
+
+        if self.kind in FIXED_KINDS:
+            self.fh_data.write(np.array([0 if v is None else v
+                for v in values], dtype=FIXED_KINDS[self.kind]).tobytes())
+        else:
+            offsets = []
+            for v in values:
+                if v is not None:
+                    data = encodeValue(v, self.kind)
+                    self.fh_data.write(data)
+                    self.offset = self.offset + len(data)
+                offsets.append(self.offset)
+            self.fh_off.write(np.array(offsets, dtype='<u8').tobytes())
+
+    def close(self):
+        self.fh_null.close()
+        if not self.has_nulls:
+            fu.delete(self.path + '.null')
+        if self.fh_data is not None:
+            self.fh_data.close()
+        if self.fh_off is not None:
+            self.fh_off.close()
+        return self.kind or 'null'
+
+
+def columnFile(directory, column):
+    return os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', column))
+
+
+def mapArray(path, dtype):
+    if (not fu.isExist(path)) or (fu.fileSize(path) == 0):
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+"""Exports one table, one directory per chromosome, and returns its
+   manifest entry
+"""
+def exportTable(conn, directory, table, chrom_col, start_col, end_col):
+    import pymysql.cursors
+
+    cursor = conn.cursor()
+    if chrom_col is not None:
+        cursor.execute('select distinct ' + chrom_col + ' from ' + table +
+            ' where ' + chrom_col + ' is not null;')
+        chroms = [row[0] for row in cursor.fetchall()]
+    else:
+        chroms = [None]
+
+    info = {'chrom_col': chrom_col, 'start_col': start_col,
+        'end_col': end_col, 'columns': None, 'chroms': {}}
+
+    for n, chrom in enumerate(chroms):
+        dirname = '%03d_%s' % (n, re.sub(r'[^A-Za-z0-9_.-]', '_',
+            str(chrom if chrom is not None else 'all')))
+        chrom_dir = os.path.join(directory, dirname)
+        fu.mkdirp(chrom_dir)
+
+        sql = 'select * from ' + table
+        if chrom_col is not None:
+            sql = sql + ' where ' + chrom_col + '="' + str(chrom) + '"'
+        stream = conn.cursor(pymysql.cursors.SSCursor)
+        stream.execute(sql + ';')
+        columns = [d[0] for d in stream.description]
+        info['columns'] = columns
+
+        writers = [ColumnWriter(columnFile(chrom_dir, c)) for c in columns]
+        rows = 0
+        while True:
+            chunk = stream.fetchmany(FETCH_ROWS)
+            if (len(chunk) == 0):
+                break
+            for i, writer in enumerate(writers):
+                writer.write([row[i] for row in chunk])
+            rows = rows + len(chunk)
+        stream.close()
+        kinds = [writer.close() for writer in writers]
+
+        writeChromIndex(chrom_dir, columns, kinds, start_col, end_col)
+
+        key = chromKey(chrom) if chrom_col is not None else ''
+        info['chroms'][key] = {'dir': dirname, 'rows': rows, 'kinds': kinds}
+
+    return info
+
+
+"""Sorts the chromosome's intervals by start once, at build time
+"""
+def writeChromIndex(chrom_dir, columns, kinds, start_col, end_col):
+    names = [c.lower() for c in columns]
+    bounds = []
+    for col in [start_col, end_col]:
+        i = names.index(col.lower())
+        if kinds[i] not in ['int', 'null']:
+            raise ValueError(f"{col} must be an integer column, " + \
+                f"not {kinds[i]}")
+        path = columnFile(chrom_dir, columns[i])
+        values = mapArray(path + '.i8', '<i8')
+        nulls = mapArray(path + '.null', np.uint8)
+        valid = (nulls == 0) if (len(nulls) > 0) else \
+            np.ones(len(values), dtype=bool)
+        bounds.append((np.asarray(values), valid))
+
+    (starts, start_ok), (ends, end_ok) = bounds
+    rowids = np.nonzero(start_ok & end_ok)[0].astype(np.int64)
+    order = np.argsort(starts[rowids], kind='stable')
+    rowids = rowids[order]
+    starts = starts[rowids]
+    ends = ends[rowids]
+    maxends = np.maximum.accumulate(ends) if (len(ends) > 0) else ends
+
+    for name, array in zip(INDEX_ARRAYS, [starts, ends, maxends, rowids]):
+        np.asarray(array, dtype='<i8').tofile(
+            os.path.join(chrom_dir, '_index.' + name + '.i8'))
+
+
+"""Exports every reference table into <root>/<version> and makes it the
+   current version once it is complete
+"""
+def buildSnapshot(root, version=None, tables=REFERENCE_TABLES, conn=None):
+    import utils as u
+
+    version = version or time.strftime('%Y%m%d%H%M%S')
+    building = os.path.join(root, version + '.building')
+    fu.mkdirp(building)
+
+    close = conn is None
+    if conn is None:
+        conn = u.db_connect()
+
+    manifest = {'version': version, 'created': int(time.time()),
+        'tables': {}}
+    for table, (chrom_col, start_col, end_col) in tables.items():
+        print(f"Exporting {table} . . .")
+        manifest['tables'][table] = exportTable(conn,
+            os.path.join(building, table), table, chrom_col, start_col,
+            end_col)
+
+    if close:
+        conn.close()
+
+    with open(os.path.join(building, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.rename(building, os.path.join(root, version))
+
+    with open(os.path.join(root, 'CURRENT.tmp'), 'w') as fh:
+        fh.write(version + '\n')
+    os.replace(os.path.join(root, 'CURRENT.tmp'),
+        os.path.join(root, 'CURRENT'))
+
+    return version
+
+
+"""Memory-mapped columns and interval index of one chromosome
+"""
+class SnapshotChrom(object):
+    def __init__(self, directory, columns, kinds, rows):
+        self.rows = rows
+        self.kinds = kinds
+        self.columns = []
+        for column, kind in zip(columns, kinds):
+            path = columnFile(directory, column)
+            nulls = mapArray(path + '.null', np.uint8)
+            if kind in FIXED_KINDS:
+                data = (mapArray(path + '.' + FIXED_KINDS[kind][1:],
+                    FIXED_KINDS[kind]), None)
+            elif kind in BLOB_KINDS:
+                data = (mapArray(path + '.blob', np.uint8),
+                    mapArray(path + '.off', '<u8'))
+            else:
+                data = (None, None)
+            self.columns.append((kind, nulls, data))
+
+        index = [mapArray(os.path.join(directory, '_index.' + name + '.i8'),
+            '<i8') for name in INDEX_ARRAYS]
+        self.index = IntervalIndex(index[0], index[1], index[3],
+            maxends=index[2])
+
+    def value(self, column, i):
+        kind, nulls, (data, offsets) = self.columns[column]
+        if (kind == 'null') or ((len(nulls) > 0) and nulls[i]):
+            return None
+        elif (kind == 'int'):
+            return int(data[i])
+        elif (kind == 'float'):
+            return float(data[i])
+        return decodeValue(data[int(offsets[i]):int(offsets[i + 1])], kind)
+
+    def row(self, i):
+        return tuple([self.value(c, i) for c in range(len(self.columns))])
+
+
+"""One table of a snapshot; chromosomes are mapped on first use
+"""
+class SnapshotTable(IndexedTable):
+    def __init__(self, directory, table, info):
+        IndexedTable.__init__(self, table, info['columns'] or [],
+            info['chrom_col'], info['start_col'], info['end_col'])
+        self.directory = directory
+        self.info = info
+        self.chroms = {}
+
+    def chrom(self, key):
+        key = key if (key is not None) else ''
+        if key not in self.chroms:
+            entry = self.info['chroms'].get(key)
+            self.chroms[key] = None if (entry is None) else \
+                SnapshotChrom(os.path.join(self.directory, entry['dir']),
+                    self.info['columns'], entry['kinds'], entry['rows'])
+        return self.chroms[key]
+
+    def chromIndex(self, key):
+        chrom = self.chrom(key)
+        return chrom.index if (chrom is not None) else None
+
+    def row(self, key, rowid):
+        return self.chrom(key).row(rowid)
+
+
+"""A snapshot version opened read-only; behaves as a mapping of table
+   name to SnapshotTable for IndexedLookup
+"""
+class Snapshot(object):
+    def __init__(self, root, version=None):
+        version = version or currentVersion(root)
+        self.path = os.path.join(root, version)
+        with open(os.path.join(self.path, 'manifest.json')) as fh:
+            self.manifest = json.load(fh)
+        self.version = self.manifest['version']
+        self.tables = {}
+
+    def get(self, table):
+        if table not in self.tables:
+            info = self.manifest['tables'].get(table)
+            self.tables[table] = None if (info is None) else \
+                SnapshotTable(os.path.join(self.path, table), table, info)
+        return self.tables[table]
+
+
+def currentVersion(root):
+    with open(os.path.join(root, 'CURRENT')) as fh:
+        return fh.read().strip()
+
+
+def openSnapshot(root, version=None):
+    version = version or currentVersion(root)
+    path = os.path.join(root, version)
+    if path not in _snapshots:
+        _snapshots[path] = Snapshot(root, version)
+    return _snapshots[path]
+
+
+"""Lookup answered entirely from the snapshot; pass inner to fall back to
+   the database for tables the snapshot does not hold
+"""
+def snapshotLookup(root, version=None, inner=None):
+    return IndexedLookup(inner, openSnapshot(root, version))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        version = buildSnapshot(sys.argv[1],
+            sys.argv[2] if len(sys.argv) > 2 else None)
+        print(f"Snapshot {version} written to {sys.argv[1]}")
+    else:
+        print("Usage: python snapshot.py <snapshot_root> [version]")
+
+### EOF
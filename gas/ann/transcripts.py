@@ -0,0 +1,123 @@
+# transcripts.py
+#
+# refGene transcript models with their exons parsed once per worker
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+from lookup import REFERENCE_TABLES
+
+"""refGene columns read by getGenes
+"""
+STRAND = 3
+TX_START = 4
+TX_END = 5
+CDS_START = 6
+CDS_END = 7
+EXON_COUNT = 8
+EXON_STARTS = 9
+EXON_ENDS = 10
+
+"""Transcript caches already built by this process, keyed by table (and
+   snapshot path for caches built from a snapshot)
+"""
+_caches = {}
+
+
+"""Exons of one transcript as int arrays sorted by start, with prefix
+   maxends as in interval_index.IntervalIndex, so the exons holding a
+   position are found in O(log exons)
+"""
+class ExonIndex(object):
+    def __init__(self, starts, ends):
+        order = sorted(range(len(starts)), key=lambda e: starts[e])
+        self.starts = array('q', [starts[e] for e in order])
+        self.ends = array('q', [ends[e] for e in order])
+        self.order = array('q', order)
+        self.maxends = array('q', accumulate(self.ends, max))
+
+    """Exon numbers (0-based, in refGene order) with start <= pos <= end
+    """
+    def overlapping(self, pos):
+        lo = bisect_left(self.maxends, pos)
+        hi = bisect_right(self.starts, pos)
+        return sorted([self.order[i] for i in range(lo, hi)
+            if self.ends[i] >= pos])
+
+
+"""A refGene row carrying its ExonIndex; still a plain tuple to the
+   stages
+"""
+class Transcript(tuple):
+    exons = None
+
+
+def parseExons(row):
+    exonCount = int(row[EXON_COUNT])
+    exonsSt = str(row[EXON_STARTS].decode('utf-8')).split(',')
+    exonsEn = str(row[EXON_ENDS].decode('utf-8')).split(',')
+    return ExonIndex([int(exonsSt[e]) for e in range(0, exonCount)],
+        [int(exonsEn[e]) for e in range(0, exonCount)])
+
+
+def transcript(row):
+    model = Transcript(row)
+    model.exons = parseExons(row)
+    return model
+
+
+"""Numbers of the exons of row that hold pos, counted from the 5' end of
+   the transcript (flipped for the minus strand), in refGene exon order
+"""
+def exonNumbers(row, pos):
+    exons = getattr(row, 'exons', None)
+    if exons is None:
+        exons = parseExons(row)
+
+    exonCount = int(row[EXON_COUNT])
+    if (str(row[STRAND]) == '-'):
+        return [exonCount - e for e in exons.overlapping(pos)]
+    return [e + 1 for e in exons.overlapping(pos)]
+
+
+"""Interval index over the transcripts of table, by chromosome; lookups
+   pass promoter_offset as the query offset, so any window can be asked
+   of the same cache (requires numpy)
+"""
+def transcriptIndex(table, names, rows):
+    from interval_index import TableIndex
+    return TableIndex(table, names, [transcript(row) for row in rows],
+        *REFERENCE_TABLES[table])
+
+
+"""Loads table from the database once per process
+"""
+def loadTranscripts(cursor, table='refGene'):
+    if table not in _caches:
+        cursor.execute('select * from ' + table + ';')
+        names = [d[0] for d in cursor.description]
+        _caches[table] = transcriptIndex(table, names, cursor.fetchall())
+    return _caches[table]
+
+
+"""Loads table from an opened snapshot.Snapshot once per process
+"""
+def snapshotTranscripts(snapshot, table='refGene'):
+    key = (snapshot.path, table)
+    if key not in _caches:
+        source = snapshot.get(table)
+        rows = []
+        for chrom_key, entry in source.info['chroms'].items():
+            chrom = source.chrom(chrom_key)
+            rows.extend([chrom.row(i) for i in range(entry['rows'])])
+        _caches[key] = transcriptIndex(table, source.info['columns'], rows)
+    return _caches[key]
+
+### EOF
@@ -13,39 +13,241 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import atexit
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+"""Counters for the reference database connections of this process:
+   secret_fetches, connections_opened, connections_reused, auth_refreshes,
+   and lookups_filtered (lookups position_filter kept from the database)
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+db_stats = Counter()
+
+"""Seconds the RDS credentials are cached before they are fetched again
+"""
+DB_CREDENTIALS_TTL = int(os.environ.get('DB_CREDENTIALS_TTL', 900))
+
+"""Most connections the pool opens at a time, and how long to wait for
+   one to be returned when they are all in use
+"""
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+DB_POOL_TIMEOUT = 60
+
+"""MySQL error code for a rejected user/password
+"""
+ER_ACCESS_DENIED = 1045
+
+_credentials = {'secret': None, 'fetched': 0}
+_credentials_lock = threading.Lock()
+_lent = threading.local()
+
+
+"""Get RDS credentials from AWS Secrets Manager, cached for
+   DB_CREDENTIALS_TTL seconds unless refresh is set
+"""
+def get_db_credentials(refresh=False):
+    with _credentials_lock:
+        age = time.time() - _credentials['fetched']
+        if refresh or (_credentials['secret'] is None) or \
+            (age > DB_CREDENTIALS_TTL):
+
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            # Get RDS secret from AWS Secrets Manager
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(
+                    SecretId='rds/anntools_database')
+                rds_secret = json.loads(asm_response['SecretString'])
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS " + \
+                    f"Secrets Manager: {e}")
+                raise e
+
+            _credentials['secret'] = rds_secret
+            _credentials['fetched'] = time.time()
+            db_stats['secret_fetches'] += 1
+
+        return _credentials['secret']
+
+
+"""Open a new connection to the reference database; if the cached
+   credentials are rejected (e.g. the secret was rotated) they are
+   fetched again and the connection retried once
+"""
+def db_open():
+    for refresh in [False, True]:
+        rds_secret = get_db_credentials(refresh=refresh)
+
+        # Extract database connection parameters
+        rds_host = rds_secret['host']
+        mysql_port = rds_secret['port']
+        username = rds_secret['username']
+        password = rds_secret['password']
+        database_name = 'annotator'
+
+        try:
+            conn = pymysql.connect(
+                host=rds_host,
+                port=mysql_port,
+                user=username,
+                passwd=password,
+                db=database_name)
+        except pymysql.err.OperationalError as e:
+            if refresh or (e.args[0] != ER_ACCESS_DENIED):
+                raise e
+            db_stats['auth_refreshes'] += 1
+            continue
+
+        db_stats['connections_opened'] += 1
+        return conn
+
+
+"""Process-wide pool of reference database connections. Idle
+   connections are pinged before they are handed out and replaced if
+   the ping fails; at most max_size are open at a time.
+"""
+class ConnectionPool(object):
+    def __init__(self, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle = []
+        self.open = 0
+        self.available = threading.Condition()
+
+    def acquire(self):
+        with self.available:
+            while True:
+                while (len(self.idle) > 0):
+                    conn = self.idle.pop()
+                    if self.healthy(conn):
+                        db_stats['connections_reused'] += 1
+                        return conn
+                    self.discard(conn)
+                if (self.open < self.max_size):
+                    self.open = self.open + 1
+                    break
+                if not self.available.wait(self.timeout):
+                    raise RuntimeError(f"No reference database connection " + \
+                        f"free after {self.timeout}s (pool size {self.max_size})")
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+        try:
+            return db_open()
+        except Exception as e:
+            with self.available:
+                self.open = self.open - 1
+                self.available.notify()
+            raise e
+
+    def release(self, conn):
+        with self.available:
+            self.idle.append(conn)
+            self.available.notify()
+
+    def healthy(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    """Closes a broken connection; the caller holds the pool lock
+    """
+    def discard(self, conn):
+        self.open = self.open - 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.available:
+            while (len(self.idle) > 0):
+                self.discard(self.idle.pop())
+
+    """Drops every connection without closing it, in a child forked from
+       the process that opened them: their sockets are still the
+       parent's, and closing or reusing them would break its sessions
+    """
+    def forget(self):
+        self.idle = []
+        self.open = 0
+        self.available = threading.Condition()
+
+
+db_pool = ConnectionPool()
+atexit.register(db_pool.close)
+
+
+"""A forked child (e.g. of driver.runParallel's process pool) opens its
+   own connections, and locks another thread held at the fork are freed
+"""
+def _after_fork():
+    global _credentials_lock
+    db_pool.forget()
+    _lent.conn = None
+    _credentials_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+"""A pooled connection; close() hands it back to the pool instead of
+   closing it
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn, lent=False):
+        self._pool = pool
+        self._conn = conn
+        self._lent = lent
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._lent or (self._conn is None):
+            return
+        self._pool.release(self._conn)
+        self._conn = None
+
+    def __del__(self):
+        self.close()
+
+
+"""Lends one pooled connection to everything in the with block on this
+   thread: db_connect() returns it (and close() leaves it open), so all
+   stages of a job share a single connection
+"""
+@contextmanager
+def lend_connection(pool=None):
+    pool = pool or db_pool
+    if getattr(_lent, 'conn', None) is not None:
+        yield _lent.conn
+        return
+
+    conn = pool.acquire()
+    _lent.conn = PooledConnection(pool, conn, lent=True)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+        yield _lent.conn
+    finally:
+        _lent.conn = None
+        pool.release(conn)
+
+
+"""Get connection to reference database: the connection lent to this
+   thread if there is one, otherwise one from the pool
+"""
+def db_connect():
+    if getattr(_lent, 'conn', None) is not None:
+        return _lent.conn
+    return PooledConnection(db_pool, db_pool.acquire())
 
 
 """Column inices for pileup and VCF
@@ -0,0 +1,334 @@
+# variant_cache.py
+#
+# Persistent cache of variant annotations shared across jobs
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import sqlite3
+from collections import Counter
+
+from annotate import clean_mysql_chars
+
+"""Default size bound of the cached annotations, in bytes
+"""
+MAX_BYTES = 1024 * 1024 * 1024
+
+"""Keys looked up per statement
+"""
+FETCH_KEYS = 500
+
+"""Fields of a VCF line the stages read besides chrom, pos, ref and alt;
+   ID is always overwritten and the other fields are copied through
+"""
+ID_FIELD = 2
+INFO_FIELD = 7
+
+
+"""Fields of a variant line whose annotation can be cached, or None. The
+   stages only look at chrom, pos, ref and alt, at whether INFO is '.'
+   or ends with ';', and at positionType/name keys in INFO, so lines with
+   such keys (or an INFO that is empty or starts with '.;') always go
+   through the stages.
+"""
+def variantFields(line, sep='\t'):
+    line = line.strip()
+    if line.startswith('#') or line.startswith('CHROM'):
+        return None
+    fields = line.split(sep)
+    if (len(fields) <= INFO_FIELD):
+        return None
+    info = fields[INFO_FIELD]
+    cleaned = clean_mysql_chars(info)
+    if (info == '') or info.startswith('.;') or ('name' in cleaned) or \
+        ('positionType' in cleaned):
+        return None
+    return fields
+
+
+def infoClass(info):
+    if (info == '.'):
+        return '.'
+    return ';' if info.endswith(';') else 'x'
+
+
+"""Key of a variant's annotation. Every stage looks chrom up with or
+   without a 'chr' prefix as its table needs, so the prefix is dropped as
+   by getSnpsFromDbSnpLine; the known_variants artifact is keyed on
+   dbSNP's unprefixed CHR values.
+"""
+def cacheKey(fields):
+    chrom = fields[0].strip()
+    if chrom.startswith('chr'):
+        chrom = chrom.replace('chr', '')
+    return json.dumps([chrom, fields[1], fields[3], fields[4],
+        infoClass(fields[INFO_FIELD])])
+
+
+"""How the stages changed fields into out_lines, or None if out_lines is
+   not the input with a new ID and an annotated INFO: pad is the space
+   gadAll puts before every field after the first, info the whole INFO
+   written for an input INFO of '.', suffix what was appended to any
+   other INFO
+"""
+def annotationTemplate(fields, out_lines):
+    if (len(out_lines) != 1):
+        return None
+    out = out_lines[0].split('\t')
+    if (len(out) != len(fields)):
+        return None
+
+    templates = []
+    for pad in ['', ' ']:
+        copied = all([out[i] == (pad if i > 0 else '') + fields[i]
+            for i in range(len(fields)) if i not in [ID_FIELD, INFO_FIELD]])
+        if not (copied and out[ID_FIELD].startswith(pad) and
+            out[INFO_FIELD].startswith(pad)):
+            continue
+        info = out[INFO_FIELD][len(pad):]
+        template = {'pad': pad, 'id': out[ID_FIELD][len(pad):]}
+        if (fields[INFO_FIELD] == '.'):
+            template['info'] = info
+        elif info.startswith(fields[INFO_FIELD]):
+            template['suffix'] = info[len(fields[INFO_FIELD]):]
+        else:
+            continue
+        templates.append(template)
+
+    return templates[0] if (len(templates) == 1) else None
+
+
+def renderTemplate(fields, template):
+    pad = template['pad']
+    out = [fields[0]] + [pad + f for f in fields[1:]]
+    out[ID_FIELD] = pad + template['id']
+    if 'info' in template:
+        out[INFO_FIELD] = pad + template['info']
+    else:
+        out[INFO_FIELD] = pad + fields[INFO_FIELD] + template['suffix']
+    return '\t'.join(out)
+
+
+"""SQLite store of annotation templates and the stage counters of each
+   variant, bounded to max_bytes by evicting the least recently used.
+   The store belongs to one reference version (snapshot version plus the
+   pipeline signature); opening it with another version empties it.
+   A readonly store (e.g. the known_variants artifact) is only read and
+   must have been built for version.
+   stats: lookups, hits, bytes_saved, stored, evicted, invalidated
+"""
+class VariantCache(object):
+    def __init__(self, path, version, max_bytes=MAX_BYTES, readonly=False):
+        self.path = path
+        self.version = version
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.stats = Counter({'lookups': 0, 'hits': 0, 'bytes_saved': 0})
+
+        if readonly:
+            if (storedVersion(path) != version):
+                raise ValueError(f"{path} was built for reference version " + \
+                    f"{storedVersion(path)}, not {version}")
+            self.conn = sqlite3.connect('file:' + path + '?mode=ro', 
+                uri=True, check_same_thread=False)
+            return
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('pragma journal_mode=wal;')
+        with self.conn:
+            self.conn.execute('create table if not exists entries (' +
+                'key text primary key, value text, bytes integer, ' +
+                'used real);')
+            self.conn.execute('create index if not exists entries_used ' +
+                'on entries (used);')
+            self.conn.execute('create table if not exists meta (' +
+                'name text primary key, value text);')
+            self.conn.execute('insert or ignore into meta values ' +
+                '("bytes", "0");')
+            row = self.conn.execute('select value from meta where ' +
+                'name="version";').fetchone()
+            if (row is None) or (row[0] != version):
+                self.conn.execute('delete from entries;')
+                self.conn.execute('update meta set value="0" where ' +
+                    'name="bytes";')
+                self.conn.execute('insert or replace into meta values ' +
+                    '("version", ?);', (version,))
+                if row is not None:
+                    self.stats['invalidated'] += 1
+
+    """For each line, (annotated lines, counters per stage) if it is cached,
+       otherwise None
+    """
+    def fetch(self, lines):
+        variants = [variantFields(line) for line in lines]
+        keys = [cacheKey(f) if f is not None else None for f in variants]
+        wanted = list(set([k for k in keys if k is not None]))
+
+        values = {}
+        for i in range(0, len(wanted), FETCH_KEYS):
+            batch = wanted[i:i + FETCH_KEYS]
+            for key, value in self.conn.execute('select key, value from ' +
+                'entries where key in (' + ','.join(['?'] * len(batch)) +
+                ');', batch):
+                values[key] = json.loads(value)
+
+        found = []
+        for fields, key in zip(variants, keys):
+            if key is None:
+                found.append(None)
+                continue
+            self.stats['lookups'] += 1
+            if key not in values:
+                found.append(None)
+                continue
+            template, counts = values[key]
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += len(template['id']) + \
+                len(template.get('info', template.get('suffix')))
+            found.append(([renderTemplate(fields, template)],
+                [Counter(c) for c in counts]))
+
+        if (len(values) > 0) and (not self.readonly):
+            with self.conn:
+                self.conn.executemany('update entries set used=? where ' +
+                    'key=?;', [(time.time(), key) for key in values])
+        return found
+
+    """Stores the annotations of lines (out_lines and counters per stage
+       for each line) that can be cached
+    """
+    def store(self, lines, groups, counts):
+        if self.readonly:
+            return
+        entries = {}
+        for line, out_lines, line_counts in zip(lines, groups, counts):
+            fields = variantFields(line)
+            if fields is None:
+                continue
+            template = annotationTemplate(fields, out_lines)
+            if template is None:
+                continue
+            entries[cacheKey(fields)] = json.dumps([template,
+                [dict(c) for c in line_counts]])
+
+        if (len(entries) == 0):
+            return
+
+        now = time.time()
+        with self.conn:
+            added = 0
+            for key, value in entries.items():
+                cursor = self.conn.execute('insert or ignore into entries ' +
+                    'values (?, ?, ?, ?);', (key, value, len(value), now))
+                if (cursor.rowcount > 0):
+                    added = added + len(value)
+                    self.stats['stored'] += 1
+            self.conn.execute('update meta set value=cast(value as integer)' +
+                ' + ? where name="bytes";', (added,))
+            self.evict()
+
+    """Drops the least recently used entries once the store is over
+       max_bytes, down to 90% of it
+    """
+    def evict(self):
+        total = int(self.conn.execute('select value from meta where ' +
+            'name="bytes";').fetchone()[0])
+        if (total <= self.max_bytes):
+            return
+
+        target = int(self.max_bytes * 0.9)
+        while (total > target):
+            rows = self.conn.execute('select key, bytes from entries ' +
+                'order by used limit 1000;').fetchall()
+            if (len(rows) == 0):
+                break
+            for key, size in rows:
+                if (total <= target):
+                    break
+                self.conn.execute('delete from entries where key=?;', (key,))
+                total = total - size
+                self.stats['evicted'] += 1
+        self.conn.execute('update meta set value=? where name="bytes";',
+            (str(max(total, 0)),))
+
+    def close(self):
+        self.conn.close()
+
+
+"""Version a store was built for, or None
+"""
+def storedVersion(path):
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect('file:' + path + '?mode=ro', uri=True)
+    try:
+        row = conn.execute('select value from meta where ' +
+            'name="version";').fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    conn.close()
+    return row[0] if (row is not None) else None
+
+
+"""Caches consulted in order, each only for the lines the ones before it
+   did not have; annotations of lines none had are stored in all of them
+   (readonly ones ignore them). stats sums their counters, with those of
+   readonly caches (the known_variants artifact) under known_, as in
+   known_lookups.
+"""
+class CacheChain(object):
+    def __init__(self, caches):
+        self.caches = caches
+
+    @property
+    def stats(self):
+        stats = Counter()
+        for cache in self.caches:
+            for key, value in cache.stats.items():
+                stats[('known_' if cache.readonly else '') + key] += value
+        return stats
+
+    def fetch(self, lines):
+        found = [None] * len(lines)
+        for cache in self.caches:
+            misses = [i for i, hit in enumerate(found) if hit is None]
+            if (len(misses) == 0):
+                break
+            for i, hit in zip(misses, cache.fetch([lines[i] for i in misses])):
+                found[i] = hit
+        return found
+
+    def store(self, lines, groups, counts):
+        for cache in self.caches:
+            cache.store(lines, groups, counts)
+
+    def close(self):
+        for cache in self.caches:
+            cache.close()
+
+
+"""Log lines for the cache counters of a job
+"""
+def writeCacheLog(fh_log, stats):
+    if ('known_lookups' in stats):
+        lookups = stats['known_lookups']
+        ratio = (stats['known_hits'] / float(lookups)) * 100 if \
+            (lookups > 0) else 0.0
+        fh_log.write(f"Precomputed annotations used: " + \
+            f"{str(stats['known_hits'])} of {str(lookups)} ({str(ratio)}%)\n")
+    if ('lookups' in stats):
+        lookups = stats['lookups']
+        ratio = (stats['hits'] / float(lookups)) * 100 if \
+            (lookups > 0) else 0.0
+        fh_log.write(f"Annotation cache hits: {str(stats['hits'])} of " + \
+            f"{str(lookups)} ({str(ratio)}%)\n")
+        fh_log.write(f"Annotation cache bytes saved: " + \
+            f"{str(stats['bytes_saved'])}\n")
+
+### EOF
@@ -0,0 +1,383 @@
+# vcf_batch.py
+#
+# Columnar batches of VCF records: a chunk is parsed once into NumPy
+# columns, the dbSNP, overlap and getGenes stages run over the whole batch
+# and the records are written back to VCF text once, after the last stage
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import re
+from collections import Counter
+
+import numpy as np
+
+import annotate as ann
+import utils as u
+from driver import splitAnnotatedLines
+from lookup import Query
+from transcripts import EXON_COUNT
+
+"""INFO field of a record
+"""
+INFO_FIELD = 7
+
+"""Characters the per-line stages would split a record on; a record that
+   gets one is handed back to them as text
+"""
+UNSAFE = re.compile('[\t\n\r]')
+
+
+"""Records of a chunk as columns: chrom holds small codes into
+   chrom_names, pos_text and pos the stripped and numeric POS, ref and
+   alt the cleaned bases as fixed-width bytes. INFO is kept as the list
+   of parts written to it, joined only when the record is rendered.
+   Headers and lines too short to be records stay raw: they, and any
+   record that takes text the columns cannot hold, go through the
+   per-line stage functions instead.
+"""
+class VariantBatch(object):
+    def __init__(self, lines):
+        self.size = len(lines)
+        self.raw = [None] * self.size
+        self.fields = [None] * self.size
+        self.info = [None] * self.size
+        for i, line in enumerate(lines):
+            self.absorb(i, line.strip())
+        self.index()
+
+    """Takes what a per-line stage made of record i back into the batch
+    """
+    def absorb(self, i, text):
+        fields = text.split('\t')
+        if ('\n' in text) or ('\r' in text) or text.startswith('#') or \
+            text.startswith('CHROM') or (len(fields) <= INFO_FIELD) or \
+            (text != text.strip()):
+            self.raw[i] = splitAnnotatedLines([text])
+            self.fields[i] = None
+            self.info[i] = None
+            return
+        self.raw[i] = None
+        self.fields[i] = fields
+        self.info[i] = [fields[INFO_FIELD]]
+
+    """Rebuilds the columns from the fields of the columnar records
+    """
+    def index(self):
+        codes = {}
+        chrom = np.full(self.size, -1, dtype=np.int32)
+        pos = np.full(self.size, -1, dtype=np.int64)
+        self.pos_text = [None] * self.size
+        ref = [b''] * self.size
+        alt = [b''] * self.size
+        for i in self.records():
+            fields = self.fields[i]
+            chrom[i] = codes.setdefault(fields[0].strip(), len(codes))
+            self.pos_text[i] = fields[1].strip()
+            if self.pos_text[i].isdigit():
+                pos[i] = int(self.pos_text[i])
+            ref[i] = ann.clean_mysql_chars(fields[3]).strip().encode('utf-8')
+            alt[i] = ann.clean_mysql_chars(fields[4]).strip().encode('utf-8')
+        self.chrom = chrom
+        self.chrom_names = list(codes)
+        self.pos = pos
+        self.ref = np.array(ref, dtype='S')
+        self.alt = np.array(alt, dtype='S')
+
+    """Indices of the records held as columns
+    """
+    def records(self, mask=None):
+        columnar = np.array([raw is None for raw in self.raw], dtype=bool)
+        if mask is not None:
+            columnar = columnar & mask
+        return np.flatnonzero(columnar)
+
+    def line(self, i):
+        fields = self.fields[i]
+        return '\t'.join(fields[:INFO_FIELD] + [''.join(self.info[i])] +
+            fields[INFO_FIELD + 1:])
+
+    def infoText(self, i):
+        return ''.join(self.info[i])
+
+    """Puts prefix before every field but the first, as a stage joining
+       the fields with '\t' + prefix does
+    """
+    def pad(self, i, prefix):
+        fields = self.fields[i]
+        for f in range(1, len(fields)):
+            if (f != INFO_FIELD):
+                fields[f] = prefix + fields[f]
+        self.info[i][0] = prefix + self.info[i][0]
+
+    """Hands record i back as text if what a stage wrote to it (written)
+       would split it or leave whitespace at the end of the line
+    """
+    def check(self, i, written):
+        last = self.infoText(i) if (len(self.fields[i]) == INFO_FIELD + 1) \
+            else self.fields[i][-1]
+        if any([UNSAFE.search(text) for text in written]) or \
+            last[-1:].isspace():
+            self.absorb(i, self.line(i))
+
+    """Lines each input line became, as driver.annotateLines returns them
+    """
+    def render(self):
+        return [raw if raw is not None else [self.line(i)] for i, raw in
+            enumerate(self.raw)]
+
+
+"""Column views of the dbSNP stage: the chrom looked up for each chrom
+   code and the complement of each reference base, compared as a column
+"""
+def dbSnpColumns(batch, varclass='SNV', **kwargs):
+    chroms = [c.replace('chr', '') if c.startswith('chr') else c
+        for c in batch.chrom_names]
+    complement = np.zeros(batch.size, dtype='S1')
+    for nuc, comp in [(b'A', b'T'), (b'T', b'A'), (b'G', b'C'), (b'C', b'G')]:
+        complement[batch.ref == nuc] = comp
+    return chroms, complement, varclass, batch.records()
+
+
+def dbSnpRows(batch, columns, i, db):
+    chroms, complement, varclass, records = columns
+    return db.fetchall(ann.dbSnpQuery(chroms[batch.chrom[i]],
+        batch.pos_text[i], batch.ref[i].decode('utf-8'),
+        complement[i].decode('utf-8'), varclass))
+
+
+def dbSnpApply(batch, columns, records, found, db, counts):
+    chroms, complement, varclass, lookups = columns
+    for i, rows in zip(records, found):
+        fields = batch.fields[i]
+        fields[2] = '.'
+        if (len(rows) > 0):
+            rsids, maf_str = ann.dbSnpRecords(rows)
+            counts[i]['var_count'] += 1
+            if (batch.infoText(i) == '.'):
+                batch.info[i] = ['DB' + maf_str]
+            else:
+                batch.info[i].append(';DB;VC=' + varclass + maf_str)
+            fields[2] = rsids
+            batch.check(i, [rsids, batch.info[i][-1]])
+        counts[i]['linenum'] += 1
+
+
+"""Column views of an overlap stage: its spec and, for each chrom code,
+   the chrom looked up and the table read (None for none), with the
+   records on a chrom that has a table
+"""
+def overlapColumns(batch, table='', spec=None, **kwargs):
+    spec = spec or ann.OVERLAP_SPECS[table]
+    targets = [ann.overlapTarget(spec, c) for c in batch.chrom_names]
+    has_table = np.array([t is not None for c, t in targets] + [False],
+        dtype=bool)
+    return spec, targets, batch.records(has_table[batch.chrom])
+
+
+def overlapRows(batch, columns, i, db):
+    spec, targets, records = columns
+    chrom, table = targets[batch.chrom[i]]
+    return ann.overlapRows(spec, db, table, chrom, batch.pos_text[i])
+
+
+def overlapApply(batch, columns, records, found, db, counts):
+    spec, targets, lookups = columns
+    for i, rows in zip(records, found):
+        if (len(rows) == 0):
+            continue
+        counts[i]['line_count'] += 1
+        counts[i]['var_count'] += len(rows)
+
+        text = ann.overlapRecords(spec, rows)
+        if not (batch.infoText(i).endswith(';') and not spec.always_sep):
+            text = ';' + text
+        batch.info[i].append(text)
+        batch.pad(i, spec.field_sep[1:])
+        batch.check(i, [text])
+
+
+"""Column views of the getGenes stage: the chrom looked up for each chrom
+   code and the stage's settings
+"""
+def genesColumns(batch, table='refGene', promoter_offset=500, **kwargs):
+    chroms = [c if c.startswith('chr') else 'chr' + c
+        for c in batch.chrom_names]
+    return chroms, table, promoter_offset, batch.records()
+
+
+def genesRows(batch, columns, i, db):
+    chroms, table, promoter_offset, lookups = columns
+    return db.fetchall(Query(table, 'chrom', chroms[batch.chrom[i]],
+        batch.pos_text[i], 'txStart', 'txEnd', offset=promoter_offset))
+
+
+def islandQuery(chrom, pos):
+    return Query('cpgIslandExt', 'chrom', chrom, pos,
+        columns='chrom, chromStart, chromEnd, name')
+
+
+"""Classifies every (record, transcript) pair of the batch at once with
+   consequence.classify, looks up the CpG islands of the promoter pairs
+   and writes each record as getGenesLine would
+"""
+def genesApply(batch, columns, records, found, db, counts):
+    import consequence as cq
+
+    chroms, table, promoter_offset, lookups = columns
+    infos = []
+    for i in records:
+        info_field = ann.clean_mysql_chars(batch.infoText(i)).strip()
+        # Unused, but parsed as getGenesLine does so an INFO entry with
+        # 'name' and no '=' raises the same IndexError here
+        u.parse_field(info_field, 'name', ';', '=')
+        infos.append(str(u.parse_field(info_field, 'positionType', ';', '=')))
+
+    pairs = [(i, row) for i, rows in zip(records, found) for row in rows]
+    positions = [int(batch.pos_text[i]) for i, row in pairs]
+    labels, offsets, numbers = cq.classify(positions, cq.transcriptArrays(
+        [row for i, row in pairs]), promoter_offset=int(promoter_offset),
+        utr=False)
+
+    promoters = np.flatnonzero(labels == cq.PROMOTER)
+    queries = dict([(k, islandQuery(chroms[batch.chrom[pairs[k][0]]],
+        positions[k])) for k in promoters])
+
+    def lookup(k, db, counts):
+        return db.fetchone(queries[k])
+
+    db.prefetch(ann.Stage('cpgIslandExt', lookup, ann.writeNoLog, {}),
+        list(promoters))
+    islands = dict([(k, db.fetchone(queries[k])) for k in promoters])
+
+    k = 0
+    for i, rows, positionType in zip(records, found, infos):
+        if (len(rows) == 0):
+            text = ';positionType=interGenic'
+            counts[i]['interGenic_count'] += 1
+        else:
+            if positionType in ann.POSITION_TYPE_COUNTS:
+                counts[i][ann.POSITION_TYPE_COUNTS[positionType]] += len(rows)
+            info = []
+            for cnt, row in enumerate(rows, 1):
+                region = genesRegion(row, labels[k], numbers[offsets[k]:
+                    offsets[k + 1]], islands.get(k), counts[i])
+                if (region != ''):
+                    info.append(ann.collapseGeneNames(row=row,
+                        indices=ann.indicesKnownGenes, region=region, cnt=cnt))
+                k = k + 1
+            text = ';' + ';'.join(info)
+        batch.info[i].append(text)
+        batch.check(i, [text])
+
+
+"""What getGenesLine writes for one transcript of a variant
+"""
+def genesRegion(row, label, numbers, island, counts):
+    import consequence as cq
+
+    exonCount = str(int(row[EXON_COUNT]))
+    if (label == cq.NON_CODING_EXON):
+        return ';'.join(["non_coding_exon=ex" + str(n) + '/' + exonCount
+            for n in numbers])
+    if (label == cq.CDS_EXON):
+        counts['exonic_count'] += len(numbers)
+        return ';'.join(["exon=ex" + str(n) + '/' + exonCount
+            for n in numbers])
+    if (label == cq.PROMOTER) and (island is not None):
+        counts['promoter_count'] += 1
+        return 'putativePromoterRegion=' + "".join(str(island[3]).split())
+    return ''
+
+
+"""Stages run over whole batches: line function -> (columns, rows,
+   apply). columns(batch, **kwargs) computes what the stage needs from
+   the columns, including the records it looks up; rows(batch, columns,
+   i, db) only reads from db, so it can be replayed by prefetch; apply(
+   batch, columns, records, found, db, counts) writes each of records,
+   given the rows found for it, as the line function would.
+"""
+BATCH_STAGES = {
+    ann.getSnpsFromDbSnpLine: (dbSnpColumns, dbSnpRows, dbSnpApply),
+    ann.addOverlapLine: (overlapColumns, overlapRows, overlapApply),
+    ann.getGenesLine: (genesColumns, genesRows, genesApply),
+}
+
+
+def batchStage(stage):
+    if (stage.kwargs.get('sep', '\t') != '\t'):
+        return None
+    if (stage.annotateLine in [ann.getSnpsFromDbSnpLine, ann.getGenesLine]) \
+        and (stage.kwargs.get('format', 'vcf') != 'vcf'):
+        return None
+    if (stage.annotateLine == ann.addOverlapLine) and not (stage.kwargs.get(
+        'spec') or ann.OVERLAP_SPECS[stage.kwargs.get('table', '')]
+        ).field_sep.startswith('\t'):
+        return None
+    return BATCH_STAGES.get(stage.annotateLine)
+
+
+"""Runs every stage over a chunk of lines as one VariantBatch; returns
+   the lines each input line became and its counters for each stage,
+   like driver.annotateLines. Stages without a batch form run line by
+   line over the rendered records, which are then taken back.
+"""
+def annotateBatch(lines, stages, db):
+    batch = VariantBatch(lines)
+    counts = [[Counter() for stage in stages] for line in lines]
+
+    for k, stage in enumerate(stages):
+        functions = batchStage(stage)
+        if functions is None:
+            annotateLines(batch, stage, db, [c[k] for c in counts])
+            continue
+
+        columns, rows, apply = functions
+        views = columns(batch, **stage.kwargs)
+        raw = [i for i in range(batch.size) if batch.raw[i] is not None]
+        order = sorted([int(i) for i in views[-1]] + raw)
+
+        def lookup(i, db, counts):
+            if batch.raw[i] is None:
+                rows(batch, views, i, db)
+            else:
+                for line in batch.raw[i]:
+                    stage.annotateLine(line, db, counts, **stage.kwargs)
+            return ''
+
+        db.prefetch(ann.Stage(stage.name, lookup, ann.writeNoLog, {}), order)
+        records = []
+        found = []
+        for i in order:
+            if batch.raw[i] is None:
+                records.append(i)
+                found.append(rows(batch, views, i, db))
+            else:
+                batch.raw[i] = splitAnnotatedLines([stage.annotateLine(line,
+                    db, counts[i][k], **stage.kwargs) for line in batch.raw[i]])
+        apply(batch, views, records, found, db, [c[k] for c in counts])
+        db.release()
+
+    return batch.render(), counts
+
+
+"""Runs a stage line by line over every record of batch, as rendered so
+   far, and takes the results back into the batch
+"""
+def annotateLines(batch, stage, db, counts):
+    groups = batch.render()
+    db.prefetch(stage, [line for group in groups for line in group])
+    for i, group in enumerate(groups):
+        group = splitAnnotatedLines([stage.annotateLine(line, db, counts[i],
+            **stage.kwargs) for line in group])
+        if (batch.raw[i] is None) and (len(group) == 1):
+            batch.absorb(i, group[0])
+        else:
+            batch.raw[i] = group
+    db.release()
+    batch.index()
+
+### EOF
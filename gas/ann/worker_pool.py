@@ -0,0 +1,313 @@
+# worker_pool.py
+#
+# Long-lived annotation workers forked from a server process that has
+# already imported boto3, pymysql and the annotation modules; each job is
+# handed to a free worker over that worker's own pipe instead of starting
+# an interpreter per job
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import atexit
+import pickle
+import itertools
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+
+"""Modules the fork server imports once, so every worker starts with
+   them loaded; modules that are not installed are skipped. The main
+   module is imported as it is for spawned processes, so what it runs
+   must be guarded by if __name__ == '__main__'.
+"""
+PRELOAD = ['__main__', 'boto3', 'botocore', 'pymysql', 'numpy', 'utils',
+    'lookup', 'annotate', 'interval_index', 'transcripts', 'vcf_batch',
+    'consequence', 'bgzf', 'external_sort', 'driver', 'run']
+
+"""Jobs a worker runs before it is replaced, bounding what a long-lived
+   process can accumulate
+"""
+JOBS_PER_WORKER = 200
+
+"""Seconds the pool's collector waits for a worker to finish a job or
+   exit before checking whether the pool has closed
+"""
+POLL_SECONDS = 1
+
+
+"""Readies a new worker before its first job: opens a reference database
+   connection and leaves it idle in the process's pool; with indexed, also
+   loads the interval indexes and transcript cache, and with snapshot_dir
+   opens the current snapshot, so jobs using them find them loaded
+"""
+def warmWorker(connect=True, indexed=False, snapshot_dir=None):
+    import utils as u
+    import transcripts
+    if connect or indexed:
+        try:
+            conn = u.db_pool.acquire()
+        except Exception as e:
+            print(f"Worker {os.getpid()} could not open a reference " + \
+                f"database connection: {e}")
+            return
+        try:
+            if indexed:
+                import interval_index
+                interval_index.loadIndexes(conn.cursor())
+                transcripts.loadTranscripts(conn.cursor())
+        finally:
+            u.db_pool.release(conn)
+
+    if snapshot_dir is not None:
+        import snapshot
+        version = snapshot.currentVersion(snapshot_dir)
+        transcripts.snapshotTranscripts(snapshot.openSnapshot(snapshot_dir,
+            version))
+
+
+"""Worker loop: runs the pickled (func, args) jobs the pool sends down
+   conn until it sends an empty stop marker (or goes away) or
+   jobs_per_worker have run, answering each with (seconds, error)
+"""
+def serve(conn, warm, jobs_per_worker):
+    if warm is not None:
+        warmWorker(**warm)
+
+    done = 0
+    while (jobs_per_worker is None) or (done < jobs_per_worker):
+        try:
+            job = conn.recv_bytes()
+        except EOFError:
+            return
+        if (len(job) == 0):
+            return
+        start = time.time()
+        error = None
+        try:
+            func, args = pickle.loads(job)
+            func(*args)
+        except Exception:
+            error = traceback.format_exc()
+        sys.stdout.flush()
+        conn.send((time.time() - start, error))
+        done = done + 1
+
+
+"""A worker process, the pool's end of its pipe, the ticket of the job
+   it was sent (None while it is free), how many it has been sent and
+   whether it has been told to stop
+"""
+class Worker(object):
+    def __init__(self, proc, conn):
+        self.proc = proc
+        self.conn = conn
+        self.ticket = None
+        self.jobs = 0
+        self.stopped = False
+
+
+"""Pool of warm worker processes running functions of preloaded modules.
+   submit() queues func(*args) and returns at once; callback(ticket,
+   seconds, error) is called when the job finishes, with error the
+   traceback of a failed job (or a note that its worker died). A job is
+   recorded against its worker before it is sent, so it is failed back
+   to its callback whatever point the worker dies at; workers that exit
+   are replaced. start_method is 'forkserver' (workers forked from a
+   clean server that only ran PRELOAD) or 'fork' (forked from this
+   process, sharing what it has loaded). Workers are not daemons, so jobs
+   may start processes of their own (driver.run with workers > 1); if
+   the pool is not closed, they are terminated at exit.
+"""
+class WorkerPool(object):
+    def __init__(self, workers=None, warm=None,
+        jobs_per_worker=JOBS_PER_WORKER, start_method='forkserver'):
+
+        if start_method not in ['forkserver', 'fork']:
+            raise ValueError(f"Workers must be started by fork or " + \
+                f"forkserver, not {start_method}")
+        self.context = multiprocessing.get_context(start_method)
+        if (start_method == 'forkserver'):
+            self.context.set_forkserver_preload(PRELOAD)
+        self.size = workers or os.cpu_count() or 1
+        self.warm = warm
+        self.jobs_per_worker = jobs_per_worker
+        self.tickets = itertools.count(1)
+        self.lock = threading.RLock()
+        self.queued = deque()
+        self.workers = {}
+        self.callbacks = {}
+        self.closed = False
+
+        with self.lock:
+            for i in range(self.size):
+                self.spawn()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+        atexit.register(self.terminate)
+
+    def spawn(self):
+        conn, child_conn = self.context.Pipe()
+        proc = self.context.Process(target=serve, args=(child_conn,
+            self.warm, self.jobs_per_worker), daemon=False)
+        proc.start()
+        child_conn.close()
+        self.workers[proc.pid] = Worker(proc, conn)
+
+    """Queues func(*args) for the next free worker; func must be a
+       module-level function so it can be sent to the worker by name
+    """
+    def submit(self, func, args=(), callback=None):
+        job = pickle.dumps((func, tuple(args)))
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Worker pool is closed")
+            ticket = next(self.tickets)
+            self.callbacks[ticket] = callback
+            self.queued.append((ticket, job))
+            self.assign()
+        return ticket
+
+    """Jobs submitted but not yet finished
+    """
+    def pending(self):
+        with self.lock:
+            return len(self.callbacks)
+
+    """Sends queued jobs to free workers, each recorded against its
+       worker first; once the pool is closed and nothing is queued, free
+       workers are sent the stop marker
+    """
+    def assign(self):
+        with self.lock:
+            for pid, worker in list(self.workers.items()):
+                if (worker.ticket is not None) or worker.stopped or \
+                    ((self.jobs_per_worker is not None) and
+                    (worker.jobs >= self.jobs_per_worker)):
+                    continue
+                if (len(self.queued) == 0):
+                    if self.closed:
+                        worker.stopped = True
+                        self.send(worker, b'')
+                    continue
+                worker.ticket, job = self.queued.popleft()
+                worker.jobs = worker.jobs + 1
+                self.send(worker, job)
+
+    """Sends to a worker; one that has gone is left for the collector to
+       retire, failing the job it was given
+    """
+    def send(self, worker, data):
+        try:
+            worker.conn.send_bytes(data)
+        except OSError:
+            pass
+
+    def collect(self):
+        while True:
+            with self.lock:
+                if self.closed and (len(self.workers) == 0):
+                    return
+                workers = list(self.workers.values())
+            ready = wait([w.conn for w in workers] +
+                [w.proc.sentinel for w in workers], POLL_SECONDS)
+            for worker in workers:
+                if worker.conn in ready:
+                    self.receive(worker)
+                elif worker.proc.sentinel in ready:
+                    self.retire(worker)
+
+    """Handles what a worker sent; a worker whose pipe has closed has
+       exited
+    """
+    def receive(self, worker):
+        try:
+            seconds, error = worker.conn.recv()
+        except (EOFError, OSError):
+            self.retire(worker)
+            return
+        with self.lock:
+            ticket = worker.ticket
+            worker.ticket = None
+        self.finish(ticket, seconds, error)
+        self.assign()
+
+    """Removes a worker that exited, after handling whatever it sent
+       first; the job it was given, if any, is reported failed. It is
+       replaced unless the pool is closed with nothing left to run.
+    """
+    def retire(self, worker):
+        while True:
+            try:
+                if not worker.conn.poll():
+                    break
+                seconds, error = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                ticket = worker.ticket
+                worker.ticket = None
+            self.finish(ticket, seconds, error)
+
+        worker.proc.join()
+        worker.conn.close()
+        with self.lock:
+            if self.workers.pop(worker.proc.pid, None) is None:
+                return
+            ticket = worker.ticket
+            worker.ticket = None
+        if ticket is not None:
+            self.finish(ticket, None, f"Worker {worker.proc.pid} exited " + \
+                f"with code {worker.proc.exitcode} while running the job")
+        with self.lock:
+            if not (self.closed and (len(self.queued) == 0)):
+                self.spawn()
+            self.assign()
+
+    def finish(self, ticket, seconds, error):
+        with self.lock:
+            if ticket not in self.callbacks:
+                return
+            callback = self.callbacks.pop(ticket)
+        if callback is not None:
+            try:
+                callback(ticket, seconds, error)
+            except Exception:
+                traceback.print_exc()
+
+    """Lets the queued jobs finish, then stops the workers
+    """
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.assign()
+        self.collector.join()
+
+    """Stops the workers at once, failing the jobs they were running and
+       dropping those still queued
+    """
+    def terminate(self):
+        with self.lock:
+            self.closed = True
+            self.queued.clear()
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.proc.terminate()
+        self.collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+### EOF
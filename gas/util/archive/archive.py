@@ -46,6 +46,8 @@ def go():
                 )
                 item = response['Items'][0]
                 result_file_name = item['s3_key_result_file']
+                # Sorted results have a tabix index next to them
+                index_file_name = item.get('s3_key_index_file')
             except ClientError as e:
                 print("Query from dynamodb failed: " + str(e))
 
@@ -67,13 +69,18 @@ def go():
             except ClientError as e: 
                 print("Failed to upload the result file to Glacier: " + str(e))
             
-            #update the Glacier archive id in dynamodb
+            #update the Glacier archive id in dynamodb; the index is
+            #deleted with the result (it can be rebuilt from a restored
+            #result with tabix), so its key is removed
+            update = "set results_file_archive_id = :archive_id"
+            if index_file_name is not None:
+                update = update + " remove s3_key_index_file"
             try:
                 response = ann_table.update_item(
                     Key={
                         'job_id': job_id
                     },
-                    UpdateExpression="set results_file_archive_id = :archive_id",
+                    UpdateExpression=update,
                     ConditionExpression="job_id = :job_id",
                     ExpressionAttributeValues={
                         ':archive_id': archive_id,
@@ -95,6 +102,13 @@ def go():
             except ClientError as e: 
                 print("Failed to delete the result file in S3 bucket: " + str(e)) 
 
+            #delete the index of the result from s3 bucket
+            if index_file_name is not None:
+                try:
+                    s3.Object(config['aws']['AWS_S3_RESULTS_BUCKET'], index_file_name).delete()
+                except ClientError as e: 
+                    print("Failed to delete the result index in S3 bucket: " + str(e)) 
+
             #delete the message
             try:
                 delete_response = message.delete()
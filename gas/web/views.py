@@ -232,6 +232,9 @@ def annotation_details(id):
       results_key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + job_id + '~' +\
                         input_file_name.split('.')[0] + '.' + app.config['RESULTS_SUFFIX'] + '.' +\
                         input_file_name.split('.')[1]
+      # Results are now bgzipped; the annotator records the key it wrote
+      if 's3_key_result_file' in item:
+        results_key_name = item['s3_key_result_file']
       
       #annotation['restore_message'] = 
       #check if the result file in s3 bucket